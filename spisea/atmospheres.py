@@ -16,21 +16,12 @@ def get_atmosphere_bounds(model_dir, metallicity=0, temperature=20000, gravity=4
     """
     Given atmosphere model, get temperature and gravity bounds
     """
-    # Open catalog fits file and break out row indices
-    catalog = Table.read('{0}/grid/{1}/catalog.fits'.format(os.environ['PYSYN_CDBS'], model_dir))
+    # Get the (cached) catalog of the grid, with the parameters of each model
+    catalog = get_grid_catalog(model_dir)
     
-    teff_arr = []
-    z_arr = []
-    logg_arr = []
-    for cur_row_index in range(len(catalog)):
-        index = catalog['INDEX'][cur_row_index]
-        tmp = index.split(',')
-        teff_arr.append(float(tmp[0]))
-        z_arr.append(float(tmp[1]))
-        logg_arr.append(float(tmp[2]))
-    teff_arr = np.array(teff_arr)
-    z_arr = np.array(z_arr)
-    logg_arr = np.array(logg_arr)
+    teff_arr = np.array(catalog['teff'])
+    z_arr = np.array(catalog['metallicity'])
+    logg_arr = np.array(catalog['logg'])
 
     # Filter by metallicity. Will chose the closest metallicity to desired input
     metal_list = np.unique(np.array(z_arr))
@@ -795,37 +786,26 @@ def get_merged_atmosphere(metallicity=0, temperature=20000, gravity=4.5, verbose
     temperature ranges where we switch between model grids, to 
     ensure a smooth transition.
     """
-    # For T < 3800, atmosphere depends on metallicity + gravity.
-    # If solar metallicity, use BTSettl 2015 grid. Only solar metallicity is
-    # currently available here, so if non-solar metallicity, just stick with
-    # the Phoenix grid
-    if (temperature <= 3800) & (metallicity == 0):
-        # High gravity are in BTSettl regime
-        if (temperature <= 3200) & (gravity > 2.5):
-            if verbose:
-                print( 'BTSettl_2015 atmosphere')
-            return get_BTSettl_2015_atmosphere(metallicity=metallicity,
-                                                temperature=temperature,
-                                                gravity=gravity,
-                                                rebin=rebin)
- 
-        if (temperature >= 3200) & (temperature < 3800) & (gravity > 2.5):
-            if verbose:
-                print( 'BTSettl/Phoenixv16 merged atmosphere')
-            return get_BTSettl_phoenix_atmosphere(metallicity=metallicity,
-                                                temperature=temperature,
-                                                gravity=gravity)
+    grid = get_merged_atmosphere_grid(metallicity=metallicity,
+                                      temperature=temperature,
+                                      gravity=gravity, rebin=rebin)
 
-        # Low gravity is PHOENIX regime
-        if gravity <= 2.5:
-            if verbose:
-                print( 'Phoenixv16 atmosphere')
-            return get_phoenixv16_atmosphere(metallicity=metallicity,
+    if grid in ['BTSettl_2015', 'BTSettl_2015_rebin']:
+        if verbose:
+            print( 'BTSettl_2015 atmosphere')
+        return get_BTSettl_2015_atmosphere(metallicity=metallicity,
                                             temperature=temperature,
                                             gravity=gravity,
                                             rebin=rebin)
-        
-    if (temperature <= 3800) & (metallicity != 0):
+ 
+    if grid == 'merged_BTSettl_phoenix':
+        if verbose:
+            print( 'BTSettl/Phoenixv16 merged atmosphere')
+        return get_BTSettl_phoenix_atmosphere(metallicity=metallicity,
+                                            temperature=temperature,
+                                            gravity=gravity)
+
+    if grid in ['phoenix_v16', 'phoenix_v16_rebin']:
         if verbose:
             print( 'Phoenixv16 atmosphere')
         return get_phoenixv16_atmosphere(metallicity=metallicity,
@@ -833,43 +813,666 @@ def get_merged_atmosphere(metallicity=0, temperature=20000, gravity=4.5, verbose
                                         gravity=gravity,
                                         rebin=rebin)
 
-    # For T > 3800, no metallicity or gravity dependence
-    if (temperature >= 3800) & (temperature < 5000):
-        if verbose:
-            print( 'Phoenixv16 atmosphere')
-        return get_phoenixv16_atmosphere(metallicity=metallicity,
-                                      temperature=temperature,
-                                      gravity=gravity,
-                                      rebin=rebin)
-
-    if (temperature >= 5000) & (temperature < 5500):
+    if grid == 'merged_atlas_phoenix':
         if verbose:
             print( 'ATLAS/Phoenix merged atmosphere')
         return get_atlas_phoenix_atmosphere(metallicity=metallicity,
                                         temperature=temperature,
                                         gravity=gravity)
     
-    if (temperature >= 5500) & (temperature < 20000):
+    if grid == 'ck04models':
         if verbose:
-            print( 'ATLAS merged atmosphere')
+            if temperature < 20000:
+                print( 'ATLAS merged atmosphere')
+            else:
+                print( 'Still ATLAS merged atmosphere')
         return get_castelli_atmosphere(metallicity=metallicity,
                                       temperature=temperature,
                                       gravity=gravity)
 
-    if temperature >= 20000:
-        if verbose:
-            print( 'Still ATLAS merged atmosphere')
-        return get_castelli_atmosphere(metallicity=metallicity,
-                                       temperature=temperature,
-                                       gravity=gravity)
-
         #print('CMFGEN')
         #return get_cmfgenRot_atmosphere_closest(metallicity=metallicity,
         #                               temperature=temperature,
         #                               gravity=gravity)
 
+def get_merged_atmosphere_grid(metallicity=0, temperature=20000, gravity=4.5,
+                               rebin=True):
+    """
+    Return the name of the pysynphot atmosphere grid (the directory
+    under $PYSYN_CDBS/grid) that get_merged_atmosphere uses for the
+    input stellar parameters. See get_merged_atmosphere for the rules.
+    Returns None if no grid applies (e.g. temperature = nan).
+
+    Parameters
+    ----------
+    metallicity: float
+        The stellar metallicity, in terms of [Z]
+
+    temperature: float
+        The stellar temperature, in units of K
+
+    gravity: float
+        The stellar gravity, in cgs units
+        
+    rebin: boolean
+        If true, use the rebinned versions of the PHOENIXv16 and
+        BTSettl_2015 grids.
+    """
+    if rebin == True:
+        phoenix_grid = 'phoenix_v16_rebin'
+        btsettl_grid = 'BTSettl_2015_rebin'
+    else:
+        phoenix_grid = 'phoenix_v16'
+        btsettl_grid = 'BTSettl_2015'
+
+    # For T < 3800, atmosphere depends on metallicity + gravity.
+    # If solar metallicity, use BTSettl 2015 grid. Only solar metallicity is
+    # currently available here, so if non-solar metallicity, just stick with
+    # the Phoenix grid
+    if (temperature <= 3800) & (metallicity == 0):
+        # High gravity are in BTSettl regime
+        if (temperature <= 3200) & (gravity > 2.5):
+            return btsettl_grid
+ 
+        if (temperature >= 3200) & (temperature < 3800) & (gravity > 2.5):
+            return 'merged_BTSettl_phoenix'
+
+        # Low gravity is PHOENIX regime
+        if gravity <= 2.5:
+            return phoenix_grid
+        
+    if (temperature <= 3800) & (metallicity != 0):
+        return phoenix_grid
+
+    # For T > 3800, no metallicity or gravity dependence
+    if (temperature >= 3800) & (temperature < 5000):
+        return phoenix_grid
+
+    if (temperature >= 5000) & (temperature < 5500):
+        return 'merged_atlas_phoenix'
+    
+    # T >= 5500: ATLAS
+    if temperature >= 5500:
+        return 'ck04models'
+
+    return None
+
+# Atmosphere functions that draw from a single pysynphot grid,
+# as (grid, rebinned grid).
+atm_func_grids = {'get_kurucz_atmosphere': ('k93models', 'k93models'),
+                  'get_castelli_atmosphere': ('ck04models', 'ck04models'),
+                  'get_phoenixv16_atmosphere': ('phoenix_v16', 'phoenix_v16_rebin'),
+                  'get_BTSettl_2015_atmosphere': ('BTSettl_2015', 'BTSettl_2015_rebin'),
+                  'get_atlas_phoenix_atmosphere': ('merged_atlas_phoenix', 'merged_atlas_phoenix'),
+                  'get_BTSettl_phoenix_atmosphere': ('merged_BTSettl_phoenix', 'merged_BTSettl_phoenix')}
+
+def has_atmosphere_grid(atm_func):
+    """
+    Return True if atm_func draws from pysynphot grids that 
+    get_atmosphere_grid knows about (get_merged_atmosphere and
+    the functions in atm_func_grids).
+    """
+    return (atm_func.__name__ == 'get_merged_atmosphere') | (atm_func.__name__ in atm_func_grids)
+
+def get_atmosphere_grid(atm_func, metallicity=0, temperature=20000, gravity=4.5,
+                        rebin=True):
+    """
+    Return the name of the pysynphot atmosphere grid that atm_func
+    uses for the input stellar parameters. Only get_merged_atmosphere
+    and the single-grid functions in atm_func_grids are supported;
+    raises a ValueError otherwise.
+    """
+    if not has_atmosphere_grid(atm_func):
+        raise ValueError('No atmosphere grid defined for {0}'.format(atm_func.__name__))
+
+    if atm_func.__name__ == 'get_merged_atmosphere':
+        return get_merged_atmosphere_grid(metallicity=metallicity,
+                                          temperature=temperature,
+                                          gravity=gravity, rebin=rebin)
+
+    if rebin == True:
+        return atm_func_grids[atm_func.__name__][1]
+    else:
+        return atm_func_grids[atm_func.__name__][0]
+
+def get_atmosphere_grids(atm_func, rebin=True):
+    """
+    Return the names of all the pysynphot atmosphere grids that
+    atm_func can draw from (an empty list if atm_func has no
+    known grid, see has_atmosphere_grid).
+    """
+    if atm_func.__name__ == 'get_merged_atmosphere':
+        atm_grids = ['ck04models', 'merged_atlas_phoenix', 'merged_BTSettl_phoenix']
+        if rebin == True:
+            atm_grids += ['phoenix_v16_rebin', 'BTSettl_2015_rebin']
+        else:
+            atm_grids += ['phoenix_v16', 'BTSettl_2015']
+            
+        return atm_grids
+
+    if atm_func.__name__ in atm_func_grids:
+        return [get_atmosphere_grid(atm_func, rebin=rebin)]
+
+    return []
+
+# Cache of the parsed grid catalogs, keyed on grid name.
+_grid_catalogs = {}
+
+def get_grid_catalog(model_dir):
+    """
+    Read the catalog of a pysynphot atmosphere grid
+    ($PYSYN_CDBS/grid/<model_dir>/catalog.fits) and return a table
+    with the teff, metallicity, logg, and filename (with the flux
+    column, e.g. 'file.fits[g45]') of each model.
+    The catalog is only read once.
+    """
+    if model_dir in _grid_catalogs:
+        return _grid_catalogs[model_dir]
+
+    catalog = Table.read('{0}/grid/{1}/catalog.fits'.format(os.environ['PYSYN_CDBS'], model_dir))
+
+    params = np.array([[float(val) for val in index.split(',')] for index in catalog['INDEX']])
+    filenames = [filename.strip() for filename in catalog['FILENAME']]
+
+    grid_cat = Table([params[:, 0], params[:, 1], params[:, 2], filenames],
+                     names=['teff', 'metallicity', 'logg', 'filename'])
+    grid_cat.meta['GRID'] = model_dir
+
+    _grid_catalogs[model_dir] = grid_cat
+
+    return grid_cat
+
+def get_grid_spectrum(model_dir, index):
+    """
+    Return the spectrum of catalog row `index` of a pysynphot
+    atmosphere grid, as read by pysynphot.Icat.
+    """
+    grid_cat = get_grid_catalog(model_dir)
     
+    tmp = grid_cat['filename'][index].split('[')
+    filename = '{0}/grid/{1}/{2}'.format(os.environ['PYSYN_CDBS'], model_dir, tmp[0])
+
+    return pysynphot.spectrum.TabularSourceSpectrum(filename, fluxname=tmp[1][:-1])
+
+def get_grid_weights(model_dir, metallicity=0, temperature=20000, gravity=4,
+                     valid=None, check_bounds=False):
+    """
+    Return the catalog rows and weights that pysynphot.Icat combines
+    to interpolate an atmosphere at the input parameters, so that the
+    interpolated spectrum is sum(weights * spectrum[rows]).
 
+    The interpolation is linear in temperature, then metallicity, then
+    gravity, between the bracketing models, exactly as in pysynphot.Icat.
+
+    Parameters
+    ----------
+    model_dir: str
+        Name of the atmosphere grid
+
+    metallicity: float
+        The stellar metallicity, in terms of [Z]
+
+    temperature: float
+        The stellar temperature, in units of K
+
+    gravity: float
+        The stellar gravity, in cgs units
+
+    valid: boolean array or None
+        If set, marks which catalog rows have valid (finite, non-zero)
+        spectra. Like pysynphot.Icat, a bracketing model without valid
+        data raises ParameterOutOfBounds.
+
+    check_bounds: boolean
+        If True and the interpolation fails, move the temperature and
+        gravity inside the grid with get_atmosphere_bounds and try again,
+        like the atmosphere functions (e.g. get_phoenixv16_atmosphere) do.
+
+    Returns
+    -------
+    rows, weights : numpy arrays
+        Catalog rows and their interpolation weights (up to 8 of each).
+
+    Raises
+    ------
+    pysynphot.exceptions.ParameterOutOfBounds
+        If the parameters are outside of the grid.
+    """
+    if check_bounds:
+        try:
+            return get_grid_weights(model_dir, metallicity=metallicity,
+                                    temperature=temperature, gravity=gravity,
+                                    valid=valid)
+        except pysynphot.exceptions.ParameterOutOfBounds:
+            # Check atmosphere catalog bounds
+            (temperature, gravity) = get_atmosphere_bounds(model_dir,
+                                                       metallicity=metallicity,
+                                                       temperature=temperature,
+                                                       gravity=gravity)
+
+    grid_cat = get_grid_catalog(model_dir)
+    par_names = ['teff', 'metallicity', 'logg']
+    par_values = [temperature, metallicity, gravity]
+
+    # Each entry is a set of candidate rows and the weight they carry.
+    brackets = [(np.arange(len(grid_cat)), 1.0)]
+
+    for name, par in zip(par_names, par_values):
+        par = float(par)
+        new_brackets = []
+        
+        for rows, wt in brackets:
+            vals = np.asarray(grid_cat[name])[rows]
+
+            upper = vals[vals >= par]
+            lower = vals[vals <= par]
+            if (len(upper) == 0) or (len(lower) == 0):
+                msg = "Parameter '{0}' exceeds data for {1}: {2}"
+                raise pysynphot.exceptions.ParameterOutOfBounds(msg.format(name, model_dir, par))
+
+            hi = upper.min()
+            lo = lower.max()
+            rows_hi = rows[(vals >= par) & (vals <= hi)]
+            rows_lo = rows[(vals >= lo) & (vals <= par)]
+
+            if hi == lo:
+                new_brackets.append((rows_hi, wt))
+            else:
+                a = (hi - par) / (hi - lo)
+                new_brackets.append((rows_hi, wt * (1.0 - a)))
+                new_brackets.append((rows_lo, wt * a))
+
+        brackets = new_brackets
+
+    rows = np.array([bracket[0][0] for bracket in brackets])
+    weights = np.array([bracket[1] for bracket in brackets])
+
+    if (valid is not None) and (not np.all(valid[rows])):
+        msg = 'Bracketing models have no valid data for {0}: {1}'
+        raise pysynphot.exceptions.ParameterOutOfBounds(msg.format(model_dir, par_values))
+
+    return rows, weights
+
+# Cache of the grid nodes, keyed on grid name.
+_grid_nodes = {}
+
+def get_grid_nodes(model_dir):
+    """
+    Return the nodes of a pysynphot atmosphere grid, for the batched
+    interpolation (see get_grid_weights_batch): the sorted temperatures,
+    the sorted metallicities at each temperature, and the sorted
+    gravities with their (first) catalog row at each temperature
+    and metallicity.
+    """
+    if model_dir in _grid_nodes:
+        return _grid_nodes[model_dir]
+
+    grid_cat = get_grid_catalog(model_dir)
+    teff = np.array(grid_cat['teff'])
+    metal = np.array(grid_cat['metallicity'])
+    logg = np.array(grid_cat['logg'])
+
+    nodes = {'teff': np.unique(teff), 'metallicity': {}, 'logg': {}}
+    for tt in nodes['teff']:
+        nodes['metallicity'][tt] = np.unique(metal[teff == tt])
+        
+        for zz in nodes['metallicity'][tt]:
+            rows = np.where((teff == tt) & (metal == zz))[0]
+            logg_uni, first = np.unique(logg[rows], return_index=True)
+            nodes['logg'][(tt, zz)] = (logg_uni, rows[first])
+
+    _grid_nodes[model_dir] = nodes
+
+    return nodes
+
+def bracket_grid_values(values, par):
+    """
+    For each value in par, find the bracketing (upper, lower)
+    values in the sorted array of grid values, and the weight of
+    the upper value, as in pysynphot.Icat. Returns
+    (upper, lower, upper weight, inside grid).
+    """
+    hi = np.searchsorted(values, par, side='left')
+    lo = np.searchsorted(values, par, side='right') - 1
+    inside = (hi < len(values)) & (lo >= 0)
+
+    hi_val = values[np.clip(hi, 0, len(values) - 1)]
+    lo_val = values[np.clip(lo, 0, len(values) - 1)]
+
+    wt_hi = np.ones(len(par), dtype=float)
+    diff = hi_val != lo_val
+    wt_hi[diff] = (par[diff] - lo_val[diff]) / (hi_val[diff] - lo_val[diff])
+
+    return hi_val, lo_val, wt_hi, inside
+
+def get_grid_weights_batch(model_dir, metallicity=0, temperature=[20000], gravity=[4],
+                           valid=None, check_bounds=False):
+    """
+    Batched version of get_grid_weights: return the catalog rows and
+    weights that pysynphot.Icat combines for many stars at once, such
+    that the interpolated spectra are sum(weights * spectrum[rows], axis=1). 
+
+    Parameters
+    ----------
+    model_dir: str
+        Name of the atmosphere grid
+
+    metallicity: float or array
+        The stellar metallicity, in terms of [Z]
+
+    temperature: array
+        The stellar temperatures, in units of K
+
+    gravity: array
+        The stellar gravities, in cgs units
+
+    valid: boolean array or None
+        If set, marks which catalog rows have valid (finite, non-zero)
+        spectra.
+
+    check_bounds: boolean
+        If True, the stars that fail are moved inside the grid with 
+        get_atmosphere_bounds and tried again (see get_grid_weights).
+        
+    Returns
+    -------
+    rows, weights : numpy arrays
+        Catalog rows and their interpolation weights, with
+        shape (N_stars, 8).
+
+    good : boolean array
+        False for stars where pysynphot.Icat would fail: parameters outside 
+        of the grid, or bracketing models without valid data.
+    """
+    temperature = np.atleast_1d(temperature).astype(float)
+    gravity = np.atleast_1d(gravity).astype(float)
+    metallicity = np.broadcast_to(np.atleast_1d(metallicity).astype(float), temperature.shape)
+    nstars = len(temperature)
+
+    nodes = get_grid_nodes(model_dir)
+
+    rows = np.zeros((nstars, 8), dtype=int)
+    weights = np.zeros((nstars, 8), dtype=float)
+    good = np.ones(nstars, dtype=bool)
+
+    # Bracket in temperature, then metallicity, then gravity. The 8 corners
+    # are ordered like the pysynphot.Icat spectra (upper before lower).
+    t_hi, t_lo, t_wt, inside = bracket_grid_values(nodes['teff'], temperature)
+    good &= inside
+
+    for ct, (t_val, t_w) in enumerate([(t_hi, t_wt), (t_lo, 1 - t_wt)]):
+        for tt in np.unique(t_val[good]):
+            sel_t = np.where(good & (t_val == tt))[0]
+
+            z_hi, z_lo, z_wt, inside = bracket_grid_values(nodes['metallicity'][tt],
+                                                           metallicity[sel_t])
+            good[sel_t[~inside]] = False
+
+            for cz, (z_val, z_w) in enumerate([(z_hi, z_wt), (z_lo, 1 - z_wt)]):
+                for zz in np.unique(z_val[inside]):
+                    sel_z = inside & (z_val == zz)
+                    sel_tz = sel_t[sel_z]
+                    
+                    logg_vals, logg_rows = nodes['logg'][(tt, zz)]
+                    g_hi, g_lo, g_wt, g_inside = bracket_grid_values(logg_vals,
+                                                                     gravity[sel_tz])
+                    good[sel_tz[~g_inside]] = False
+
+                    for cg, (g_val, g_w) in enumerate([(g_hi, g_wt), (g_lo, 1 - g_wt)]):
+                        corner = 4*ct + 2*cz + cg
+                        rows[sel_tz, corner] = logg_rows[np.searchsorted(logg_vals, g_val)]
+                        weights[sel_tz, corner] = t_w[sel_tz] * z_w[sel_z] * g_w
+
+    # Like pysynphot.Icat, all the bracketing models must have valid data.
+    if valid is not None:
+        good &= np.all(valid[rows], axis=1)
+
+    rows[~good] = 0
+    weights[~good] = 0
+
+    # Check atmosphere catalog bounds for the stars that failed
+    if check_bounds:
+        for ii in np.where(~good)[0]:
+            rows_ii, weights_ii = get_grid_weights(model_dir, metallicity=metallicity[ii],
+                                                   temperature=temperature[ii],
+                                                   gravity=gravity[ii],
+                                                   valid=valid, check_bounds=True)
+            rows[ii] = rows_ii[0]
+            rows[ii, :len(rows_ii)] = rows_ii
+            weights[ii, :len(rows_ii)] = weights_ii
+            good[ii] = True
+
+    return rows, weights, good
+
+def get_atmosphere_cube_files(model_dir):
+    """
+    Return the names of the flux cube, wavelength, and index files
+    of an atmosphere grid (see make_atmosphere_cube).
+    """
+    cube_root = '{0}/grid/{1}/cube'.format(os.environ['PYSYN_CDBS'], model_dir)
+    
+    return (cube_root + '_flux.npy', cube_root + '_wave.npy', cube_root + '_index.fits')
+
+def make_atmosphere_cube(model_dir):
+    """
+    Pack all the spectra of a pysynphot atmosphere grid into a single
+    flux cube, which can be memory-mapped by get_atmosphere_batch instead
+    of opening the FITS files of each model. Processes that use the same
+    grid share the cube pages in the OS cache.
+
+    The cube has shape (N_models, N_wave), with one row per model
+    in the grid catalog; it is saved with the wavelengths and an index
+    (the teff, metallicity, logg, and valid flag of each model) as
+    $PYSYN_CDBS/grid/<model_dir>/cube_flux.npy, cube_wave.npy, and
+    cube_index.fits. Flux is in photlam, the pysynphot internal units. 
+    All the models are sampled at the wavelengths of the first one.
+
+    Parameters
+    ----------
+    model_dir: str
+        Name of the atmosphere grid
+    """
+    t1 = time.time()
+    
+    grid_cat = get_grid_catalog(model_dir)
+    flux_file, wave_file, index_file = get_atmosphere_cube_files(model_dir)
+
+    wave = None
+    valid = np.zeros(len(grid_cat), dtype=bool)
+    
+    for ii in range(len(grid_cat)):
+        sp = get_grid_spectrum(model_dir, ii)
+
+        if wave is None:
+            wave = sp.wave
+            flux = np.lib.format.open_memmap(flux_file, mode='w+', dtype=float,
+                                             shape=(len(grid_cat), len(wave)))
+
+        # Models without a positive total flux are invalid (as in pysynphot.Icat)
+        totflux = sp.integrate()
+        valid[ii] = np.isfinite(totflux) & (totflux > 0)
+        
+        flux[ii] = sp(wave)
+
+    flux.flush()
+    del flux
+    np.save(wave_file, wave)
+
+    index = Table([grid_cat['teff'], grid_cat['metallicity'], grid_cat['logg'], valid],
+                  names=['teff', 'metallicity', 'logg', 'valid'])
+    index.meta['GRID'] = model_dir
+    index.write(index_file, overwrite=True)
+
+    t2 = time.time()
+    print( 'Atmosphere cube for {0} took {1:f} s.'.format(model_dir, t2-t1))
+    
+    return
+
+# Cache of the memory-mapped atmosphere cubes, keyed on grid name.
+_atmosphere_cubes = {}
+
+def get_atmosphere_cube(model_dir):
+    """
+    Return the wavelengths, flux cube (memory-mapped), and valid flags
+    of an atmosphere grid made by make_atmosphere_cube, or None if
+    there is no cube for the grid.
+    """
+    if model_dir in _atmosphere_cubes:
+        return _atmosphere_cubes[model_dir]
+
+    flux_file, wave_file, index_file = get_atmosphere_cube_files(model_dir)
+    if not os.path.exists(index_file):
+        return None
+
+    wave = np.load(wave_file)
+    flux = np.load(flux_file, mmap_mode='r')
+    valid = np.array(Table.read(index_file)['valid'])
+    
+    _atmosphere_cubes[model_dir] = (wave, flux, valid)
+
+    return _atmosphere_cubes[model_dir]
+
+def get_tabular_spectrum(wave, flux, name=''):
+    """
+    Return a pysynphot spectrum with the input wavelengths (Angstroms) and
+    flux (photlam, the pysynphot internal units), without any unit
+    conversion. Like the grid spectra, its flux is reported in flam.
+    """
+    sp = pysynphot.spectrum.TabularSourceSpectrum()
+    sp._wavetable = wave
+    sp._fluxtable = flux
+    sp.waveunits = pysynphot.units.Units('angstrom')
+    sp.fluxunits = pysynphot.units.Units('flam')
+    sp.name = name
+
+    return sp
+
+def get_atmosphere_batch(atm_func, metallicity=0, temperature=[20000], gravity=[4.5],
+                         rebin=True):
+    """
+    Return the atmospheres of many stars at once, equivalent to calling 
+    atm_func for each star. Only get_merged_atmosphere and the 
+    single-grid atmosphere functions (see atm_func_grids) are supported.
+
+    The stars are grouped by atmosphere grid, and all the stars of
+    a grid are interpolated in one matrix operation with the
+    pysynphot.Icat weights (get_grid_weights_batch). The spectra come 
+    from the memory-mapped grid cube if it exists (see make_atmosphere_cube),
+    and otherwise only the needed models are read.
+    Stars outside of the grid are moved inside with get_atmosphere_bounds,
+    as in the atmosphere functions.
+
+    Parameters
+    ----------
+    atm_func: model atmosphere function
+        The atmosphere function to reproduce
+
+    metallicity: float
+        The stellar metallicity, in terms of [Z]
+
+    temperature: array
+        The stellar temperatures, in units of K
+
+    gravity: array
+        The stellar gravities, in cgs units
+        
+    rebin: boolean
+        If true, use the rebinned versions of the PHOENIXv16 and 
+        BTSettl_2015 grids.
+
+    Returns
+    -------
+    spec_list : list of pysynphot spectra
+        The atmosphere of each star (None if there is no grid for it).
+    """
+    temperature = np.atleast_1d(temperature).astype(float)
+    gravity = np.atleast_1d(gravity).astype(float)
+
+    star_grids = np.array([get_atmosphere_grid(atm_func, metallicity=metallicity,
+                                               temperature=temperature[ii],
+                                               gravity=gravity[ii], rebin=rebin)
+                           for ii in range(len(temperature))], dtype=object)
+
+    spec_list = [None] * len(temperature)
+
+    for model_dir in set(star_grids) - set([None]):
+        idx = np.where(star_grids == model_dir)[0]
+
+        cube = get_atmosphere_cube(model_dir)
+        if cube is not None:
+            wave, flux, valid = cube
+        else:
+            # Without a cube, read in only the models that are needed. 
+            models = {}
+            valid = np.ones(len(get_grid_catalog(model_dir)), dtype=bool)
+            rows, weights, good = get_grid_weights_batch(model_dir, metallicity=metallicity,
+                                                         temperature=temperature[idx],
+                                                         gravity=gravity[idx])
+            for row in np.unique(rows[good]):
+                models[row] = get_grid_spectrum(model_dir, row)
+                totflux = models[row].integrate()
+                valid[row] = np.isfinite(totflux) & (totflux > 0)
+
+        rows, weights, good = get_grid_weights_batch(model_dir, metallicity=metallicity,
+                                                     temperature=temperature[idx],
+                                                     gravity=gravity[idx], valid=valid,
+                                                     check_bounds=True)
+
+        if cube is None:
+            uni_rows, inv = np.unique(rows, return_inverse=True)
+            
+            for row in uni_rows:
+                if row not in models:
+                    models[row] = get_grid_spectrum(model_dir, row)
+                    totflux = models[row].integrate()
+                    if (not np.isfinite(totflux)) or (totflux <= 0):
+                        msg = 'Model {0} of {1} has no valid data.'
+                        raise pysynphot.exceptions.ParameterOutOfBounds(msg.format(row, model_dir))
+
+            wave = models[uni_rows[0]].wave
+            flux = np.array([models[row](wave) for row in uni_rows])
+            rows = inv.reshape(rows.shape)
+
+        # Interpolate all the stars at once
+        star_flux = np.zeros((len(idx), len(wave)), dtype=float)
+        for cc in range(rows.shape[1]):
+            star_flux += weights[:, cc, None] * flux[rows[:, cc]]
+
+        for ii in range(len(idx)):
+            name = '{0}(Teff={1:g},metallicity={2:g},logG={3:g})'.format(model_dir,
+                                                                     temperature[idx[ii]],
+                                                                     metallicity,
+                                                                     gravity[idx[ii]])
+            
+            spec_list[idx[ii]] = get_tabular_spectrum(wave, star_flux[ii], name=name)
+
+    return spec_list
+
+def get_merged_atmosphere_batch(metallicity=0, temperature=[20000], gravity=[4.5],
+                                rebin=True):
+    """
+    Return the get_merged_atmosphere atmospheres of many stars at once,
+    with the same model grids (and transitions between them). 
+    See get_atmosphere_batch.
+
+    Parameters
+    ----------
+    metallicity: float
+        The stellar metallicity, in terms of [Z]
+
+    temperature: array
+        The stellar temperatures, in units of K
+
+    gravity: array
+        The stellar gravities, in cgs units
+        
+    rebin: boolean
+        If true, use the rebinned versions of the PHOENIXv16 and 
+        BTSettl_2015 grids.
+    """
+    return get_atmosphere_batch(get_merged_atmosphere, metallicity=metallicity,
+                                temperature=temperature, gravity=gravity,
+                                rebin=rebin)
 
 def get_wd_atmosphere(metallicity=0, temperature=20000, gravity=4, verbose=False):
     """
@@ -23,6 +23,7 @@
 #########################################################
 
 import numpy as np
+from spisea.utils.rng import get_rng
 
 class IFMR(object):
     def __init__(self):
@@ -717,7 +718,7 @@ class IFMR_Raithel18(IFMR):
         """
         return f_ej * self.BH_mass_core_low(MZAMS) + (1 - f_ej) * self.BH_mass_all_low(MZAMS)
 
-    def NS_mass(self, MZAMS):
+    def NS_mass(self, MZAMS, rng=None):
         """                                                                                                      
         Drawing the NS mass from a Gaussian distrobuton based on observational data.
 
@@ -728,11 +729,12 @@ class IFMR_Raithel18(IFMR):
         J1757+1854 Cameron et al. (2018), J0030+0451 Riley et al. (2019), J1301+0833 Romani et al. (2016)
         The Gaussian distribution was fit using this data and a Bayesian MCMC method adapted from
         Kiziltan et al. (2010).
-        
+
+        rng is the numpy random Generator (or seed) to use.
         """
-        return np.random.normal(loc=1.36, scale=0.09, size=len(MZAMS))
+        return get_rng(rng).normal(loc=1.36, scale=0.09, size=len(MZAMS))
 
-    def generate_death_mass(self, mass_array):
+    def generate_death_mass(self, mass_array, rng=None):
         """
         The top-level function that assigns the remnant type 
         and mass based on the stellar initial mass. 
@@ -742,6 +744,8 @@ class IFMR_Raithel18(IFMR):
         mass_array: array of floats
             Array of initial stellar masses. Units are
             M_sun.
+        rng: numpy.random.Generator, int, or None
+            Random number generator (or seed) to use.
 
 
         Notes
@@ -772,7 +776,8 @@ class IFMR_Raithel18(IFMR):
         output_array = np.zeros((2, len(mass_array)))
 
         #Random array to get probabilities for what type of object will form
-        random_array = np.random.randint(1, 1001, size = len(mass_array))
+        rng = get_rng(rng)
+        random_array = rng.integers(1, 1001, size = len(mass_array))
 
         codes = {'WD': 101, 'NS': 102, 'BH': 103}
         
@@ -788,7 +793,7 @@ class IFMR_Raithel18(IFMR):
         output_array[1][id_array1]= codes['WD']
 
         id_array2 = np.where((mass_array >= 9) & (mass_array < 15))
-        output_array[0][id_array2] = self.NS_mass(mass_array[id_array2])
+        output_array[0][id_array2] = self.NS_mass(mass_array[id_array2], rng=rng)
         output_array[1][id_array2] = codes['NS']
 
         id_array3_BH = np.where((mass_array >= 15) & (mass_array < 17.8) & (random_array > 679))
@@ -796,7 +801,7 @@ class IFMR_Raithel18(IFMR):
         output_array[1][id_array3_BH] = codes['BH']
 
         id_array3_NS = np.where((mass_array >= 15) & (mass_array < 17.8) & (random_array <= 679))
-        output_array[0][id_array3_NS] = self.NS_mass(mass_array[id_array3_NS])
+        output_array[0][id_array3_NS] = self.NS_mass(mass_array[id_array3_NS], rng=rng)
         output_array[1][id_array3_NS] = codes['NS']
 
         id_array4_BH = np.where((mass_array >= 17.8) & (mass_array < 18.5) & (random_array > 833))
@@ -804,7 +809,7 @@ class IFMR_Raithel18(IFMR):
         output_array[1][id_array4_BH] = codes['BH']
         
         id_array4_NS = np.where((mass_array >= 17.8) & (mass_array < 18.5) & (random_array <= 833))
-        output_array[0][id_array4_NS] = self.NS_mass(mass_array[id_array4_NS])
+        output_array[0][id_array4_NS] = self.NS_mass(mass_array[id_array4_NS], rng=rng)
         output_array[1][id_array4_NS] = codes['NS']
 
         id_array5_BH = np.where((mass_array >= 18.5) & (mass_array < 21.7) & (random_array > 500))
@@ -812,7 +817,7 @@ class IFMR_Raithel18(IFMR):
         output_array[1][id_array5_BH] = codes['BH']
         
         id_array5_NS = np.where((mass_array >= 18.5) & (mass_array < 21.7) & (random_array <= 500))
-        output_array[0][id_array5_NS] = self.NS_mass(mass_array[id_array5_NS])
+        output_array[0][id_array5_NS] = self.NS_mass(mass_array[id_array5_NS], rng=rng)
         output_array[1][id_array5_NS] = codes['NS']
 
         id_array6 = np.where((mass_array >= 21.7) & (mass_array < 25.2))
@@ -824,7 +829,7 @@ class IFMR_Raithel18(IFMR):
         output_array[1][id_array7_BH] = codes['BH']
         
         id_array7_NS = np.where((mass_array >= 25.2) & (mass_array < 27.5) & (random_array <= 652))
-        output_array[0][id_array7_NS] = self.NS_mass(mass_array[id_array7_NS])
+        output_array[0][id_array7_NS] = self.NS_mass(mass_array[id_array7_NS], rng=rng)
         output_array[1][id_array7_NS] = codes['NS']
 
         id_array8 = np.where((mass_array >= 27.5) & (mass_array < 42.22))
@@ -840,7 +845,7 @@ class IFMR_Raithel18(IFMR):
         output_array[1][id_array10_BH] = codes['BH']
         
         id_array10_NS = np.where((mass_array >= 60) & (mass_array < 120) & (random_array <= 400))
-        output_array[0][id_array10_NS] = self.NS_mass(mass_array[id_array10_NS])
+        output_array[0][id_array10_NS] = self.NS_mass(mass_array[id_array10_NS], rng=rng)
         output_array[1][id_array10_NS] = codes['NS']
 
         return(output_array)
@@ -879,7 +884,7 @@ class IFMR_N20_Sukhbold(IFMR):
     # Solar metallicity (what Sam is using)
     Zsun = 0.014
 
-    def NS_mass(self, MZAMS):
+    def NS_mass(self, MZAMS, rng=None):
         """                                                                                                      
         Drawing the NS mass from a Gaussian distrobuton based on observational data.
 
@@ -890,12 +895,14 @@ class IFMR_N20_Sukhbold(IFMR):
         J1757+1854 Cameron et al. (2018), J0030+0451 Riley et al. (2019), J1301+0833 Romani et al. (2016)
         The Gaussian distribution was fit using this data and a Bayesian MCMC method adapted from
         Kiziltan et al. (2010).
-        
+
+        rng is the numpy random Generator (or seed) to use.
         """
+        rng = get_rng(rng)
         if isinstance(MZAMS, np.ndarray):
-            return np.random.normal(loc=1.36, scale=0.09, size=len(MZAMS))
+            return rng.normal(loc=1.36, scale=0.09, size=len(MZAMS))
         else:
-            return np.random.normal(loc=1.36, scale=0.09, size=1)[0]
+            return rng.normal(loc=1.36, scale=0.09, size=1)[0]
  
  
     def BH_mass_low(self, MZAMS):
@@ -952,7 +959,7 @@ class IFMR_N20_Sukhbold(IFMR):
         return pBH
 
 
-    def generate_death_mass(self, mass_array, metallicity_array):
+    def generate_death_mass(self, mass_array, metallicity_array, rng=None):
         """
         The top-level function that assigns the remnant type 
         and mass based on the stellar initial mass. 
@@ -964,6 +971,8 @@ class IFMR_N20_Sukhbold(IFMR):
             M_sun.
         metallicity_array: array of floats
             Array of metallicities in terms of [Fe/H]
+        rng: numpy.random.Generator, int, or None
+            Random number generator (or seed) to use.
         Notes
         ------
         The output typecode tells what compact object formed:
@@ -999,7 +1008,8 @@ class IFMR_N20_Sukhbold(IFMR):
         Z_array[metal_idx] = self.get_Z(metallicity_array[metal_idx])
 
         # Random array to get probabilities for what type of object will form
-        random_array = np.random.randint(1, 101, size = len(mass_array))
+        rng = get_rng(rng)
+        random_array = rng.integers(1, 101, size = len(mass_array))
 
         id_array0 = np.where((mass_array < 0.5) | (mass_array >= 120))
         output_array[0][id_array0] = -99 * np.ones(len(id_array0))
@@ -1010,7 +1020,7 @@ class IFMR_N20_Sukhbold(IFMR):
         output_array[1][id_array1]= codes['WD']
 
         id_array2 = np.where((mass_array >= 9) & (mass_array < 15))
-        output_array[0][id_array2] = self.NS_mass(mass_array[id_array2])
+        output_array[0][id_array2] = self.NS_mass(mass_array[id_array2], rng=rng)
         output_array[1][id_array2] = codes['NS']
 
         id_array3_BH = np.where((mass_array >= 15) & (mass_array < 21.8) & (random_array > 75))
@@ -1018,7 +1028,7 @@ class IFMR_N20_Sukhbold(IFMR):
         output_array[1][id_array3_BH] = codes['BH']
 
         id_array3_NS = np.where((mass_array >= 15) & (mass_array < 21.8) & (random_array <= 75))
-        output_array[0][id_array3_NS] = self.NS_mass(mass_array[id_array3_NS])
+        output_array[0][id_array3_NS] = self.NS_mass(mass_array[id_array3_NS], rng=rng)
         output_array[1][id_array3_NS] = codes['NS']
 
         id_array4 = np.where((mass_array >= 21.8) & (mass_array < 25.2))
@@ -1026,7 +1036,7 @@ class IFMR_N20_Sukhbold(IFMR):
         output_array[1][id_array4] = codes['BH']
 
         id_array5 = np.where((mass_array >= 25.2) & (mass_array < 27.4))
-        output_array[0][id_array5] = self.NS_mass(mass_array[id_array5])
+        output_array[0][id_array5] = self.NS_mass(mass_array[id_array5], rng=rng)
         output_array[1][id_array5] = codes['NS']
 
         id_array6 = np.where((mass_array >= 27.4) & (mass_array < 39.6))
@@ -1047,13 +1057,13 @@ class IFMR_N20_Sukhbold(IFMR):
                 output_array[1][id_array8[0][i]] = codes['BH']
                 
             else:
-                output_array[0][id_array8[0][i]] = self.NS_mass(mass_array[id_array8][i])
+                output_array[0][id_array8[0][i]] = self.NS_mass(mass_array[id_array8][i], rng=rng)
                 output_array[1][id_array8[0][i]] = codes['NS']
         #this is where sam's janky fix for unphysical BH massses goes
         #any BH with mass less then 3 M_sun is reassigned as a NS
         #and given a mass from the NS mass dist instead
         id_array9 = np.where((output_array[1] == codes['BH']) & (output_array[0] < 3.0))
-        output_array[0][id_array9] = self.NS_mass(mass_array[id_array9])
+        output_array[0][id_array9] = self.NS_mass(mass_array[id_array9], rng=rng)
         output_array[1][id_array9] = codes['NS']
 
         return(output_array)
@@ -17,9 +17,116 @@ import numpy as np
 import time
 import pdb
 import logging
+from scipy.special import gammainc
+from spisea.utils.rng import get_rng
 
 log = logging.getLogger('imf')
 
+def _grow_array(arr, n_used, n_alloc):
+    """
+    Return a copy of arr with n_alloc elements, keeping the
+    first n_used ones.
+    """
+    new_arr = np.zeros(n_alloc, dtype=arr.dtype)
+    new_arr[:n_used] = arr[:n_used]
+    
+    return new_arr
+
+class CompanionMasses(object):
+    """
+    The companion masses of a list of stellar systems, stored as
+    one flat array with the masses of all companions (ordered by system)
+    and the number of companions of each system.
+
+    Indexing with an integer returns the array of companion masses of 
+    that system (like a list of arrays). Indexing with an array, slice or
+    boolean mask returns a new CompanionMasses with the selected systems.
+
+    Parameters
+    ----------
+    N_companions : int array
+        Number of companions of each system.
+
+    masses : float array
+        Masses of all companions, with the companions of 
+        each system in consecutive elements.
+    """
+    def __init__(self, N_companions, masses):
+        self.N_companions = np.asarray(N_companions, dtype=int)
+        self.masses = np.asarray(masses, dtype=float)
+
+        # Position of the first companion of each system in masses
+        self.offsets = np.zeros(len(self.N_companions) + 1, dtype=int)
+        self.offsets[1:] = np.cumsum(self.N_companions)
+
+        if self.offsets[-1] != len(self.masses):
+            raise ValueError('CompanionMasses: number of masses does not match N_companions')
+
+        return
+
+    @classmethod
+    def from_lists(cls, comp_masses):
+        """
+        Make a CompanionMasses from a list (or object array) with
+        the list of companion masses of each system.
+        """
+        N_companions = np.array([len(star_masses) for star_masses in comp_masses], dtype=int)
+        
+        if N_companions.sum() > 0:
+            masses = np.concatenate([np.atleast_1d(star_masses) for star_masses in comp_masses])
+        else:
+            masses = np.array([], dtype=float)
+
+        return cls(N_companions, masses)
+
+    @classmethod
+    def concatenate(cls, comp_list):
+        """
+        Join a list of CompanionMasses (of consecutive systems).
+        """
+        N_companions = np.concatenate([comp.N_companions for comp in comp_list])
+        masses = np.concatenate([comp.masses for comp in comp_list])
+
+        return cls(N_companions, masses)
+
+    def __len__(self):
+        return len(self.N_companions)
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0 and not isinstance(idx, slice):
+            return self.masses[self.offsets[idx]:self.offsets[idx+1]]
+
+        # Contiguous systems: return views
+        if isinstance(idx, slice) and idx.step in (None, 1):
+            start, stop, step = idx.indices(len(self))
+            stop = max(start, stop)
+            return CompanionMasses(self.N_companions[start:stop],
+                                   self.masses[self.offsets[start]:self.offsets[stop]])
+
+        idx = np.arange(len(self))[idx]
+        N_companions = self.N_companions[idx]
+
+        # Position of every selected companion in masses
+        new_offsets = np.cumsum(N_companions) - N_companions
+        cdx = np.repeat(self.offsets[idx] - new_offsets, N_companions)
+        cdx += np.arange(N_companions.sum())
+
+        return CompanionMasses(N_companions, self.masses[cdx])
+
+    def system_index(self):
+        """
+        Index of the system of each companion.
+        """
+        return np.repeat(np.arange(len(self)), self.N_companions)
+
+    def system_mass(self):
+        """
+        Total companion mass of each system.
+        """
+        return np.bincount(self.system_index(), weights=self.masses,
+                           minlength=len(self))
+
+
 class IMF(object):
     """
     The IMF base class. The mass sampling and multiplicity 
@@ -59,7 +166,7 @@ class IMF(object):
         return
             
 
-    def generate_cluster(self, totalMass, seed=None):
+    def generate_cluster(self, totalMass, seed=None, min_mass=None):
         """
         Generate a cluster of stellar systems with the specified IMF.
         
@@ -79,11 +186,23 @@ class IMF(object):
         totalMass : float
             The total mass of the cluster (including companions) in solar masses.
 
-        seed: int
+        seed: int, numpy.random.SeedSequence, or numpy.random.Generator
             If set to non-None, all random sampling will be seeded with the
-            specified seed, forcing identical output.
+            specified seed, forcing identical output. The random numbers
+            are drawn from a numpy Generator made from the seed 
+            (see spisea.utils.rng.get_rng), not the global np.random state.
             Default None
 
+        min_mass : float or None
+            If set, only the systems with primaries more massive than 
+            min_mass are sampled (e.g. those brighter than a magnitude limit),
+            so the total mass of the sampled systems is about the fraction of
+            the system mass of the cluster above min_mass (see 
+            int_system_mass). The companions of these primaries are 
+            made as usual (and can be less massive than min_mass). See
+            mass_below for the number and mass of the systems that are skipped.
+            Default None (all systems are sampled)
+
         Returns
         -------
         masses : numpy float array
@@ -106,28 +225,360 @@ class IMF(object):
         # Estimate the mean number of stars expected.
         self.normalize(totalMass)
         mean_number = self.int_xi(self._mass_limits[0], self._mass_limits[-1])
-        newStarCount = np.round(mean_number)
+
+        # Only sample the part of the IMF above min_mass.
+        r_min, f_mass = self._min_mass_fractions(min_mass)
+
+        # Random number generator, seeded if desired
+        rng = get_rng(seed)
+
+        return self._sample_cluster(totalMass * f_mass, mean_number * (1 - r_min), rng,
+                                    r_min=r_min)
+
+    def generate_cluster_chunks(self, totalMass, chunk_mass, seed=None, min_mass=None):
+        """
+        Generate a cluster of stellar systems with the specified IMF,
+        in chunks of about chunk_mass solar masses each, so that very
+        massive clusters can be made without holding all of the stars
+        in memory at once.
+
+        This is a generator: each chunk is sampled like generate_cluster
+        with a total mass of chunk_mass (the last chunk has the mass
+        that remains to reach totalMass). The IMF and its maximum mass are
+        set by totalMass, as in generate_cluster. The chunks only
+        depend on totalMass, chunk_mass, and the seed.
+
+        Parameters
+        ----------
+        totalMass : float
+            The total mass of the cluster (including companions) in solar masses.
+
+        chunk_mass : float
+            The mass of each chunk, in solar masses.
+
+        seed: int, numpy.random.SeedSequence, or numpy.random.Generator
+            If set to non-None, all random sampling will be seeded with the
+            specified seed, forcing identical output. The random numbers
+            are drawn from a numpy Generator made from the seed 
+            (see spisea.utils.rng.get_rng), not the global np.random state.
+            Default None
+
+        min_mass : float or None
+            If set, only the systems with primaries more massive than 
+            min_mass are sampled (see generate_cluster).
+            Default None
+
+        Yields
+        ------
+        masses, isMultiple, companionMasses, systemMasses
+            The arrays for each chunk, as returned by generate_cluster.
+        """
+        if (self._mass_limits[-1] > totalMass):
+            log.info('sample_imf: Setting maximum allowed mass to %d' %
+                      (totalMass))
+            self._mass_limits[-1] = totalMass
+
+        # Estimate the mean number of stars expected.
+        self.normalize(totalMass)
+        mean_number = self.int_xi(self._mass_limits[0], self._mass_limits[-1])
+
+        # Only sample the part of the IMF above min_mass.
+        r_min, f_mass = self._min_mass_fractions(min_mass)
+        mean_number *= (1 - r_min)
+        totalMass = totalMass * f_mass
+
+        # Random number generator, seeded if desired
+        rng = get_rng(seed)
+
+        totalMassTally = 0
+        while totalMassTally < totalMass:
+            chunkMass = totalMass - totalMassTally
+            last_chunk = chunkMass <= chunk_mass
+            if not last_chunk:
+                chunkMass = chunk_mass
+
+            chunk = self._sample_cluster(chunkMass, mean_number * chunkMass / totalMass, rng,
+                                         r_min=r_min)
+            totalMassTally += chunk[3].sum()
+
+            yield chunk
+
+            if last_chunk:
+                break
+
+    def generate_weighted(self, totalMass, n_systems, seed=None, min_mass=None):
+        """
+        Generate n_systems representative stellar systems of a cluster 
+        of totalMass, each with a statistical weight (the number of 
+        systems of the cluster that it stands for), e.g. for galaxy-scale 
+        populations that have too many stars to be sampled one by one.
+
+        The primary masses are stratified in mass: the IMF is split into 
+        n_systems bins of equal width in log(m), and one primary is drawn 
+        from the IMF within each bin. Its weight is the number of systems 
+        in the bin, from the IMF normalized to totalMass (int_xi). So 
+        the massive stars are as well sampled as the low-mass stars. 
+        Companions are generated as in generate_cluster. The weights are
+        then scaled so that the weighted sum of the system masses is 
+        totalMass (or the mass above min_mass), which accounts for the 
+        mass of the companions.
+
+        Parameters
+        ----------
+        totalMass : float
+            The total mass of the cluster (including companions) in solar masses.
+
+        n_systems : int
+            Number of systems to generate.
+
+        seed: int, numpy.random.SeedSequence, or numpy.random.Generator
+            Seed of the random sampling (see generate_cluster).
+            Default None
+
+        min_mass : float or None
+            If set, only the primaries above min_mass are generated 
+            (see generate_cluster).
+            Default None
+
+        Returns
+        -------
+        masses, isMultiple, companionMasses, systemMasses
+            The arrays of the systems, as returned by generate_cluster.
+
+        weights : numpy float array
+            The number of systems of the cluster that each system stands for.
+        """
+        if (self._mass_limits[-1] > totalMass):
+            log.info('sample_imf: Setting maximum allowed mass to %d' %
+                      (totalMass))
+            self._mass_limits[-1] = totalMass
+
+        self.normalize(totalMass)
+        r_min, f_mass = self._min_mass_fractions(min_mass)
+
+        rng = get_rng(seed)
+
+        # Bins of equal width in log(m) (above min_mass)
+        m_lo = float(self.norm_Mmin)
+        m_hi = float(self.norm_Mmax)
+        if min_mass is not None:
+            m_lo = max(m_lo, min(float(min_mass), m_hi))
+        edges = np.geomspace(m_lo, m_hi, n_systems + 1)
+
+        # Draw one primary from the IMF in each bin with the inverse CDF.
+        n_all = self.int_xi(float(self.norm_Mmin), m_hi)
+        cdf = self.int_xi(float(self.norm_Mmin), edges) / n_all
+        r = cdf[:-1] + rng.random(n_systems) * (cdf[1:] - cdf[:-1])
+        masses = np.clip(self.dice_star_cl(r), edges[:-1], edges[1:])
+
+        # Number of systems in each bin
+        weights = self.int_xi(edges[:-1], edges[1:])
+
+        if self._multi_props != None:
+            MF = self._multi_props.multiplicity_fraction(masses)
+            CSF = self._multi_props.companion_star_fraction(masses)
+            isMultiple = rng.random(n_systems) < MF
+            
+            compMasses, systemMasses, isMultiple = self.calc_multi(masses, masses.copy(),
+                                                                   isMultiple, CSF, MF,
+                                                                   rng=rng)
+        else:
+            isMultiple = np.zeros(n_systems, dtype=bool)
+            systemMasses = masses
+            compMasses = CompanionMasses(np.zeros(n_systems, dtype=int), [])
+
+        # The weighted mass of the systems is the cluster mass.
+        weights *= totalMass * f_mass / (weights * systemMasses).sum()
+
+        return (masses, isMultiple, compMasses, systemMasses, weights)
+
+    def mass_below(self, totalMass, min_mass):
+        """
+        Expected number and mass of the systems with primaries less 
+        massive than min_mass in a cluster of totalMass, i.e. the systems
+        that generate_cluster skips with min_mass. They are computed 
+        from the integrals of the IMF (int_xi and int_system_mass),
+        normalized so that the expected system mass (including the 
+        companions) of the whole cluster is totalMass.
+
+        Parameters
+        ----------
+        totalMass : float
+            The total mass of the cluster (including companions) in solar masses.
+
+        min_mass : float or None
+            The primary mass cut, in solar masses.
+
+        Returns
+        -------
+        number : float
+            Expected number of systems below min_mass.
+
+        mass : float
+            Expected total mass of the systems below min_mass, in solar masses.
+        """
+        if (self._mass_limits[-1] > totalMass):
+            self._mass_limits[-1] = totalMass
+
+        self.normalize(totalMass)
+        if (min_mass is None) or (min_mass <= self.norm_Mmin):
+            return 0.0, 0.0
+
+        m_lo = float(self.norm_Mmin)
+        m_hi = float(self.norm_Mmax)
+        min_mass = float(min(min_mass, m_hi))
+        r_min, f_mass = self._min_mass_fractions(min_mass)
+
+        # The IMF is normalized to the primary mass, so scale it to the system mass.
+        number = self.int_xi(m_lo, min_mass) * totalMass / self.int_system_mass(m_lo, m_hi)
+
+        return number, totalMass * (1 - f_mass)
+
+    def system_mass_factor(self, mass, n_q=200):
+        """
+        Expected ratio of the system mass (the primary and its companions)
+        to the primary mass, for primaries of the given masses. This is
+        1 + CSF * <q>, where CSF is the companion star fraction and <q> the
+        mean mass ratio of the companions that are kept (those more 
+        massive than the minimum mass of the IMF, see calc_multi). If the
+        number of companions is limited to CSF_max (companion_max), the 
+        expected number of companions is reduced accordingly.
+
+        Parameters
+        ----------
+        mass : float or array
+            Primary masses, in solar masses.
+
+        n_q : int
+            Number of points of the quadrature over the mass ratio.
+
+        Returns
+        -------
+        factor : array
+            System mass / primary mass. It is 1 without multiplicity.
+        """
+        mass = np.atleast_1d(mass).astype(float)
+        
+        if (self._multi_props == None) or not hasattr(self._multi_props, 'random_q'):
+            return np.ones(len(mass))
+
+        # Mean mass ratio of the companions above the minimum mass
+        # (midpoint quadrature of the inverse CDF of q)
+        x = (np.arange(n_q) + 0.5) / n_q
+        q = self._multi_props.random_q(x)
+        keep = q[np.newaxis, :] * mass[:, np.newaxis] >= self._mass_limits[0]
+        mean_q = np.where(keep, q[np.newaxis, :], 0).mean(axis=1)
+
+        csf = self._multi_props.companion_star_fraction(mass.copy())
+        
+        if getattr(self._multi_props, 'companion_max', False):
+            # Multiples have 1 + Poisson(CSF/MF - 1) companions, at most CSF_max.
+            mf = self._multi_props.multiplicity_fraction(mass.copy())
+            lam = np.clip(csf / mf - 1, 0, None)
+            n_comp = np.ones(len(mass))
+            for jj in range(int(self._multi_props.CSF_max) - 1):
+                # P(Poisson > jj)
+                n_comp += gammainc(jj + 1, lam)
+            csf = mf * n_comp
+
+        return 1 + csf * mean_q
+
+    def int_system_mass(self, massLo, massHi, n_grid=1000):
+        """
+        Expected total system mass (primaries and their companions) of 
+        the primaries between massLo and massHi, for the normalized IMF:
+        the integral of m * xi(m) * system_mass_factor(m), over n_grid
+        logarithmic bins between each massLo and massHi. Without 
+        multiplicity, this is int_mxi.
+        """
+        if self._multi_props == None:
+            return self.int_mxi(massLo, massHi)
+
+        returnFloat = (np.ndim(massLo) == 0) and (np.ndim(massHi) == 0)
+        
+        lo, hi = np.broadcast_arrays(np.atleast_1d(massLo).astype(float),
+                                     np.atleast_1d(massHi).astype(float))
+        hi = np.maximum(hi, lo)
+
+        # Logarithmic bins between every massLo and massHi (N x n_grid)
+        t = np.linspace(0, 1, n_grid + 1)
+        edges = lo[:, np.newaxis] * (hi / lo)[:, np.newaxis]**t
+        
+        mass_bins = self.int_mxi(edges[:, :-1].ravel(), edges[:, 1:].ravel())
+        m_mid = np.sqrt(edges[:, :-1] * edges[:, 1:]).ravel()
+        val = (mass_bins * self.system_mass_factor(m_mid)).reshape(len(lo), n_grid).sum(axis=1)
+
+        if returnFloat:
+            return val[0]
+        else:
+            return val
+
+    def _min_mass_fractions(self, min_mass):
+        """
+        Helper function for sampling only the primaries above min_mass
+        (for the normalized IMF). Returns the fraction of the random numbers
+        of the inverse CDF (dice_star_cl) that are below min_mass, and the
+        fraction of the system mass (including the companions, see 
+        int_system_mass) above min_mass.
+        """
+        if (min_mass is None) or (min_mass <= self.norm_Mmin):
+            return 0.0, 1.0
+
+        m_lo = float(self.norm_Mmin)
+        m_hi = float(self.norm_Mmax)
+        min_mass = float(min(min_mass, m_hi))
+        r_min = self.int_xi(m_lo, min_mass) / self.int_xi(m_lo, m_hi)
+        f_mass = self.int_system_mass(min_mass, m_hi) / self.int_system_mass(m_lo, m_hi)
+
+        return r_min, f_mass
+
+    def _sample_cluster(self, totalMass, mean_number, rng, r_min=0.0):
+        """
+        Sample stellar systems from the (normalized) IMF until totalMass is
+        reached (see generate_cluster). mean_number is the expected number
+        of stars, which sets the size of the random batches. rng is the 
+        numpy random Generator. The random numbers of the inverse CDF 
+        (dice_star_cl) are drawn between r_min and 1, to only sample the 
+        IMF above a minimum mass (see _min_mass_fractions).
+
+        The output arrays are preallocated for the expected number of stars
+        (and only grown if the sampling runs over), and the returned
+        arrays are views of them.
+        """
+        newStarCount = max(np.round(mean_number), 1)
         if self._multi_props == None:
             newStarCount *= 1.1
+        batchCount = max(mean_number * 0.1, 1)
 
-        # Generate output arrays.
-        masses = np.array([], dtype=float)
-        isMultiple = np.array([], dtype=bool)
-        compMasses = np.array([], dtype=np.object)
-        systemMasses = np.array([], dtype=float)
+        # Generate output arrays, with room for a few extra batches.
+        nAlloc = int(newStarCount) + 3 * int(batchCount)
+        masses = np.empty(nAlloc, dtype=float)
+        if self._multi_props != None:
+            isMultiple = np.zeros(nAlloc, dtype=bool)
+            systemMasses = np.empty(nAlloc, dtype=float)
+        compMasses = []
 
         # Loop through and add stars to the cluster until we get to
         # the desired total cluster mass.
         totalMassTally = 0
         loopCnt = 0
+        nStars = 0
 
-        # Set the random seed, if desired
-        if seed:
-            np.random.seed(seed=seed)
-        
         while totalMassTally < totalMass:
+            nNew = int(newStarCount)
+            
+            # Grow the output arrays (by at least a factor 2), if needed.
+            if nStars + nNew > len(masses):
+                nAlloc = max(2 * len(masses), nStars + nNew)
+                masses = _grow_array(masses, nStars, nAlloc)
+                if self._multi_props != None:
+                    isMultiple = _grow_array(isMultiple, nStars, nAlloc)
+                    systemMasses = _grow_array(systemMasses, nStars, nAlloc)
+                
             # Generate a random number array.
-            uniX = np.random.rand(int(newStarCount))
+            uniX = rng.random(nNew)
+            if r_min > 0:
+                uniX = r_min + (1 - r_min) * uniX
 
             # Convert into the IMF from the inverted CDF
             newMasses = self.dice_star_cl(uniX)
@@ -139,77 +590,88 @@ class IMF(object):
                 
             # Dealing with multiplicity
             if self._multi_props != None:
-                newCompMasses = np.empty((len(newMasses),), dtype=np.object)
-                newCompMasses.fill([])
-                
                 # Determine the multiplicity of every star
                 MF = self._multi_props.multiplicity_fraction(newMasses)
                 CSF = self._multi_props.companion_star_fraction(newMasses)
                 
-                newIsMultiple = np.random.rand(int(newStarCount)) < MF
+                newIsMultiple = rng.random(nNew) < MF
 
                 # Copy over the primary masses. Eventually add the companions.
                 newSystemMasses = newMasses.copy()
 
                 # Function to calculate multiple systems more efficiently
-                newCompMasses, newSystemMasses, newIsMultiple = self.calc_multi(newMasses, newCompMasses,
-                                                                                newSystemMasses, newIsMultiple,
-                                                                                CSF, MF)
+                newCompMasses, newSystemMasses, newIsMultiple = self.calc_multi(newMasses, newSystemMasses,
+                                                                                newIsMultiple, CSF, MF,
+                                                                                rng=rng)
 
                 newTotalMassTally = newSystemMasses.sum()
-                isMultiple = np.append(isMultiple, newIsMultiple)
-                systemMasses = np.append(systemMasses, newSystemMasses)
-                compMasses = np.append(compMasses, newCompMasses)
+                isMultiple[nStars:nStars+nNew] = newIsMultiple
+                systemMasses[nStars:nStars+nNew] = newSystemMasses
+                compMasses.append(newCompMasses)
             else:
                 newTotalMassTally = newMasses.sum()
 
-            # Append to our primary masses array
-            masses = np.append(masses, newMasses)
+            # Add to our primary masses array
+            masses[nStars:nStars+nNew] = newMasses
+            nStars += nNew
             
             if (loopCnt >= 0):
                 log.info('sample_imf: Loop %d added %.2e Msun to previous total of %.2e Msun' %
                          (loopCnt, newTotalMassTally, totalMassTally))
 
             totalMassTally += newTotalMassTally
-            newStarCount = mean_number * 0.1  # increase by 20% each pass
+            newStarCount = batchCount
             loopCnt += 1
         
         # Make a running sum of the system masses
         if self._multi_props:
-            massCumSum = systemMasses.cumsum()
+            massCumSum = systemMasses[:nStars].cumsum()
         else:
-            massCumSum = masses.cumsum()
+            massCumSum = masses[:nStars].cumsum()
 
         # Find the index where we are closest to the desired
-        # total mass.
-        idx = np.abs(massCumSum - totalMass).argmin()
+        # total mass: the star that crosses it, or the one before.
+        idx = np.searchsorted(massCumSum, totalMass)
+        if idx >= nStars:
+            idx = nStars - 1
+        elif (idx > 0) and ((totalMass - massCumSum[idx-1]) <= (massCumSum[idx] - totalMass)):
+            idx -= 1
 
         masses = masses[:idx+1]
 
         if self._multi_props:
             systemMasses = systemMasses[:idx+1]
             isMultiple = isMultiple[:idx+1]
-            compMasses = compMasses[:idx+1]
+            compMasses = CompanionMasses.concatenate(compMasses)[:idx+1]
         else:
             isMultiple = np.zeros(len(masses), dtype=bool)
             systemMasses = masses
+            compMasses = CompanionMasses(np.zeros(len(masses), dtype=int), [])
 
         return (masses, isMultiple, compMasses, systemMasses)
         
-    def calc_multi(self, newMasses, compMasses, newSystemMasses, newIsMultiple, CSF, MF):
+    def calc_multi(self, newMasses, newSystemMasses, newIsMultiple, CSF, MF, rng=None):
         """
         Helper function to calculate multiples more efficiently.
-        We will use array operations as much as possible
+        We will use array operations as much as possible.
+        The companion masses are returned as a CompanionMasses object.
+        rng is the numpy random Generator (or seed) to use.
         """
+        rng = get_rng(rng)
+        
         # Identify multiple systems, calculate number of companions for
         # each 
         idx = np.where(newIsMultiple == True)[0]
-        n_comp_arr = 1 + np.random.poisson((CSF[idx] / MF[idx]) - 1)
+        n_comp_arr = 1 + rng.poisson((CSF[idx] / MF[idx]) - 1)
         if self._multi_props.companion_max == True:
             too_many = np.where(n_comp_arr > self._multi_props.CSF_max)[0]
             n_comp_arr[too_many] = self._multi_props.CSF_max
         primary = newMasses[idx]
 
+        # System index and mass of every companion
+        comp_sys = [np.array([], dtype=int)]
+        comp_mass = [np.array([], dtype=float)]
+
         # We will deal with each number of multiple system independently. This is
         # so we can put in uniform arrays in _multi_props.random_q.
         num = np.unique(n_comp_arr)
@@ -218,37 +680,33 @@ class IMF(object):
             
             if ii == 1:
                 # Single companion case
-                q_values = self._multi_props.random_q(np.random.rand(len(tmp)))
-                
-                # Calculate mass of companion
-                m_comp = q_values * primary[tmp]
-
-                # Only keep companions that are more than the minimum mass. Update
-                # compMasses, newSystemMasses, and newIsMultiple appropriately 
-                good = np.where(m_comp >= self._mass_limits[0])[0]
-                for jj in good:
-                    compMasses[idx[tmp[jj]]] = np.transpose([m_comp[jj]])
-                    newSystemMasses[idx[tmp[jj]]] += compMasses[idx[tmp[jj]]]
-
-                bad = np.where(m_comp < self._mass_limits[0])[0]
-                newIsMultiple[idx[tmp[bad]]] = False                
+                q_values = self._multi_props.random_q(rng.random(len(tmp)))
             else:
                 # Multple companion case
-                q_values = self._multi_props.random_q(np.random.rand(len(tmp), ii))
+                q_values = self._multi_props.random_q(rng.random((len(tmp), ii)))
+
+            # Calculate masses of companions
+            m_comp = np.multiply(q_values.reshape(len(tmp), ii), np.transpose([primary[tmp]]))
+            
+            # Only keep companions that are more than the minimum mass.
+            m_comp = m_comp.ravel()
+            good = m_comp >= self._mass_limits[0]
 
-                # Calculate masses of companions
-                m_comp = np.multiply(q_values, np.transpose([primary[tmp]]))
+            comp_sys.append(np.repeat(idx[tmp], ii)[good])
+            comp_mass.append(m_comp[good])
 
-                # Update compMasses, newSystemMasses, and newIsMultiple appropriately
-                for jj in range(len(tmp)):
-                    m_comp_tmp = m_comp[jj]
-                    compMasses[idx[tmp[jj]]] = m_comp_tmp[m_comp_tmp >= self._mass_limits[0]]
-                    newSystemMasses[idx[tmp[jj]]] += compMasses[idx[tmp[jj]]].sum()
+        comp_sys = np.concatenate(comp_sys)
+        comp_mass = np.concatenate(comp_mass)
 
-                    # Double check for the case when we drop all companions.
-                    # This happens a lot near the minimum allowed mass.
-                    if len(compMasses[idx[tmp[jj]]]) == 0:
-                        newIsMultiple[idx[tmp[jj]]] = False
+        # Order the companions by system (stable, to keep their order within the system).
+        sdx = np.argsort(comp_sys, kind='stable')
+        N_companions = np.bincount(comp_sys, minlength=len(newMasses))
+        compMasses = CompanionMasses(N_companions, comp_mass[sdx])
+
+        # Update newSystemMasses and newIsMultiple. Systems where we drop all
+        # companions are not multiple. This happens a lot near the minimum allowed mass.
+        newSystemMasses += compMasses.system_mass()
+        newIsMultiple = newIsMultiple & (N_companions > 0)
 
         return compMasses, newSystemMasses, newIsMultiple
         
@@ -312,6 +770,9 @@ class IMF_broken_powerlaw(IMF):
         self.coeffs = coeffs
         self.k = 1
 
+        # Cache for the primitives of the segments (see _segment_primitives)
+        self._prim_cache = {}
+
     def xi(self, m):
         """
         Probability density describing the IMF.
@@ -425,61 +886,74 @@ class IMF_broken_powerlaw(IMF):
         """
         return self.prim_mxi(massHi) - self.prim_mxi(massLo)
 
-    def prim_xi(self, a):
+    def _segment_primitives(self, power_offset):
         """
-        Helper function
+        Helper function: the primitives of k * m**(power + power_offset)
+        of every power-law segment at its lower limit, and their integral over
+        the whole segment. These are cached, and recomputed when k or the 
+        mass limits change.
+        """
+        cache_key = (power_offset, float(self.k), self._m_limits_low.tobytes(),
+                     self._m_limits_high.tobytes())
+
+        if cache_key not in self._prim_cache:
+            powers = self._powers + power_offset
+            
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                prim_low = self.k * self.coeffs * prim_power(self._m_limits_low, powers)
+                prim_high = self.k * self.coeffs * prim_power(self._m_limits_high, powers)
+                
+            # Only keep the cache for the current k and limits.
+            self._prim_cache = {key: val for key, val in self._prim_cache.items()
+                                if key[1:] == cache_key[1:]}
+            self._prim_cache[cache_key] = (prim_low, prim_high - prim_low)
+
+        return self._prim_cache[cache_key]
+
+    def _prim(self, a, power_offset):
         """
-        returnFloat = type(a) == float
+        Helper function: primitive of k * m**(power + power_offset) 
+        over the segments, evaluated for all masses and all segments 
+        at once (an N_masses x N_segments array operation).
+        """
+        returnFloat = np.ndim(a) == 0
+
+        a = np.atleast_1d(a).astype(float)
+        prim_low, prim_seg = self._segment_primitives(power_offset)
 
-        a = np.atleast_1d(a)
-        val = np.zeros(len(a), dtype=float)
+        powers = self._powers + power_offset
+        z = 1.0 + powers
+        aa = a[:, np.newaxis]
 
-        for i in range(len(val)):
-            t1 = theta_open(a[i] - self._m_limits_high) * self.coeffs
-            t2 = prim_power(self._m_limits_high, self._powers)
-            t3 = prim_power(self._m_limits_low, self._powers)
-            y1 = (t1 * (t2 - t3)).sum()
+        # Segments entirely below each mass
+        full = aa > self._m_limits_high
+        y1 = np.where(full, prim_seg, 0).sum(axis=1)
 
-            t1 = gamma_closed(a[i], self._m_limits_low, self._m_limits_high) 
-            t1 *= self.coeffs
-            t2 = prim_power(a[i], self._powers)
-            t3 = prim_power(self._m_limits_low, self._powers)
-            y2 = (t1 * (t2 - t3)).sum()
+        # The segment (or boundary segments) containing each mass
+        part = (aa >= self._m_limits_low) & (aa <= self._m_limits_high)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            prim_a = np.where(powers == -1, np.log(aa), aa**z / z)
+            y2 = self.k * self.coeffs * prim_a - prim_low
+        y2 = np.where(part, y2, 0).sum(axis=1)
 
-            val[i] = self.k * (y1 + y2)
+        val = y1 + y2
 
         if returnFloat:
             return val[0]
         else:
             return val
 
-    def prim_mxi(self, a):
+    def prim_xi(self, a):
         """
         Helper function
         """
-        returnFloat = type(a) == float
-        
-        a = np.atleast_1d(a)
-        val = np.zeros(len(a), dtype=float)
-
-        for i in range(len(val)):
-            t1 = theta_open(a[i] - self._m_limits_high) * self.coeffs
-            t2 = prim_power(self._m_limits_high, self._powers+1)
-            t3 = prim_power(self._m_limits_low, self._powers+1)
-            y1 = (t1 * (t2 - t3)).sum()
-            
-            t1 = gamma_closed(a[i], self._m_limits_low, self._m_limits_high) 
-            t1 *= self.coeffs
-            t2 = prim_power(a[i], self._powers+1)
-            t3 = prim_power(self._m_limits_low, self._powers+1)
-            y2 = (t1 * (t2 - t3)).sum()
-
-            val[i] = self.k * (y1 + y2)
+        return self._prim(a, 0)
 
-        if returnFloat:
-            return val[0]
-        else:
-            return val
+    def prim_mxi(self, a):
+        """
+        Helper function
+        """
+        return self._prim(a, 1)
 
     def normalize(self, Mcl, Mmin=None, Mmax=None):
         """
@@ -508,7 +982,7 @@ class IMF_broken_powerlaw(IMF):
         self.norm_Mmin = Mmin
         self.norm_Mmax = Mmax
         
-        self.k = Mcl / self.int_mxi(self.norm_Mmin, self.norm_Mmax)
+        self.k = float(Mcl / self.int_mxi(self.norm_Mmin, self.norm_Mmax))
         self.lamda = self.int_xi_cl(self._m_limits_low[0], self._mass_limits)
 
     def norm_cl_wk04(self, Mcl, Mmax=None, Mmin=None):
@@ -533,22 +1007,31 @@ class IMF_broken_powerlaw(IMF):
         if Mmin < self._m_limits_low[0]:
             Mmin = self._m_limits_low[0]
 
+        # Find the mass b where int_mxi(Mmin, b) / int_xi(b, Mmax) = Mcl.
+        # This ratio increases with b, so we bracket it on a grid of b values
+        # (all evaluated at once), and refine the bracket until it is small enough.
         a = Mmin
         c = Mmax
         b = (c + a) / 2.0
         while (((c/b)-(a/b)) > 0.00001):
-            mb = self.int_mxi(Mmin, b) / self.int_xi(b, Mmax)
-            if mb < Mcl:
-                a = b
+            b_grid = np.linspace(a, c, 101)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mb = self.int_mxi(Mmin, b_grid) / self.int_xi(b_grid, Mmax)
+
+            above = np.where(mb >= Mcl)[0]
+            if len(above) > 0:
+                jj = max(above[0], 1)
             else:
-                c = b
+                jj = len(b_grid) - 1
+            a = b_grid[jj-1]
+            c = b_grid[jj]
             b = (c + a) / 2.0
 
         Mmax = b
         self.norm_Mmin = Mmin
         self.norm_Mmax = Mmax
 
-        self.k = Mcl / self.int_mxi(Mmin, Mmax)
+        self.k = float(Mcl / self.int_mxi(Mmin, Mmax))
         self.lamda = self.int_xi_cl(self._m_limits_low[0], self._mass_limits)
 
     def xi_cl(self, m):
@@ -690,6 +1173,293 @@ class Weidner_Kroupa_2004(IMF_broken_powerlaw):
         IMF_broken_powerlaw.__init__(self, massLimits, powers,
                                      multiplicity=multiplicity)
 
+class IMF_tabulated(IMF):
+    """
+    IMF with any probability density xi(m), sampled from a tabulated
+    cumulative distribution (inverse-CDF sampling). 
+
+    The IMF (and mass-weighted IMF) are integrated once on a grid of
+    n_grid masses, evenly spaced in log(m), and the masses are drawn by
+    interpolating the inverse of the integral. The cost of sampling does not
+    depend on the shape of xi(m). The accuracy is set by n_grid; the 
+    integrals are exact at the grid points for a power-law xi(m) with 
+    breaks at the mass limits.
+
+    Parameters
+    ----------
+    xi_func : function or None
+        Function that returns the (unnormalized) dn/dm at an array
+        of masses. If None, the masses and xi_values are used instead.
+
+    mass_limits : numpy array
+        Minimum and maximum stellar mass of the IMF, in solar masses
+        (must be finite). Any additional elements in between are mass 
+        breaks (e.g. of a broken power-law), which are added to the grid.
+
+    masses : numpy array; optional
+        Masses of a tabulated dn/dm, if xi_func is None. 
+        The IMF is interpolated linearly in log(m) between them.
+
+    xi_values : numpy array; optional
+        dn/dm at the tabulated masses, if xi_func is None. A zero at 
+        the first or last mass is replaced by the power law through the 
+        next two values.
+
+    n_grid : int; optional
+        Number of mass grid points used to tabulate the IMF.
+
+    multiplicity : Multiplicity object or None
+        If None, no multiplicity is assumed. Otherwise, use 
+        multiplicity object to create multiple star systems.
+    """
+    def __init__(self, xi_func=None, mass_limits=None, masses=None, xi_values=None,
+                 n_grid=10000, multiplicity=None):
+        if xi_func is None:
+            if (masses is None) or (xi_values is None):
+                raise ValueError('IMF_tabulated: either xi_func or masses and xi_values are needed')
+
+            log_m_tab = np.log(np.asarray(masses, dtype=float))
+            xi_tab = np.array(xi_values, dtype=float)
+
+            # A zero at the ends of the table (e.g. a dn/dm sampled on its
+            # cutoff) is the power law of the next two values instead.
+            if (len(xi_tab) > 2) and (xi_tab[0] == 0) and np.all(xi_tab[1:3] > 0):
+                slope = np.log(xi_tab[2] / xi_tab[1]) / (log_m_tab[2] - log_m_tab[1])
+                xi_tab[0] = xi_tab[1] * np.exp(slope * (log_m_tab[0] - log_m_tab[1]))
+            if (len(xi_tab) > 2) and (xi_tab[-1] == 0) and np.all(xi_tab[-3:-1] > 0):
+                slope = np.log(xi_tab[-2] / xi_tab[-3]) / (log_m_tab[-2] - log_m_tab[-3])
+                xi_tab[-1] = xi_tab[-2] * np.exp(slope * (log_m_tab[-1] - log_m_tab[-2]))
+            xi_func = lambda m: np.interp(np.log(m), log_m_tab, xi_tab, left=0, right=0)
+
+            if mass_limits is None:
+                mass_limits = np.array([masses[0], masses[-1]])
+
+        mass_limits = np.array(mass_limits, dtype=float)
+        if not np.all(np.isfinite(mass_limits)):
+            raise ValueError('IMF_tabulated: mass_limits must be finite')
+
+        IMF.__init__(self, massLimits=mass_limits, multiplicity=multiplicity)
+
+        self._xi_func = xi_func
+        self.k = 1.0
+
+        # Mass grid, including the mass breaks (and without the grid 
+        # points that round to them).
+        m_grid = np.logspace(np.log10(mass_limits[0]), np.log10(mass_limits[-1]), n_grid)
+        near = np.any(np.abs(np.log(m_grid[:, np.newaxis] / mass_limits)) < 1e-9, axis=1)
+        m_grid = np.unique(np.concatenate([m_grid[~near], mass_limits]))
+
+        # xi is evaluated just inside the mass limits, where it can be 
+        # cut off (e.g. IMF_broken_powerlaw.xi is halved at its limits).
+        m_eval = m_grid.copy()
+        m_eval[0] *= 1 + 1e-10
+        m_eval[-1] *= 1 - 1e-10
+        xi_grid = np.asarray(xi_func(m_eval), dtype=float)
+
+        if np.any(xi_grid < 0) or not np.all(np.isfinite(xi_grid)):
+            raise ValueError('IMF_tabulated: xi(m) must be finite and positive')
+
+        # Integrate xi and m*xi on the grid. Between the grid points,
+        # xi is a power law (linear in log-log), or linear where it is zero.
+        self._log_m_grid = np.log(m_grid)
+        self._prim_xi_grid = self._integrate_grid(m_grid, xi_grid, 0)
+        self._prim_mxi_grid = self._integrate_grid(m_grid, xi_grid, 1)
+
+        return
+
+    def _integrate_grid(self, m, xi, power_offset):
+        """
+        Helper function: cumulative integral of m**power_offset * xi(m) 
+        on the mass grid, assuming a power law between the grid points.
+        If xi is zero at the first (or last) grid point, e.g. a tabulated
+        dn/dm that ends on the mass limit, the first (or last) bin is 
+        integrated as the power law of its neighbor.
+        """
+        f = xi * m**power_offset
+        f_lo = f[:-1]
+        f_hi = f[1:]
+        dlogm = np.diff(np.log(m))
+
+        # Trapezoid rule in log(m) where either end is zero.
+        integ = 0.5 * (f_lo * m[:-1] + f_hi * m[1:]) * dlogm
+
+        # Exact integral for a power law elsewhere, with the slope
+        # z - 1 of f (in log-log) in each bin.
+        good = (f_lo > 0) & (f_hi > 0) & (dlogm > 0)
+        z = np.zeros(len(dlogm), dtype=float)
+        z[good] = np.log(f_hi[good] / f_lo[good]) / dlogm[good] + 1.0
+        integ[good] = self._power_law_integral(f_lo[good] * m[:-1][good], z[good], dlogm[good])
+
+        # Power law of the neighbor bin at the edges of the grid
+        if len(dlogm) > 1:
+            if (f[0] == 0) and (f[1] > 0) and good[1]:
+                fm_lo = f[1] * m[1] * np.exp(-z[1] * dlogm[0])
+                integ[0] = self._power_law_integral(fm_lo, z[1], dlogm[0])
+            if (f[-1] == 0) and (f[-2] > 0) and good[-2]:
+                integ[-1] = self._power_law_integral(f[-2] * m[-2], z[-2], dlogm[-1])
+
+        prim = np.zeros(len(m), dtype=float)
+        prim[1:] = np.cumsum(integ)
+
+        return prim
+
+    @staticmethod
+    def _power_law_integral(fm_lo, z, dlogm):
+        """
+        Helper function: integral of a power law f(m) ~ m**(z-1) over a 
+        bin of width dlogm in log(m), where f*m = fm_lo at its lower end.
+        """
+        returnFloat = (np.ndim(fm_lo) == 0) and (np.ndim(z) == 0) and (np.ndim(dlogm) == 0)
+        fm_lo, z, dlogm = np.broadcast_arrays(np.atleast_1d(fm_lo), np.atleast_1d(z),
+                                              np.atleast_1d(dlogm))
+
+        # The flat case (z ~ 0) is the limit fm_lo * dlogm.
+        integ = fm_lo * dlogm
+        curved = np.abs(z * dlogm) >= 1e-8
+        integ[curved] = fm_lo[curved] * np.expm1(z[curved] * dlogm[curved]) / z[curved]
+
+        if returnFloat:
+            return integ[0]
+        return integ
+
+    def xi(self, m):
+        """
+        Probability density describing the IMF.
+
+        Input:
+        m - mass of a star
+
+        Output:
+        xi - probability of measuring that mass.
+        """
+        returnFloat = type(m) == float
+        m = np.atleast_1d(m).astype(float)
+
+        inside = (m >= self._mass_limits[0]) & (m <= self._mass_limits[-1])
+        xi = np.zeros(len(m), dtype=float)
+        xi[inside] = self.k * self._xi_func(m[inside])
+
+        if returnFloat:
+            return xi[0]
+        else:
+            return xi
+
+    def m_xi(self, m):
+        """
+        Mass-weighted probability m*xi
+        """
+        return m * self.xi(m)
+
+    def prim_xi(self, a):
+        """
+        Helper function: integral of xi from the minimum mass to a.
+        """
+        return self.k * np.interp(np.log(a), self._log_m_grid, self._prim_xi_grid)
+
+    def prim_mxi(self, a):
+        """
+        Helper function: integral of m*xi from the minimum mass to a.
+        """
+        return self.k * np.interp(np.log(a), self._log_m_grid, self._prim_mxi_grid)
+
+    def getProbabilityBetween(self, massLo, massHi):
+        """Return the integrated probability between some low and high 
+        mass value.
+        """
+        return self.int_xi(massLo, massHi)
+
+    def int_xi(self, massLo, massHi):
+        """Return the integrated probability between some low and high 
+        mass value.
+        """
+        return self.prim_xi(massHi) - self.prim_xi(massLo)
+    
+    def getMassBetween(self, massLo, massHi):
+        """Return the integrated mass between some low and high 
+        mass value.
+        """
+        return self.int_mxi(massLo, massHi)
+    
+    def int_mxi(self, massLo, massHi):
+        """Return the integrated total mass between some low and high stellar
+        mass value. Be sure to normalize the IMF instance beforehand.
+        """
+        return self.prim_mxi(massHi) - self.prim_mxi(massLo)
+
+    def normalize(self, Mcl, Mmin=None, Mmax=None):
+        """
+        Normalize the IMF to a total cluster mass within a specified
+        minimum and maximum stellar mass range.
+        """
+        self.k = 1.0
+        self.Mcl = Mcl
+        
+        if Mmax == None:
+            Mmax = self._mass_limits[-1]
+
+        if Mmin == None:
+            Mmin = self._mass_limits[0]
+
+        if Mmax > Mcl:
+            Mmax = Mcl
+            
+        if Mmax > self._mass_limits[-1]:
+            Mmax = self._mass_limits[-1]
+
+        if Mmin < self._mass_limits[0]:
+            Mmin = self._mass_limits[0]
+
+        self.norm_Mmin = Mmin
+        self.norm_Mmax = Mmax
+        
+        self.k = float(Mcl / self.int_mxi(self.norm_Mmin, self.norm_Mmax))
+
+    def dice_star_cl(self, r):
+        """
+        Given a list of random numbers (r), return a list of masses
+        selected from the IMF (between norm_Mmin and norm_Mmax).
+        """
+        returnFloat = type(r) == float
+        r = np.atleast_1d(r)
+
+        p_lo = np.interp(np.log(self.norm_Mmin), self._log_m_grid, self._prim_xi_grid)
+        p_hi = np.interp(np.log(self.norm_Mmax), self._log_m_grid, self._prim_xi_grid)
+
+        # Invert the integral of xi (interpolating in log(m))
+        x = p_lo + r * (p_hi - p_lo)
+        m = np.exp(np.interp(x, self._prim_xi_grid, self._log_m_grid))
+
+        if returnFloat:
+            return m[0]
+        else:
+            return m
+
+class Chabrier_2003(IMF_tabulated):
+    """
+    Define the single-star IMF from `Chabrier (2003) <https://ui.adsabs.harvard.edu/abs/2003PASP..115..763C/abstract>`_:
+    a log-normal below 1 M_sun (mean log(m) = log(0.079), sigma = 0.69)
+    and a power law (dn/dm ~ m^-2.3) above.
+    Mass range is 0.01 M_sun - 150 M_sun.
+    """
+    def __init__(self, multiplicity=None, n_grid=10000):
+        mean_logm = np.log10(0.079)
+        sigma_logm = 0.69
+        
+        # dn/dm of the log-normal, and the amplitude that makes the power law continuous
+        ln_amp = 0.158 / np.log(10)
+        pow_amp = ln_amp * log_normal(np.array([1.0]), mean_logm, sigma_logm)[0]
+
+        def xi_func(m):
+            xi = pow_amp * m**-2.3
+            low = m <= 1
+            xi[low] = ln_amp * log_normal(m[low], mean_logm, sigma_logm)
+            return xi
+
+        massLimits = np.array([0.01, 1, 150])
+
+        IMF_tabulated.__init__(self, xi_func, massLimits, n_grid=n_grid,
+                               multiplicity=multiplicity)
+        
 ##################################################
 # 
 # Generic functions -- see if we can move these up.
@@ -759,8 +1529,8 @@ def log_normal(m, mean_logm, sigma_logm):
         (type(sigma_logm) == float)
 
     m = np.atleast_1d(m)
-    mean_logm = np.atleat_1d(mean_logm)
-    sigma_logm = np.atleat_1d(sigma_logm)
+    mean_logm = np.atleast_1d(mean_logm)
+    sigma_logm = np.atleast_1d(sigma_logm)
 
     z = np.log10(m) - mean_logm
     val = np.exp(-z**2 / (2.0 * sigma_logm**2)) / m
@@ -775,8 +1545,8 @@ def prim_log_normal(m, mean_logm, sigma_logm):
         (type(sigma_logm) == float)
 
     m = np.atleast_1d(m)
-    mean_logm = np.atleat_1d(mean_logm)
-    sigma_logm = np.atleat_1d(sigma_logm)
+    mean_logm = np.atleast_1d(mean_logm)
+    sigma_logm = np.atleast_1d(sigma_logm)
 
     mu = (np.log10(m) - mean_logm) / (1.4142135623731 * sigma_logm)
     val = 2.88586244942136 * sigma_logm * error(mu)
@@ -791,8 +1561,8 @@ def inv_prim_log_normal(x, mean_logm, sigma_logm):
         (type(sigma_logm) == float)
 
     m = np.atleast_1d(m)
-    mean_logm = np.atleat_1d(mean_logm)
-    sigma_logm = np.atleat_1d(sigma_logm)
+    mean_logm = np.atleast_1d(mean_logm)
+    sigma_logm = np.atleast_1d(sigma_logm)
     
     mu = inv_error(0.346516861952484 * x / sigma_logm)
     val = 10.0**(1.4142135623731 * sigma_logm * mu + mean_logm)
@@ -807,8 +1577,8 @@ def mlog_normal(x, mean_logm, sigma_logm):
         (type(sigma_logm) == float)
 
     m = np.atleast_1d(m)
-    mean_logm = np.atleat_1d(mean_logm)
-    sigma_logm = np.atleat_1d(sigma_logm)
+    mean_logm = np.atleast_1d(mean_logm)
+    sigma_logm = np.atleast_1d(sigma_logm)
 
     z = np.log10(m) - mean_logm
     val = np.exp(-z**2 / (2.0 * sigma_logm**2))
@@ -823,8 +1593,8 @@ def prim_mlog_normal(x, mean_logm, sigma_logm):
         (type(sigma_logm) == float)
 
     m = np.atleast_1d(m)
-    mean_logm = np.atleat_1d(mean_logm)
-    sigma_logm = np.atleat_1d(sigma_logm)
+    mean_logm = np.atleast_1d(mean_logm)
+    sigma_logm = np.atleast_1d(sigma_logm)
 
     eta = np.log10(m) - mean_logm - (sigma_logm**2 * 2.30258509299405)
     eta /= 1.4142135623731 * sigma_logm
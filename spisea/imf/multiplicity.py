@@ -1,6 +1,6 @@
 import numpy as np
 import astropy.modeling
-from random import choice
+from spisea.utils.rng import get_rng
 
 defaultMF_amp = 0.44
 defaultMF_power = 0.51
@@ -194,11 +194,12 @@ class MultiplicityUnresolved(object):
         """
         return x < MF
 
-    def random_companion_count(self, x, CSF, MF):
+    def random_companion_count(self, x, CSF, MF, rng=None):
         """
         Helper function: calculate number of companions.
+        rng is the numpy random Generator (or seed) to use.
         """
-        n_comp = 1 + np.random.poisson((CSF / MF) - 1)
+        n_comp = 1 + get_rng(rng).poisson((CSF / MF) - 1)
         
         if self.companion_max == True:
             if n_comp > self.CSF_max:
@@ -241,34 +242,46 @@ class MultiplicityResolvedDK(MultiplicityUnresolved):
         self.a_std_slope = a_std_slope
         self.a_std_intercept = a_std_intercept
     
-    def log_semimajoraxis(self, mass):
+    def log_semimajoraxis(self, mass, rng=None):
         """
         Generate the semimajor axis for a given mass. The mean and standard deviation of a given mass are determined 
         by fitting the data from fitting the semimajor axis data as a function of mass in table 1 of Duchene and Kraus 2013.
-        Then a random semimajor axis is drawn from a log normal distribution with that mean and standard deviation.
+        Then a random semimajor axis is drawn from a log normal distribution with that mean and standard deviation,
+        truncated to -2 < log_semimajoraxis < log(2000 AU).
         
         Parameters
         ----------
-        mass : float
-            Mass of primary star
+        mass : float or array_like
+            Mass of primary star(s)
+
+        rng : numpy.random.Generator, int, or None
+            Random number generator (or seed) to use.
 
         Returns
         -------
-        log_semimajoraxis : float
+        log_semimajoraxis : float or array_like
             Log of the semimajor axis/separation between the stars in units of AU
         """
+        rng = get_rng(rng)
+        scalar = np.ndim(mass) == 0
+        mass = np.atleast_1d(np.asarray(mass, dtype=float))
+        
         a_mean_func = astropy.modeling.powerlaws.BrokenPowerLaw1D(amplitude=self.a_amp, x_break=self.a_break, alpha_1=self.a_slope1, alpha_2=self.a_slope2)
         log_a_mean = np.log10(a_mean_func(mass)) #mean log(a)
         log_a_std_func = astropy.modeling.models.Linear1D(slope=self.a_std_slope, intercept=self.a_std_intercept)
-        log_a_std = log_a_std_func(np.log10(mass)) #sigma_log(a)
-        if mass >= 2.9:
-            log_a_std = log_a_std_func(np.log10(2.9)) #sigma_log(a)
-        if log_a_std < 0.1:
-            log_a_std = 0.1
-            
-        log_semimajoraxis = np.random.normal(log_a_mean, log_a_std)
-        while 10**log_semimajoraxis > 2000 or log_semimajoraxis < -2: #AU
-            log_semimajoraxis = np.random.normal(log_a_mean, log_a_std)
+        log_a_std = log_a_std_func(np.log10(np.minimum(mass, 2.9))) #sigma_log(a)
+        log_a_std = np.maximum(log_a_std, 0.1)
+
+        log_semimajoraxis = rng.normal(log_a_mean, log_a_std)
+
+        # Redraw the ones outside of the allowed range (rejection sampling)
+        bad = np.where((log_semimajoraxis > np.log10(2000)) | (log_semimajoraxis < -2))[0]
+        while len(bad) > 0:
+            log_semimajoraxis[bad] = rng.normal(log_a_mean[bad], log_a_std[bad])
+            bad = bad[(log_semimajoraxis[bad] > np.log10(2000)) | (log_semimajoraxis[bad] < -2)]
+
+        if scalar:
+            log_semimajoraxis = log_semimajoraxis[0]
             
         return log_semimajoraxis
     
@@ -290,7 +303,7 @@ class MultiplicityResolvedDK(MultiplicityUnresolved):
         
         return e
     
-    def random_keplarian_parameters(self, x, y, z):
+    def random_keplarian_parameters(self, x, y, z, rng=None):
         """
         Generate random incliniation and angles of binary system
         
@@ -305,6 +318,9 @@ class MultiplicityResolvedDK(MultiplicityUnresolved):
         z : float or array_like
             Random number between 0 and 1.
 
+        rng : numpy.random.Generator, int, or None
+            Random number generator (or seed) for the sign of cos(inclination).
+
         Returns
         -------
         inclination : float or array_like
@@ -316,7 +332,7 @@ class MultiplicityResolvedDK(MultiplicityUnresolved):
         omega : float or array_like
             Final angle of the system
         """
-        sign = np.array([choice([-1,1]) for i in range(len(x))])
+        sign = get_rng(rng).choice([-1, 1], size=np.shape(x))
         x = sign*x
         inclination = np.arccos(x)*180/np.pi #inclination angle in degrees
         
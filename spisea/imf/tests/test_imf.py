@@ -1,5 +1,6 @@
 import numpy as np
 import nose.tools
+import warnings
 import time
 import pdb
 
@@ -32,6 +33,363 @@ def test_generate_cluster():
 
     return
 
+def test_generate_cluster_single():
+    from .. import imf
+    
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+
+    M_cl = 10**5.
+    mass, isMulti, compMass, sysMass = my_imf.generate_cluster(M_cl, seed=3)
+
+    assert len(isMulti) == len(mass)
+    assert len(compMass) == len(mass)
+    assert isMulti.sum() == 0
+    np.testing.assert_array_equal(sysMass, mass)
+
+    # The last star brings us closest to the requested mass
+    assert np.abs(M_cl - mass.sum()) <= mass[-1] / 2.0 + 120.0
+    assert np.abs(M_cl - mass.sum()) <= np.abs(M_cl - mass[:-1].sum())
+
+    # Same seed, same cluster
+    mass2 = my_imf.generate_cluster(M_cl, seed=3)[0]
+    np.testing.assert_array_equal(mass, mass2)
+
+    return
+
+def test_generate_cluster_numpy_limits():
+    from .. import imf
+    
+    # Mass limits and cluster masses given as numpy scalars
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+
+    M_cl = np.float64(10**4.)
+    my_imf.normalize(M_cl, Mmin=np.float64(0.1), Mmax=np.float64(50))
+    assert type(my_imf.k) == float
+    assert np.ndim(my_imf.int_xi(my_imf.norm_Mmin, my_imf.norm_Mmax)) == 0
+    assert np.ndim(my_imf.int_mxi(np.float64(1), np.float64(2))) == 0
+    np.testing.assert_allclose(my_imf.int_mxi(my_imf.norm_Mmin, my_imf.norm_Mmax), M_cl)
+
+    mass, isMulti, compMass, sysMass = my_imf.generate_cluster(M_cl, seed=1)
+    assert np.abs(M_cl - sysMass.sum()) <= 120.0
+
+    return
+
+def test_generate_cluster_rng():
+    from .. import imf
+    from .. import multiplicity
+    from spisea.utils.rng import get_rng, spawn_rngs
+    from concurrent.futures import ThreadPoolExecutor
+
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+
+    def make_cluster(seed):
+        imf_multi = multiplicity.MultiplicityUnresolved()
+        my_imf = imf.IMF_broken_powerlaw(massLimits.copy(), powers, imf_multi)
+        return my_imf.generate_cluster(10**4, seed=seed)
+
+    # Seeds, SeedSequences and Generators give identical clusters
+    mass1, isMulti1, compMass1, sysMass1 = make_cluster(42)
+    mass2, isMulti2, compMass2, sysMass2 = make_cluster(get_rng(42))
+    np.testing.assert_array_equal(mass1, mass2)
+    np.testing.assert_array_equal(sysMass1, sysMass2)
+    np.testing.assert_array_equal(compMass1.masses, compMass2.masses)
+
+    # The global random state is not used
+    np.random.seed(1)
+    state = np.random.get_state()[1].copy()
+    make_cluster(42)
+    np.testing.assert_array_equal(np.random.get_state()[1], state)
+
+    # Clusters made in parallel threads are the same as one at a time
+    seeds = [np.random.SeedSequence(7).spawn(4)[ii] for ii in range(4)]
+    serial = [make_cluster(seed) for seed in seeds]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        parallel = list(pool.map(make_cluster, seeds))
+    for clust_s, clust_p in zip(serial, parallel):
+        np.testing.assert_array_equal(clust_s[0], clust_p[0])
+        np.testing.assert_array_equal(clust_s[3], clust_p[3])
+
+    # Spawned generators are independent but reproducible
+    rngs1 = spawn_rngs(7, 2)
+    rngs2 = spawn_rngs(7, 2)
+    assert rngs1[0].random() == rngs2[0].random()
+    assert rngs1[1].random() != rngs1[0].random()
+
+    return
+
+def test_generate_cluster_chunks():
+    from .. import imf
+    from .. import multiplicity
+    
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, imf_multi)
+
+    M_cl = 10**5.
+    chunk_mass = 10**4.
+
+    chunks = list(my_imf.generate_cluster_chunks(M_cl, chunk_mass, seed=10))
+    sysMass = np.concatenate([chunk[3] for chunk in chunks])
+
+    # The chunks add up to the requested mass
+    assert len(chunks) >= 10
+    assert np.abs(M_cl - sysMass.sum()) < 120.0
+    for chunk in chunks[:-1]:
+        assert np.abs(chunk_mass - chunk[3].sum()) < 120.0
+
+    # Same seed, same chunks
+    chunks2 = list(my_imf.generate_cluster_chunks(M_cl, chunk_mass, seed=10))
+    assert len(chunks2) == len(chunks)
+    for chunk, chunk2 in zip(chunks, chunks2):
+        np.testing.assert_array_equal(chunk[0], chunk2[0])
+        np.testing.assert_array_equal(chunk[3], chunk2[3])
+
+    return
+
+def test_generate_cluster_min_mass():
+    from .. import imf
+    from .. import multiplicity
+    
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+
+    M_cl = 10**5.
+    min_mass = 2.0
+
+    mass, isMulti, compMass, sysMass = my_imf.generate_cluster(M_cl, seed=2, min_mass=min_mass)
+    assert mass.min() >= min_mass
+
+    # The sampled and skipped systems add up to the cluster mass
+    N_below, M_below = my_imf.mass_below(M_cl, min_mass)
+    assert np.abs(M_cl - M_below - sysMass.sum()) < 200.0
+
+    # The skipped number and mass agree with a full sample
+    mass_all = my_imf.generate_cluster(M_cl, seed=3)[0]
+    below = mass_all < min_mass
+    assert np.abs(below.sum() - N_below) < 0.02 * N_below
+    assert np.abs(mass_all[below].sum() - M_below) < 0.02 * M_below
+    assert np.abs((~below).sum() - len(mass)) < 0.05 * len(mass)
+
+    # Chunks with a mass cut
+    chunks = list(my_imf.generate_cluster_chunks(M_cl, 10**4, seed=2, min_mass=min_mass))
+    mass_chunks = np.concatenate([chunk[0] for chunk in chunks])
+    assert mass_chunks.min() >= min_mass
+    assert np.abs(M_cl - M_below - mass_chunks.sum()) < 200.0
+
+    # With multiples, the companions make the system mass grow faster than
+    # the primary mass, so compare the systems with a full sample.
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+
+    mass, isMulti, compMass, sysMass = my_imf.generate_cluster(M_cl, seed=2, min_mass=min_mass)
+    assert mass.min() >= min_mass
+    
+    N_below, M_below = my_imf.mass_below(M_cl, min_mass)
+    assert np.abs(M_cl - M_below - sysMass.sum()) < 0.02 * sysMass.sum()
+
+    # The high-mass stars make single clusters scatter by ~2%, so
+    # compare with the mean of several full samples.
+    n_draws = 10
+    n_below = np.zeros(n_draws)
+    m_below = np.zeros(n_draws)
+    n_above = np.zeros(n_draws)
+    n_above_cut = np.zeros(n_draws)
+    for ii in range(n_draws):
+        mass_all, isMulti_all, compMass_all, sysMass_all = my_imf.generate_cluster(M_cl, seed=100 + ii)
+        below = mass_all < min_mass
+        n_below[ii] = below.sum()
+        m_below[ii] = sysMass_all[below].sum()
+        n_above[ii] = (~below).sum()
+        n_above_cut[ii] = len(my_imf.generate_cluster(M_cl, seed=200 + ii, min_mass=min_mass)[0])
+
+    assert np.abs(n_below.mean() - N_below) < 0.015 * N_below
+    assert np.abs(m_below.mean() - M_below) < 0.015 * M_below
+    assert np.abs(n_above.mean() - n_above_cut.mean()) < 0.03 * n_above.mean()
+
+    return
+
+def test_system_mass_factor():
+    from .. import imf
+    from .. import multiplicity
+    
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    M_cl = 10**5.
+
+    # Without multiples, the system mass is the primary mass
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+    my_imf.normalize(M_cl)
+    np.testing.assert_allclose(my_imf.system_mass_factor([0.1, 1.0, 10.0]), 1.0)
+    np.testing.assert_allclose(my_imf.int_system_mass(0.08, 120.0), M_cl, rtol=1e-6)
+
+    # The factor is the mean system mass that calc_multi draws
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    rng = np.random.default_rng(1)
+    n_stars = 10**5
+    for m in [0.09, 0.3, 1.0, 5.0, 50.0]:
+        mass = np.full(n_stars, m)
+        MF = imf_multi.multiplicity_fraction(mass.copy())
+        CSF = imf_multi.companion_star_fraction(mass.copy())
+        isMulti = rng.random(n_stars) < MF
+        sysMass = my_imf.calc_multi(mass, mass.copy(), isMulti, CSF, MF, rng=rng)[1]
+        np.testing.assert_allclose(sysMass.mean() / m, my_imf.system_mass_factor(m)[0], rtol=5e-3)
+
+    # Arrays of bins add up to the whole range
+    my_imf.normalize(M_cl)
+    edges = np.array([0.08, 0.3, 2.0, 120.0])
+    np.testing.assert_allclose(my_imf.int_system_mass(edges[:-1], edges[1:]).sum(),
+                               my_imf.int_system_mass(0.08, 120.0), rtol=1e-6)
+
+    # With multiples, the expected system mass agrees with a sample
+    for companion_max in [False, True]:
+        imf_multi = multiplicity.MultiplicityUnresolved(companion_max=companion_max)
+        my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+        mass, isMulti, compMass, sysMass = my_imf.generate_cluster(M_cl, seed=1)
+        
+        my_imf.normalize(M_cl)
+        scale = M_cl / my_imf.int_system_mass(0.08, 120.0)
+        assert scale < 1
+        assert np.abs(len(mass) - my_imf.int_xi(0.08, 120.0) * scale) < 0.02 * len(mass)
+        
+        hi = mass > 1
+        sys_hi = my_imf.int_system_mass(1.0, 120.0) * scale
+        assert np.abs(sysMass[hi].sum() - sys_hi) < 0.05 * sys_hi
+
+    return
+
+def test_generate_weighted():
+    from .. import imf
+    from .. import multiplicity
+    
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    M_cl = 10**9.
+    n_sys = 10**4
+
+    # Without multiples, the weights are the IMF numbers
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+    mass, isMulti, compMass, sysMass, weight = my_imf.generate_weighted(M_cl, n_sys, seed=1)
+    assert len(mass) == n_sys
+    np.testing.assert_allclose((weight * sysMass).sum(), M_cl, rtol=1e-10)
+    np.testing.assert_allclose(weight.sum(), my_imf.int_xi(0.08, 120.0), rtol=1e-3)
+
+    # Stratified: one primary in each log mass bin
+    edges = np.geomspace(0.08, 120, n_sys + 1)
+    assert np.all((mass >= edges[:-1]) & (mass <= edges[1:]))
+
+    # The weighted mass above 1 Msun is the IMF mass
+    hi = mass > 1
+    np.testing.assert_allclose((weight * mass)[hi].sum(), my_imf.int_mxi(1.0, 120.0), rtol=1e-2)
+
+    # With multiples, the weighted system mass is still the cluster mass
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity.MultiplicityUnresolved())
+    mass, isMulti, compMass, sysMass, weight = my_imf.generate_weighted(M_cl, n_sys, seed=1)
+    np.testing.assert_allclose((weight * sysMass).sum(), M_cl, rtol=1e-10)
+    assert isMulti.sum() > 0
+    assert len(compMass) == n_sys
+
+    return
+
+def test_CompanionMasses():
+    from .. import imf
+    from .. import multiplicity
+
+    comp_list = [[], [0.5], [0.2, 0.3], [], [1.0, 0.1, 0.4]]
+    comp = imf.CompanionMasses.from_lists(comp_list)
+
+    assert len(comp) == 5
+    np.testing.assert_array_equal(comp.N_companions, [0, 1, 2, 0, 3])
+    np.testing.assert_array_equal(comp.offsets, [0, 0, 1, 3, 3, 6])
+    np.testing.assert_array_equal(comp.system_index(), [1, 2, 2, 4, 4, 4])
+    np.testing.assert_allclose(comp.system_mass(), [0, 0.5, 0.5, 0, 1.5])
+    for ii in range(len(comp_list)):
+        np.testing.assert_array_equal(comp[ii], comp_list[ii])
+
+    # Selecting systems
+    sub = comp[np.array([4, 1, 3])]
+    np.testing.assert_array_equal(sub.N_companions, [3, 1, 0])
+    np.testing.assert_array_equal(sub.masses, [1.0, 0.1, 0.4, 0.5])
+    
+    sub = comp[2:]
+    np.testing.assert_array_equal(sub.masses, [0.2, 0.3, 1.0, 0.1, 0.4])
+
+    both = imf.CompanionMasses.concatenate([comp, sub])
+    assert len(both) == 8
+    np.testing.assert_array_equal(both[6], [])
+    np.testing.assert_array_equal(both[7], [1.0, 0.1, 0.4])
+
+    # Companions from the IMF
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.08, 0.5, 1, 120]), np.array([-1.3, -2.3, -2.3]),
+                                     imf_multi)
+    mass, isMulti, compMass, sysMass = my_imf.generate_cluster(10**4)
+
+    assert len(compMass) == len(mass)
+    np.testing.assert_array_equal(isMulti, compMass.N_companions > 0)
+    np.testing.assert_allclose(sysMass, mass + compMass.system_mass())
+    assert compMass.masses.min() >= 0.08
+
+    return
+
+def test_IMF_tabulated():
+    from .. import imf
+    from .. import multiplicity
+
+    # Tabulated version of a broken power-law
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    imf_pow = imf.IMF_broken_powerlaw(massLimits, powers)
+    imf_tab = imf.IMF_tabulated(imf_pow.xi, massLimits)
+
+    imf_pow.normalize(1e4)
+    imf_tab.normalize(1e4)
+    
+    np.testing.assert_allclose(imf_tab.int_xi(0.08, 120), imf_pow.int_xi(0.08, 120), rtol=1e-6)
+    np.testing.assert_allclose(imf_tab.int_xi(0.2, 3.0), imf_pow.int_xi(0.2, 3.0), rtol=1e-6)
+    np.testing.assert_allclose(imf_tab.int_mxi(0.08, 120), 1e4, rtol=1e-6)
+
+    # Sampled masses follow the IMF
+    mass = imf_tab.dice_star_cl(np.random.rand(100000))
+    assert mass.min() >= 0.08
+    assert mass.max() <= 120
+    frac_low = imf_pow.int_xi(0.08, 0.5) / imf_pow.int_xi(0.08, 120)
+    np.testing.assert_allclose((mass < 0.5).mean(), frac_low, atol=0.01)
+
+    # From a table of xi values. The first mass rounds to just below 0.08, 
+    # where the tabulated xi is zero.
+    m_tab = np.logspace(np.log10(0.08), np.log10(120), 1000)
+    xi_tab = imf_pow.xi(m_tab)
+    assert xi_tab[0] == 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        imf_table = imf.IMF_tabulated(masses=m_tab, xi_values=xi_tab)
+        imf_table.normalize(1e4)
+        np.testing.assert_allclose(imf_table.int_xi(0.08, 120), imf_pow.int_xi(0.08, 120), rtol=1e-4)
+
+    # Log-normal + power law IMF with multiplicity
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    imf_chab = imf.Chabrier_2003(multiplicity=imf_multi)
+    
+    M_cl = 10**4.
+    mass, isMulti, compMass, sysMass = imf_chab.generate_cluster(M_cl)
+    assert np.abs(M_cl - sysMass.sum()) < 150.0
+    assert mass.min() >= 0.01
+    assert isMulti.sum() > 0
+
+    # The peak of dn/dlog(m) is near 0.08 Msun
+    n, bins = np.histogram(np.log10(mass), bins=np.arange(-2, 1.01, 0.2))
+    assert np.abs(bins[n.argmax()] - np.log10(0.08)) < 0.4
+
+    return
+
 def test_prim_power():
     from .. import imf
 
@@ -232,6 +590,47 @@ def test_mxi():
 
     return
 
+def test_prim_xi():
+    from .. import imf
+
+    mass_limits = np.array([0.1, 1.0, 10.0, 100.0])
+    powers = np.array([-0.3, -1.0, -2.3])
+    imf_tmp = imf.IMF_broken_powerlaw(mass_limits, powers)
+
+    def prim_loop(a, offset):
+        # Segment by segment primitive
+        val = 0.0
+        for ii in range(len(powers)):
+            lo = mass_limits[ii]
+            hi = min(max(a, lo), mass_limits[ii+1])
+            val += imf_tmp.coeffs[ii] * (imf.prim_power(hi, powers[ii] + offset) -
+                                         imf.prim_power(lo, powers[ii] + offset))[0]
+        return imf_tmp.k * val
+
+    m = np.array([0.05, 0.1, 0.5, 1.0, 3.0, 10.0, 50.0, 100.0])
+    for k in [1.0, 25.0]:
+        imf_tmp.k = k
+        val_xi = imf_tmp.prim_xi(m)
+        val_mxi = imf_tmp.prim_mxi(m)
+        assert val_xi.shape == m.shape
+        
+        for ii in range(len(m)):
+            np.testing.assert_almost_equal(val_xi[ii], prim_loop(m[ii], 0))
+            np.testing.assert_almost_equal(val_mxi[ii], prim_loop(m[ii], 1))
+
+    # Scalars
+    np.testing.assert_almost_equal(imf_tmp.prim_xi(3.0), prim_loop(3.0, 0))
+
+    # Normalization to a cluster mass
+    imf_tmp.normalize(1e4)
+    np.testing.assert_almost_equal(imf_tmp.int_mxi(0.1, 100.0), 1e4)
+
+    imf_tmp.norm_cl_wk04(1e4)
+    np.testing.assert_almost_equal(imf_tmp.int_mxi(0.1, imf_tmp.norm_Mmax), 1e4)
+    np.testing.assert_allclose(imf_tmp.int_xi(imf_tmp.norm_Mmax, 100.0), 1.0, rtol=1e-2)
+
+    return
+
 def test_theta_closed():
     from .. import imf
 
@@ -189,3 +189,36 @@ def test_resolvedmult():
     return
 
     
+
+def test_resolvedmult_arrays():
+    """
+    Test the semimajor axis and angles of MultiplicityResolvedDK
+    for arrays of primary masses.
+    """
+    from spisea.imf import multiplicity
+
+    mu = multiplicity.MultiplicityResolvedDK()
+
+    mass = np.concatenate([np.full(10000, 0.1), np.full(10000, 10.0)])
+    log_a = mu.log_semimajoraxis(mass)
+
+    assert log_a.shape == mass.shape
+    assert log_a.min() >= -2
+    assert log_a.max() <= np.log10(2000)
+
+    # More massive primaries have wider companions
+    assert np.median(log_a[mass > 1]) > np.median(log_a[mass < 1])
+
+    # Scalars still work
+    log_a = mu.log_semimajoraxis(1.0)
+    assert np.isscalar(log_a)
+    assert -2 <= log_a <= np.log10(2000)
+
+    N = 10000
+    i, Omega, omega = mu.random_keplarian_parameters(np.random.rand(N), np.random.rand(N),
+                                                     np.random.rand(N))
+    assert i.shape == (N,)
+    assert (i > 90).sum() > 0.4 * N
+    assert (i < 90).sum() > 0.4 * N
+
+    return
@@ -5,15 +5,18 @@ from spisea import evolution
 from spisea import atmospheres as atm
 from spisea import filters
 from spisea.imf import imf, multiplicity
+from spisea.utils.rng import get_rng
 from scipy import interpolate
 from scipy import stats
 from scipy.special import erf
 from pysynphot import spectrum
 from pysynphot import ObsBandpass
 from pysynphot import observation as obs
+from pysynphot import binning
 import pysynphot
 from astropy import constants, units
-from astropy.table import Table, Column, MaskedColumn
+from astropy.table import Table, Column, MaskedColumn, vstack
+from astropy.io import fits
 import pickle
 import time, datetime
 import math
@@ -28,6 +31,12 @@ import pdb
 from scipy.spatial import cKDTree as KDTree
 import inspect
 import astropy.modeling
+import hashlib
+import json
+import contextlib
+import multiprocessing
+import copy
+import functools
 
 default_evo_model = evolution.MISTv1()
 default_red_law = reddening.RedLawNishiyama09()
@@ -74,9 +83,12 @@ class Cluster(object):
         produced by the cluster at the given isochrone age. Otherwise,
         no compact remnants are produced.
 
-    seed: int
+    seed: int, numpy.random.SeedSequence, or numpy.random.Generator
         If set to non-None, all random sampling will be seeded with the
-        specified seed, forcing identical output.
+        specified seed, forcing identical output. Each cluster draws
+        its random numbers from its own numpy Generator (see 
+        spisea.utils.rng.get_rng) rather than the global np.random state,
+        so clusters can be made in parallel threads or processes.
         Default None
 
     vebose: boolean
@@ -90,6 +102,7 @@ class Cluster(object):
         self.ifmr = ifmr
         self.cluster_mass = cluster_mass
         self.seed = seed
+        self.rng = get_rng(seed)
         
         return
     
@@ -120,21 +133,79 @@ class ResolvedCluster(Cluster):
         produced by the cluster at the given isochrone age. Otherwise,
         no compact remnants are produced.
 
-    seed: int
+    seed: int, numpy.random.SeedSequence, or numpy.random.Generator
         If set to non-None, all random sampling will be seeded with the
-        specified seed, forcing identical output.
+        specified seed, forcing identical output. Each cluster draws
+        its random numbers from its own numpy Generator (see 
+        spisea.utils.rng.get_rng) rather than the global np.random state,
+        so clusters can be made in parallel threads or processes.
         Default None
 
     vebose: boolean
         True for verbose output.
+
+    chunk_mass: float or None
+        If set, the IMF is sampled in chunks of about chunk_mass M_sun
+        (see imf.generate_cluster_chunks) and the photometry is 
+        interpolated one chunk at a time. The tables of all of the chunks
+        are then stacked into star_systems and companions. 
+        Default None (the whole cluster is sampled at once).
+
+    stream: boolean
+        If True, the star_systems and companions tables are not made. 
+        Instead, the chunks are made one at a time with iter_chunks or 
+        write_chunks (with chunk_mass), so that the memory used 
+        does not depend on cluster_mass. For the same seed, the streamed chunks
+        are identical to the stacked tables made with the same chunk_mass.
+        Realizations can also be made with make_realization.
+        Default False
+
+    precision: 'double' or 'single'
+        Precision of the star_systems and companions columns. With 'single',
+        the photometry, Teff, L, logg and metallicity are float32, phase 
+        is int16 (with -99 for stars without a phase), isWR and 
+        isMultiple are boolean, and N_companions is uint8 (the masses 
+        stay float64). This halves the memory of large clusters. The 
+        companion fluxes are still added to the systems in float64, so 
+        the results agree with 'double' to float32 precision.
+        Default 'double'
+
+    min_mass: float or None
+        If set, only the systems with primaries more massive than min_mass
+        (in M_sun) are made (see imf.generate_cluster), e.g. to skip the
+        stars that are too faint to be detected. The companions of these
+        primaries are made as usual. The expected number and mass of the
+        skipped systems are computed from the IMF (see imf.mass_below), 
+        and saved in the unresolved_number and unresolved_mass attributes 
+        and in the N_UNRES and M_UNRES meta of the star_systems table.
+        Default None
+
+    mag_limit: float or None
+        If set, min_mass is derived from the isochrone: it is the largest 
+        isochrone mass below which all stars are fainter than mag_limit in
+        the mag_limit_filter filter. With multiples, the limit is made 
+        fainter by 2.5 log10(1 + CSF_max), the most that the companions 
+        can add to the system flux (except for the rare systems with more
+        than CSF_max companions). The magnitudes are those of the 
+        isochrone (before set_extinction).
+        Default None
+
+    mag_limit_filter: str or None
+        Filter of mag_limit, as the column name (e.g. 'm_nirc2_Kp') or
+        the filter string (e.g. 'nirc2,Kp').
+        Default None
     """
     def __init__(self, iso, imf, cluster_mass, ifmr=None, verbose=True,
-                     seed=None):
+                     seed=None, chunk_mass=None, stream=False, precision='double',
+                     min_mass=None, mag_limit=None, mag_limit_filter=None):
+        if precision not in ['double', 'single']:
+            raise ValueError("ResolvedCluster: precision must be 'double' or 'single', not {0}".format(precision))
+        
         Cluster.__init__(self, iso, imf, cluster_mass, ifmr=ifmr, verbose=verbose,
                              seed=seed)
-        # Provide a user warning is random seed is set
-        if seed is not None:
-            print('WARNING: random seed set to %i' % seed)
+        self.chunk_mass = chunk_mass
+        self.stream = stream
+        self.precision = precision
 
         t1 = time.time()
 
@@ -146,17 +217,50 @@ class ResolvedCluster(Cluster):
         # Make isochrone interpolators
         #####
         interp_keys = ['Teff', 'L', 'logg', 'isWR', 'mass_current', 'phase'] + self.filt_names
-        self.iso_interps = {}
-        for ikey in interp_keys:
-            self.iso_interps[ikey] = interpolate.interp1d(self.iso.points['mass'], self.iso.points[ikey],
-                                                          kind='linear', bounds_error=False, fill_value=np.nan)
+
+        # Magnitudes at each extinction of the AKs grid, if the isochrone has them
+        self.AKs_grid = None
+        if 'AKSGRID' in self.iso.points.meta:
+            self.AKs_grid = np.array(self.iso.points.meta['AKSGRID'].split(','), dtype=float)
+            interp_keys += [filt.replace('m_', 'mgrid_', 1) for filt in self.filt_names]
+        
+        # One shared interpolator for all columns: the bracketing isochrone
+        # points of each star are found only once (see IsochroneInterpolator).
+        self.iso_interp = IsochroneInterpolator(self.iso.points['mass'],
+                                                {ikey: self.iso.points[ikey] for ikey in interp_keys})
+        self.iso_interps = {ikey: self.iso_interp.column(ikey) for ikey in interp_keys}
+
+        # Only sample the systems above the mass cut, and account
+        # for the skipped systems from the IMF.
+        if mag_limit is not None:
+            if mag_limit_filter is None:
+                raise ValueError('ResolvedCluster: mag_limit requires mag_limit_filter')
+            min_mass = self._mag_limit_min_mass(mag_limit, mag_limit_filter)
+        self.min_mass = min_mass
+        self.unresolved_number = 0.0
+        self.unresolved_mass = 0.0
+        if min_mass is not None:
+            self.unresolved_number, self.unresolved_mass = self.imf.mass_below(cluster_mass, min_mass)
+            if self.verbose:
+                print('Skipping an expected {0:.0f} systems ({1:.1f} M_sun) below {2:.3f} M_sun'.format(
+                    self.unresolved_number, self.unresolved_mass, min_mass))
+
+        # Arguments of the IFMR (see _generate_death_mass)
+        self._ifmr_args = []
+        if self.ifmr is not None:
+            self._ifmr_args = inspect.getfullargspec(self.ifmr.generate_death_mass).args
         
         # Converted to function, so that inherent classes had more flexibility
-        self._setup_systems_table()
+        if not stream:
+            self._setup_systems_table()
 
         return
 
     def _setup_systems_table(self):
+        if self.chunk_mass is not None:
+            self._setup_systems_table_chunks()
+            return
+        
         ##### 
         # Sample the IMF to build up our cluster mass.
         #####
@@ -164,29 +268,173 @@ class ResolvedCluster(Cluster):
         mass, isMulti, compMass, sysMass = self._generate_cluster_members() 
 
         ##### 
-        # Make a table to contain all the information about each stellar system.
-        #####
-        star_systems = self._make_star_systems_table(mass, isMulti, sysMass)
-        
-        # Trim out bad systems; specifically, stars with masses outside those provided
-        # by the model isochrone (except for compact objects).
-        star_systems, compMass = self._remove_bad_systems(star_systems, compMass)
-
-        ##### 
-        # Make a table to contain all the information about companions.
+        # Make the columns of the tables with all the information about each 
+        # stellar system and companion. Bad systems (stars with masses outside 
+        # those provided by the model isochrone, except for compact objects) 
+        # are trimmed out.
         #####
-        if self.imf.make_multiples:
-            companions = self._make_companions_table(star_systems, compMass)
+        star_systems, companions = self._make_systems_columns(mass, isMulti, compMass, sysMass)
             
         #####
-        # Save our arrays to the object
+        # Save our tables to the object
         #####
-        self.star_systems = star_systems
+        self.star_systems = self._add_unresolved_meta(columns_to_table(star_systems))
         
         if self.imf.make_multiples:
-            self.companions = companions
+            self.companions = self._companions_to_table(companions)
         return
     
+    def _setup_systems_table_chunks(self):
+        """
+        Make star_systems and companions by stacking the tables of 
+        all chunks from iter_chunks.
+        """
+        chunks = list(self.iter_chunks())
+
+        self.star_systems = vstack([chunk[0] for chunk in chunks],
+                                         metadata_conflicts='silent')
+        
+        if self.imf.make_multiples:
+            self.companions = vstack([chunk[1] for chunk in chunks],
+                                           metadata_conflicts='silent')
+        return
+
+    def make_realization(self, seed=None, stream=False):
+        """
+        Make another realization of the cluster, with the same isochrone,
+        IMF, IFMR and cluster mass. The isochrone interpolators of this 
+        cluster are reused, so this is faster than making a new ResolvedCluster.
+
+        Parameters
+        ----------
+        seed: int, numpy.random.SeedSequence, numpy.random.Generator, or None
+            Seed of the new realization.
+
+        stream: boolean
+            If True, the tables of the new realization are not made
+            (see the stream parameter of ResolvedCluster).
+
+        Returns
+        -------
+        cluster: ResolvedCluster
+            The new realization, with its star_systems and companions tables.
+        """
+        cluster = copy.copy(self)
+        cluster.seed = seed
+        cluster.rng = get_rng(seed)
+        cluster.stream = stream
+        if not stream:
+            cluster._setup_systems_table()
+
+        return cluster
+
+    def reduce(self, reducers):
+        """
+        Update reducers (see ClusterReducer) with the cluster. If the
+        cluster is streamed (stream=True, with chunk_mass), the chunks 
+        are made and passed to the reducers one at a time, and then discarded.
+
+        Parameters
+        ----------
+        reducers: list of ClusterReducer objects
+
+        Returns
+        -------
+        reducers: list of ClusterReducer objects
+            The updated reducers.
+        """
+        if self.stream:
+            chunks = self.iter_chunks()
+        else:
+            companions = self.companions if self.imf.make_multiples else None
+            chunks = [(self.star_systems, companions)]
+
+        for star_systems, companions in chunks:
+            for reducer in reducers:
+                reducer.update(star_systems, companions)
+
+        return reducers
+
+    def iter_chunks(self, raw=False):
+        """
+        Generate the cluster in chunks of about chunk_mass M_sun each.
+        Only one chunk is sampled and interpolated at a time, so the
+        memory used depends on chunk_mass rather than on cluster_mass.
+        If chunk_mass is None, the whole cluster is made as one chunk.
+
+        The system_idx column of the companions refers to the row of 
+        the system in the stacked star_systems of all the chunks, so
+        that the chunks can simply be concatenated.
+
+        Parameters
+        ----------
+        raw : boolean
+            If True, yield dicts of numpy column arrays rather than
+            astropy Tables (for pipelines that don't use astropy). 
+            They can be made into Tables later with columns_to_table.
+
+        Yields
+        ------
+        star_systems, companions : astropy Table or dict
+            The tables of each chunk. companions is None if the IMF
+            doesn't make multiples.
+        """
+        if self.chunk_mass is None:
+            chunks = [self._generate_cluster_members()]
+        else:
+            chunks = self.imf.generate_cluster_chunks(self.cluster_mass, self.chunk_mass,
+                                                      seed=self.rng, min_mass=self.min_mass)
+
+        N_systems_tot = 0
+        for mass, isMulti, compMass, sysMass in chunks:
+            star_systems, companions = self._make_systems_columns(mass, isMulti, compMass, sysMass)
+            
+            if companions is not None:
+                companions['system_idx'] += N_systems_tot
+
+            N_systems_tot += len(star_systems['mass'])
+
+            if not raw:
+                star_systems = self._add_unresolved_meta(columns_to_table(star_systems))
+                if companions is not None:
+                    companions = self._companions_to_table(companions)
+
+            yield star_systems, companions
+
+    def write_chunks(self, root, overwrite=False):
+        """
+        Generate the cluster in chunks (see iter_chunks) and write
+        each chunk to FITS files: <root>_systems_<n>.fits and, with
+        multiples, <root>_companions_<n>.fits.
+
+        Parameters
+        ----------
+        root : str
+            Root of the file names (can include a directory).
+
+        overwrite : boolean
+            Overwrite existing files.
+
+        Returns
+        -------
+        files : list of tuples
+            The (systems, companions) file names of each chunk 
+            (companions is None without multiples).
+        """
+        files = []
+        for nn, (star_systems, companions) in enumerate(self.iter_chunks()):
+            sys_file = '{0}_systems_{1:04d}.fits'.format(root, nn)
+            star_systems.write(sys_file, overwrite=overwrite)
+            
+            comp_file = None
+            if companions is not None:
+                comp_file = '{0}_companions_{1:04d}.fits'.format(root, nn)
+                companions.write(comp_file, overwrite=overwrite)
+                
+            files.append((sys_file, comp_file))
+
+        return files
+
     def _generate_cluster_members(self):
         """
         Generate the essential column members for ResolveCluster object to work.
@@ -198,9 +446,51 @@ class ResolvedCluster(Cluster):
         
         """
         mass, isMulti, compMass, sysMass = self.imf.generate_cluster(self.cluster_mass,
-                                                                        seed=self.seed)
+                                                                        seed=self.rng,
+                                                                        min_mass=self.min_mass)
         return mass, isMulti, compMass, sysMass
 
+    def _mag_limit_min_mass(self, mag_limit, filt):
+        """
+        Helper function to derive the mass cut of a magnitude limit from
+        the isochrone (see the mag_limit parameter). Returns None if even
+        the least massive isochrone star is brighter than the limit.
+        """
+        if filt not in self.filt_names:
+            filt = 'm_' + get_filter_col_name(filt)
+            
+        if self.imf.make_multiples:
+            n_comp_max = getattr(self.imf._multi_props, 'CSF_max', 1)
+            mag_limit = mag_limit + 2.5 * np.log10(1 + n_comp_max)
+
+        mass = np.array(self.iso.points['mass'])
+        mag = np.array(self.iso.points[filt])
+        sdx = np.argsort(mass)
+        mass = mass[sdx]
+        mag = mag[sdx]
+
+        # Stars are interpolated between the isochrone points, so the cut
+        # is the point below the first one that is bright enough.
+        bright = np.where(mag <= mag_limit)[0]
+        if len(bright) == 0:
+            return mass[-1]
+        if bright[0] == 0:
+            return None
+
+        return mass[bright[0] - 1]
+
+    def _add_unresolved_meta(self, star_systems):
+        """
+        Save the mass cut and the expected number and mass of the 
+        skipped systems (see min_mass) in the meta of a star_systems table.
+        """
+        if self.min_mass is not None:
+            star_systems.meta['MIN_MASS'] = self.min_mass
+            star_systems.meta['N_UNRES'] = self.unresolved_number
+            star_systems.meta['M_UNRES'] = self.unresolved_mass
+
+        return star_systems
+
     def set_filter_names(self):
         """
         Set filter column names
@@ -208,41 +498,169 @@ class ResolvedCluster(Cluster):
         filt_names = []
         
         for col_name in self.iso.points.colnames:
-            if 'm_' in col_name:
+            if col_name.startswith('m_'):
                 filt_names.append(col_name)
 
         return filt_names
         
+    def set_extinction(self, AKs):
+        """
+        Set the extinction of each star system, and remake the photometry
+        of the systems (and companions) for it. The magnitude of each star is 
+        interpolated between the magnitudes that the isochrone has at each
+        extinction of its AKs grid (see the IsochronePhot AKs_grid 
+        parameter), so this is exact at the grid values. Companions have
+        the extinction of their system. The extinction of each system 
+        is saved in the AKs_f column.
+
+        Parameters
+        ----------
+        AKs : float or array
+            Total extinction in the Ks filter (in magnitudes), for all
+            the systems or for each one (e.g. from an extinction map).
+        """
+        if self.AKs_grid is None:
+            raise ValueError('Isochrone has no AKs grid photometry; set AKs_grid in IsochronePhot')
+
+        N_systems = len(self.star_systems)
+        AKs = np.broadcast_to(np.asarray(AKs, dtype=float), (N_systems,))
+        if (AKs.min() < self.AKs_grid.min()) | (AKs.max() > self.AKs_grid.max()):
+            raise ValueError('AKs is outside of the isochrone AKs grid {0}'.format(self.AKs_grid))
+
+        if self.imf.make_multiples:
+            comp_idx = np.array(self.companions['system_idx'])
+            comp_AKs = AKs[comp_idx]
+
+        grid_names = [filt.replace('m_', 'mgrid_', 1) for filt in self.filt_names]
+        mag_grids = self.iso_interp(self.star_systems['mass'], keys=grid_names)
+        if self.imf.make_multiples:
+            mag_grids_c = self.iso_interp(self.companions['mass'], keys=grid_names)
+
+        for filt, grid_name in zip(self.filt_names, grid_names):
+            mag = interp_AKs_grid(mag_grids[grid_name], self.AKs_grid, AKs)
+
+            # Add the flux of the companions to the system
+            if self.imf.make_multiples:
+                mag_grid_c = mag_grids_c[grid_name]
+                mag_c = interp_AKs_grid(mag_grid_c, self.AKs_grid, comp_AKs)
+                self.companions[filt] = mag_c.astype(self._column_dtype(filt) or float)
+
+                # For dark objects, turn the np.nan fluxes into zeros.
+                f1 = np.nan_to_num(10**(-mag / 2.5))
+                f2 = np.nan_to_num(10**(-mag_c / 2.5))
+                flux = f1 + np.bincount(comp_idx, weights=f2, minlength=N_systems)
+                
+                # If *all* objects are dark, then keep the magnitude as np.nan.
+                with np.errstate(divide='ignore'):
+                    mag = np.where(flux > 0, -2.5 * np.log10(flux), np.nan)
+
+            self.star_systems[filt] = mag.astype(self._column_dtype(filt) or float)
+
+        if 'AKs_f' in self.star_systems.colnames:
+            self.star_systems['AKs_f'] = AKs
+        else:
+            self.star_systems.add_column(Column(np.array(AKs), name='AKs_f'))
+
+        return
+
+    def _make_systems_columns(self, mass, isMulti, compMass, sysMass, system_columns=None):
+        """
+        Make the columns of the star_systems and companions tables
+        (dicts of numpy arrays, see _make_star_systems_columns),
+        without the bad systems.
+        companions is None if the IMF doesn't make multiples.
+
+        system_columns is an optional dict of extra columns of the systems 
+        (e.g. weights), which are also given to their companions.
+        """
+        star_systems = self._make_star_systems_columns(mass, isMulti, sysMass)
+        if system_columns is not None:
+            star_systems.update(system_columns)
+        star_systems, compMass = self._remove_bad_systems(star_systems, compMass)
+
+        companions = None
+        if self.imf.make_multiples:
+            companions = self._make_companions_columns(star_systems, compMass)
+            if system_columns is not None:
+                for key in system_columns:
+                    companions[key] = star_systems[key][companions['system_idx']]
+            companions = self._apply_precision(companions)
+
+        # Only after the companion fluxes are added to the systems.
+        star_systems = self._apply_precision(star_systems)
+
+        return star_systems, companions
+
+    def _column_dtype(self, key):
+        """
+        Dtype of a column of the star_systems and companions tables 
+        for the precision of the cluster (None to keep it as it is).
+        """
+        if self.precision == 'double':
+            return None
+
+        if key in self.filt_names:
+            return np.float32
+
+        return _single_precision_dtypes.get(key)
+
+    def _apply_precision(self, table):
+        """
+        Convert the columns of a star_systems or companions table (or 
+        dict of columns) to the dtypes of the precision of the cluster.
+        """
+        if self.precision == 'double':
+            return table
+
+        for key in list(table.keys()):
+            dtype = self._column_dtype(key)
+            if dtype is None:
+                continue
+
+            col = np.asarray(table[key])
+            if not np.issubdtype(dtype, np.floating):
+                # Integer and boolean columns can't hold nan.
+                col = np.nan_to_num(col, nan=(-99 if np.issubdtype(dtype, np.integer) else 0))
+
+            table[key] = col.astype(dtype)
+
+        return table
+
     def _make_star_systems_table(self, mass, isMulti, sysMass):
         """
         Make a star_systems table and get synthetic photometry for each primary star.
         """
-        star_systems = Table([mass, isMulti, sysMass],
-                             names=['mass', 'isMultiple', 'systemMass'])
-        N_systems = len(star_systems)
-
-        # Add columns for the Teff, L, logg, isWR, mass_current, phase for the primary stars.
-        star_systems.add_column( Column(np.zeros(N_systems, dtype=float), name='Teff') )
-        star_systems.add_column( Column(np.empty(N_systems, dtype=float), name='L') )
-        star_systems.add_column( Column(np.empty(N_systems, dtype=float), name='logg') )
-        star_systems.add_column( Column(np.empty(N_systems, dtype=float), name='isWR') )
-        star_systems.add_column( Column(np.empty(N_systems, dtype=float), name='mass_current') )
-        star_systems.add_column( Column(np.empty(N_systems, dtype=float), name='phase') )
-        star_systems.add_column( Column(np.empty(N_systems, dtype=float), name='metallicity') )
-
-        # Add the filter columns to the table. They are empty so far.
-        # Keep track of the filter names in : filt_names
+        return columns_to_table(self._make_star_systems_columns(mass, isMulti, sysMass))
+
+    def _make_star_systems_columns(self, mass, isMulti, sysMass):
+        """
+        Make the columns of the star_systems table, as a dict of numpy
+        arrays, and get synthetic photometry for each primary star.
+
+        The isochrone columns are interpolated into one preallocated
+        (N_columns x N_systems) buffer (see IsochroneInterpolator), and
+        each column is a view of one row of it. So the columns can be
+        made into a Table (see columns_to_table) without copying them.
+        """
+        mass = np.asarray(mass, dtype=float)
+        N_systems = len(mass)
+
+        # Use our pre-built interpolator to fetch values from the isochrone for each star.
+        # All columns are interpolated at once.
+        iso_keys = ['Teff', 'L', 'logg', 'isWR', 'mass_current', 'phase'] + self.filt_names
+        iso_vals = self.iso_interp(mass, keys=iso_keys)
+
+        star_systems = {'mass': mass,
+                        'isMultiple': np.asarray(isMulti),
+                        'systemMass': np.asarray(sysMass, dtype=float)}
+        for key in ['Teff', 'L', 'logg', 'isWR', 'mass_current', 'phase']:
+            star_systems[key] = iso_vals[key]
+        star_systems['metallicity'] = np.full(N_systems, self.iso.metallicity, dtype=float)
         for filt in self.filt_names:
-            star_systems.add_column( Column(np.empty(N_systems, dtype=float), name=filt) )
+            star_systems[filt] = iso_vals[filt]
 
-        # Use our pre-built interpolators to fetch values from the isochrone for each star.
-        star_systems['Teff'] = self.iso_interps['Teff'](star_systems['mass'])
-        star_systems['L']    = self.iso_interps['L'](star_systems['mass'])
-        star_systems['logg'] = self.iso_interps['logg'](star_systems['mass'])
-        star_systems['isWR'] = np.round(self.iso_interps['isWR'](star_systems['mass']))
-        star_systems['mass_current'] = self.iso_interps['mass_current'](star_systems['mass'])
-        star_systems['phase'] = np.round(self.iso_interps['phase'](star_systems['mass']))
-        star_systems['metallicity'] = np.ones(N_systems)*self.iso.metallicity
+        np.round(star_systems['isWR'], out=star_systems['isWR'])
+        np.round(star_systems['phase'], out=star_systems['phase'])
 
         # For a very small fraction of stars, the star phase falls on integers in-between
         # the ones we have definition for, as a result of the interpolation. For these
@@ -259,9 +677,6 @@ class ResolvedCluster(Cluster):
             for ii in range(len(bad[0])):
                 print('WARNING: changing phase {0} to 5'.format(star_systems['phase'][bad[0][ii]]))
         star_systems['phase'][bad] = 5
-        
-        for filt in self.filt_names:
-            star_systems[filt] = self.iso_interps[filt](star_systems['mass'])
 
         #####
         # Make Remnants
@@ -277,11 +692,8 @@ class ResolvedCluster(Cluster):
             
             # Calculate remnant mass and ID for compact objects; update remnant_id and
             # remnant_mass arrays accordingly
-            if 'metallicity_array' in inspect.getfullargspec(self.ifmr.generate_death_mass).args:
-                r_mass_tmp, r_id_tmp = self.ifmr.generate_death_mass(mass_array=star_systems['mass'][idx_rem],
-                                                                     metallicity_array=star_systems['metallicity'][idx_rem])
-            else:
-                r_mass_tmp, r_id_tmp = self.ifmr.generate_death_mass(mass_array=star_systems['mass'][idx_rem])
+            r_mass_tmp, r_id_tmp = self._generate_death_mass(star_systems['mass'][idx_rem],
+                                                             star_systems['metallicity'][idx_rem])
 
             # Drop remnants where it is not relevant (e.g. not a compact object or
             # outside mass range IFMR is defined for)
@@ -293,59 +705,92 @@ class ResolvedCluster(Cluster):
 
             # Give remnants a magnitude of nan, so they can be filtered out later when calculating flux.
             for filt in self.filt_names:
-                star_systems[filt][idx_rem_good] = np.full(len(idx_rem_good), np.nan)
+                star_systems[filt][idx_rem_good] = np.nan
 
         return star_systems
         
+    def _generate_death_mass(self, mass, metallicity):
+        """
+        Helper function to get the remnant masses and types from the IFMR,
+        with the metallicity and the random number generator of the 
+        cluster if the IFMR takes them.
+        """
+        kwargs = {}
+        if 'metallicity_array' in self._ifmr_args:
+            kwargs['metallicity_array'] = metallicity
+        if 'rng' in self._ifmr_args:
+            kwargs['rng'] = self.rng
+
+        return self.ifmr.generate_death_mass(mass_array=mass, **kwargs)
+        
     def _make_companions_table(self, star_systems, compMass):
-        N_systems = len(star_systems)
+        """
+        Make a companions table and get synthetic photometry for each 
+        companion (and add the companion flux to the systems).
+        """
+        return self._companions_to_table(self._make_companions_columns(star_systems, compMass))
+
+    def _companions_to_table(self, companions):
+        """
+        Make a companions table from its columns (see columns_to_table).
+        """
+        companions = columns_to_table(companions)
+
+        if 'i' in companions.colnames:
+            companions['i'].description = 'degrees'
+
+        return companions
+
+    def _make_companions_columns(self, star_systems, compMass):
+        """
+        Make the columns of the companions table, as a dict of numpy
+        arrays (see _make_star_systems_columns). The N_companions column is
+        added to star_systems (a Table or a dict of columns), and the
+        flux of the companions is added to the system magnitudes.
+        """
+        N_systems = len(star_systems['mass'])
         #####
         #    MULTIPLICITY                 
         # Make a second table containing all the companion-star masses.
         # This table will be much longer... here are the arrays:
         #    sysIndex - the index of the system this star belongs too
         #    mass - the mass of this individual star.
-        N_companions = np.array([len(star_masses) for star_masses in compMass])
-        star_systems.add_column( Column(N_companions, name = 'N_companions') )
+        # compMass is an imf.CompanionMasses, so the companions
+        # are already in a flat array, ordered by system.
+        N_companions = compMass.N_companions
+        star_systems['N_companions'] = N_companions
 
         N_comp_tot = N_companions.sum()
-        system_index = np.repeat(np.arange(N_systems), N_companions)
-
-        companions = Table([system_index], names=['system_idx'])
-
-        # Add columns for the Teff, L, logg, isWR mass_current, phase, and filters for the companion stars.
-        companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='mass') )
-        companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='Teff') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='L') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='logg') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='isWR') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='mass_current') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='phase') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='metallicity') )
+        system_index = compMass.system_index()
+        comp_mass = np.array(compMass.masses, dtype=float)
+
+        # Interpolate the properties of all companions at once.
+        iso_keys = ['Teff', 'L', 'logg', 'isWR', 'mass_current', 'phase'] + self.filt_names
+        iso_vals = self.iso_interp(comp_mass, keys=iso_keys)
+
+        # Columns for the Teff, L, logg, isWR mass_current, phase, and filters for the companion stars.
+        companions = {'system_idx': system_index, 'mass': comp_mass}
+        for key in ['Teff', 'L', 'logg', 'isWR', 'mass_current', 'phase']:
+            companions[key] = iso_vals[key]
+        companions['metallicity'] = np.full(N_comp_tot, self.iso.metallicity, dtype=float)
         for filt in self.filt_names:
-            companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name=filt) )
+            companions[filt] = iso_vals[filt]
+
+        np.round(companions['isWR'], out=companions['isWR'])
+        np.round(companions['phase'], out=companions['phase'])
             
         if isinstance(self.imf._multi_props, multiplicity.MultiplicityResolvedDK):
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='log_a') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='e') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='i', description = 'degrees') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='Omega') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='omega') )
-            
-            for ii in range(len(companions)):
-                companions['log_a'][ii] = self.imf._multi_props.log_semimajoraxis(star_systems['mass'][companions['system_idx'][ii]])
+            companions['log_a'] = self.imf._multi_props.log_semimajoraxis(star_systems['mass'][system_index],
+                                                                          rng=self.rng)
             
-            companions['e'] = self.imf._multi_props.random_e(np.random.rand(N_comp_tot))
-            companions['i'], companions['Omega'], companions['omega'] = self.imf._multi_props.random_keplarian_parameters(np.random.rand(N_comp_tot),np.random.rand(N_comp_tot),np.random.rand(N_comp_tot))
+            companions['e'] = self.imf._multi_props.random_e(self.rng.random(N_comp_tot))
+            companions['i'], companions['Omega'], companions['omega'] = self.imf._multi_props.random_keplarian_parameters(self.rng.random(N_comp_tot),self.rng.random(N_comp_tot),self.rng.random(N_comp_tot), rng=self.rng)
 
         if self.imf._multi_props == 'table' :
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='log_a') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='e') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='i', description = 'degrees') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='Omega') )
-            companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='omega') )
+            for key in ['log_a', 'e', 'i', 'Omega', 'omega']:
+                companions[key] = np.zeros(N_comp_tot, dtype=float)
 
-            for ii in range(len(companions)):
+            for ii in range(N_comp_tot):
                 #companions['log_a'][ii] = self.imf._multi_props.log_semimajoraxis(companions['system_idx'][ii])
                 ind = companions['system_idx'][ii]
                 ncomp = star_systems['N_companions'][ii]
@@ -355,77 +800,38 @@ class ResolvedCluster(Cluster):
                 #companions['Omega'][ii:ii+ncomp] = star_systems['Omega'][ind] 
                 #companions['omega'][ii:ii+ncomp] = star_systems['omega'][ind] 
 
+        # For a very small fraction of stars, the star phase falls on integers in-between
+        # the ones we have definition for, as a result of the interpolation. For these
+        # stars, round phase down to nearest defined phase (e.g., if phase is 71,
+        # then round it down to 5, rather than up to 101).
+        # Convert nan_to_num to avoid errors on greater than, less than comparisons
+        companions_phase_non_nan = np.nan_to_num(companions['phase'], nan=-99)
+        bad = np.where( (companions_phase_non_nan > 5) & (companions_phase_non_nan < 101) & (companions_phase_non_nan != 9) & (companions_phase_non_nan != -99))
+        # Print warning, if desired
+        verbose=False
+        if verbose:
+            for ii in range(len(bad[0])):
+                print('WARNING: changing phase {0} to 5'.format(companions['phase'][bad[0][ii]]))
+        companions['phase'][bad] = 5
 
-        # Make an array that maps system index (ii), companion index (cc) to
-        # the place in the 1D companions array.
-        N_comp_max = N_companions.max()
-        
-        comp_index = np.zeros((N_systems, N_comp_max), dtype=int)
-        kk = 0
-        for ii in range(N_systems):
-            for cc in range(N_companions[ii]):
-                comp_index[ii][cc] = kk
-                kk += 1
+        if N_comp_tot > 0:
+            # Systems with at least one companion.
+            idx = np.where(N_companions > 0)[0]
+            
+            for filt in self.filt_names:
+                # Add the flux of all companions to the system flux.
+                # For dark objects, turn the np.nan fluxes into zeros.
+                f1 = np.nan_to_num(10**(-star_systems[filt][idx] / 2.5))
+                f2 = np.nan_to_num(10**(-companions[filt] / 2.5))
+                f2 = np.bincount(system_index, weights=f2, minlength=N_systems)[idx]
 
-        # Find all the systems with at least one companion... add the flux
-        # of that companion to the primary. Repeat for 2 companions,
-        # 3 companions, etc.
-        for cc in range(1, N_comp_max+1):
-            # All systems with at least cc companions.
-            idx = np.where(N_companions >= cc)[0]
+                # If *all* objects are dark, then keep the magnitude
+                # as np.nan. Otherwise, add fluxes together
+                good = np.where( (f1 != 0) | (f2 != 0) )
+                bad = np.where( (f1 == 0) & (f2 == 0) )
 
-            # Get the location in the companions array for each system and
-            # the cc'th companion. 
-            cdx = comp_index[idx, cc-1]
-            
-            companions['mass'][cdx] = [compMass[ii][cc-1] for ii in idx]
-            comp_mass = companions['mass'][cdx]
-
-            if len(idx) > 0:
-                companions['Teff'][cdx] = self.iso_interps['Teff'](comp_mass)
-                companions['L'][cdx] = self.iso_interps['L'](comp_mass)
-                companions['logg'][cdx] = self.iso_interps['logg'](comp_mass)
-                companions['isWR'][cdx] = np.round(self.iso_interps['isWR'](comp_mass))
-                companions['mass_current'] = self.iso_interps['mass_current'](companions['mass'])
-                companions['phase'] = np.round(self.iso_interps['phase'](companions['mass']))
-                companions['metallicity'] = np.ones(N_comp_tot)*self.iso.metallicity
-
-                # For a very small fraction of stars, the star phase falls on integers in-between
-                # the ones we have definition for, as a result of the interpolation. For these
-                # stars, round phase down to nearest defined phase (e.g., if phase is 71,
-                # then round it down to 5, rather than up to 101).
-                # Convert nan_to_num to avoid errors on greater than, less than comparisons
-                companions_phase_non_nan = np.nan_to_num(companions['phase'], nan=-99)
-                bad = np.where( (companions_phase_non_nan > 5) & (companions_phase_non_nan < 101) & (companions_phase_non_nan != 9) & (companions_phase_non_nan != -99))
-                # Print warning, if desired
-                verbose=False
-                if verbose:
-                    for ii in range(len(bad[0])):
-                        print('WARNING: changing phase {0} to 5'.format(companions['phase'][bad[0][ii]]))
-                companions['phase'][bad] = 5
-
-                for filt in self.filt_names:
-                    # Magnitude of companion
-                    companions[filt][cdx] = self.iso_interps[filt](comp_mass)
-
-                    mag_s = star_systems[filt][idx]
-                    mag_c = companions[filt][cdx]
-
-                    # Add companion flux to system flux.
-                    f1 = 10**(-mag_s / 2.5)
-                    f2 = 10**(-mag_c / 2.5)
-
-                    # For dark objects, turn the np.nan fluxes into zeros.
-                    f1 = np.nan_to_num(f1)
-                    f2 = np.nan_to_num(f2)
-
-                    # If *both* objects are dark, then keep the magnitude
-                    # as np.nan. Otherwise, add fluxes together
-                    good = np.where( (f1 != 0) | (f2 != 0) )
-                    bad = np.where( (f1 == 0) & (f2 == 0) )
-                    
-                    star_systems[filt][idx[good]] = -2.5 * np.log10(f1[good] + f2[good])
-                    star_systems[filt][idx[bad]] = np.nan
+                star_systems[filt][idx[good]] = -2.5 * np.log10(f1[good] + f2[good])
+                star_systems[filt][idx[bad]] = np.nan
 
         #####
         # Make Remnants with flux = 0 in all bands.
@@ -438,11 +844,8 @@ class ResolvedCluster(Cluster):
 
             # Calculate remnant mass and ID for compact objects; update remnant_id and
             # remnant_mass arrays accordingly
-            if 'metallicity_array' in inspect.getfullargspec(self.ifmr.generate_death_mass).args:
-                r_mass_tmp, r_id_tmp = self.ifmr.generate_death_mass(mass_array=companions['mass'][cdx_rem],
-                                                                     metallicity_array=companions['metallicity'][cdx_rem])
-            else:
-                r_mass_tmp, r_id_tmp = self.ifmr.generate_death_mass(mass_array=companions['mass'][cdx_rem])
+            r_mass_tmp, r_id_tmp = self._generate_death_mass(companions['mass'][cdx_rem],
+                                                             companions['metallicity'][cdx_rem])
 
             # Drop remnants where it is not relevant (e.g. not a compact object or
             # outside mass range IFMR is defined for)
@@ -454,7 +857,7 @@ class ResolvedCluster(Cluster):
                 
             # Give remnants a magnitude of nan, so they can be filtered out later when calculating flux.
             for filt in self.filt_names:
-                companions[filt][cdx_rem_good] = np.full(len(cdx_rem_good), np.nan)
+                companions[filt][cdx_rem_good] = np.nan
 
 
         # Notify if we have a lot of bad ones.
@@ -477,8 +880,10 @@ class ResolvedCluster(Cluster):
         If self.ifmr == None, then both high and low-mass bad systems are 
         removed. If self.ifmr != None, then we will save the high mass systems 
         since they will be plugged into an ifmr later.
+
+        star_systems can be a Table or a dict of columns.
         """
-        N_systems = len(star_systems)
+        N_systems = len(star_systems['mass'])
 
         # Get rid of the bad ones
         # Convert nan_to_num to avoid errors on greater than, less than comparisons
@@ -494,19 +899,104 @@ class ResolvedCluster(Cluster):
         if len(idx) != N_systems and self.verbose:
             print( 'Found {0:d} stars out of mass range'.format(N_systems - len(idx)))
 
-        star_systems = star_systems[idx]
-        N_systems = len(star_systems)
+        # Only copy the columns if there are bad systems.
+        if len(idx) != N_systems:
+            if isinstance(star_systems, dict):
+                for key in list(star_systems.keys()):
+                    star_systems[key] = star_systems[key][idx]
+            else:
+                star_systems = star_systems[idx]
 
         if self.imf.make_multiples:
             # Clean up companion stuff (which we haven't handled yet)
         #jpf : shouldnt this allways be done?
         #   : how is compMass if self.imf.make_multiples is False? index error?
         #   : imf.make_multiples is not defined in CustomResolvedCluster
-            compMass = [compMass[ii] for ii in idx]
+            # Custom tables have a list of companion masses for each system
+            if not isinstance(compMass, imf.CompanionMasses):
+                compMass = imf.CompanionMasses.from_lists(compMass)
+            compMass = compMass[idx]
         
         return star_systems, compMass
 
 
+class WeightedResolvedCluster(ResolvedCluster):
+    """
+    Sub-class of ResolvedCluster made of n_systems representative star 
+    systems, each with a statistical weight, for populations that are 
+    too massive to be sampled star by star (e.g. 10^9 M_sun). The size 
+    of the tables is set by n_systems rather than by cluster_mass.
+
+    The primaries are stratified in mass (one per bin of equal width in 
+    log mass, see imf.generate_weighted), and the weight column of
+    star_systems is the number of systems of the cluster that each
+    system stands for (computed from the normalized IMF). The companions
+    have the weight of their system. Weighted sums over the tables 
+    give the cluster totals, e.g. the total mass is 
+    sum(weight * systemMass) = cluster_mass (less the systems outside of
+    the isochrone mass range, which are removed), a luminosity function is
+    a histogram with the weights (see the weight_column of 
+    HistogramReducer), and the integrated flux in a filter is 
+    sum(weight * 10**(-0.4 * mag)).
+
+    Parameters
+    -----------
+    iso: isochrone object
+        SPISEA isochrone object
+    
+    imf: imf object
+        SPISEA IMF object
+
+    cluster_mass: float
+        Total initial mass of the cluster, in M_sun
+
+    n_systems: int
+        Number of representative star systems to make (before the
+        systems outside of the isochrone mass range are removed).
+
+    ifmr, verbose, seed, precision, min_mass, mag_limit, mag_limit_filter:
+        See ResolvedCluster.
+    """
+    def __init__(self, iso, imf, cluster_mass, n_systems, ifmr=None, verbose=True,
+                 seed=None, precision='double', min_mass=None, mag_limit=None,
+                 mag_limit_filter=None):
+        self.n_systems = int(n_systems)
+        
+        ResolvedCluster.__init__(self, iso, imf, cluster_mass, ifmr=ifmr, verbose=verbose,
+                                 seed=seed, precision=precision, min_mass=min_mass,
+                                 mag_limit=mag_limit, mag_limit_filter=mag_limit_filter)
+
+        return
+
+    def _setup_systems_table(self):
+        star_systems, companions = next(self.iter_chunks())
+
+        self.star_systems = star_systems
+        
+        if self.imf.make_multiples:
+            self.companions = companions
+        return
+
+    def iter_chunks(self, raw=False):
+        """
+        Make the weighted systems as one chunk (see ResolvedCluster.iter_chunks),
+        e.g. for ResolvedCluster.reduce.
+        """
+        mass, isMulti, compMass, sysMass, weight = self.imf.generate_weighted(self.cluster_mass,
+                                                                              self.n_systems,
+                                                                              seed=self.rng,
+                                                                              min_mass=self.min_mass)
+        
+        star_systems, companions = self._make_systems_columns(mass, isMulti, compMass, sysMass,
+                                                              system_columns={'weight': weight})
+
+        if not raw:
+            star_systems = self._add_unresolved_meta(columns_to_table(star_systems))
+            if companions is not None:
+                companions = self._companions_to_table(companions)
+
+        yield star_systems, companions
+
 class ResolvedClusterDiffRedden(ResolvedCluster):
     """
     Sub-class of ResolvedCluster that applies differential
@@ -528,30 +1018,63 @@ class ResolvedClusterDiffRedden(ResolvedCluster):
         in terms of magnitudes of extinction in the Ks filter. Specifically,
         delta_AKs defines the standard deviation of a Gaussian distribution 
         from which the delta_AKs values will be drawn from for each individual
-        system.
+        system. If the isochrone has photometry on an AKs grid 
+        (the IsochronePhot AKs_grid parameter), the magnitudes are
+        interpolated to the extinction of each system (see 
+        ResolvedCluster.set_extinction). Otherwise, the magnitudes of
+        all stars are shifted by the differential reddening of Vega.
 
     ifmr: ifmr object or None
         If ifmr object is defined, will create compact remnants
         produced by the cluster at the given isochrone age. Otherwise,
         no compact remnants are produced.
 
-    seed: int
+    seed: int, numpy.random.SeedSequence, or numpy.random.Generator
         If set to non-None, all random sampling will be seeded with the
-        specified seed, forcing identical output.
+        specified seed, forcing identical output. Each cluster draws
+        its random numbers from its own numpy Generator (see 
+        spisea.utils.rng.get_rng) rather than the global np.random state,
+        so clusters can be made in parallel threads or processes.
         Default None
 
     vebose: boolean
         True for verbose output.
+
+    precision: 'double' or 'single'
+        Precision of the star_systems and companions columns 
+        (see ResolvedCluster).
+        Default 'double'
+
+    min_mass, mag_limit, mag_limit_filter: 
+        Only make the systems above a mass cut, or brighter than a
+        magnitude limit (see ResolvedCluster). The magnitude limit 
+        applies to the isochrone magnitudes, before the differential 
+        extinction.
+        Default None
     """
     def __init__(self, iso, imf, cluster_mass, deltaAKs,
-                 ifmr=None, verbose=False, seed=None):
+                 ifmr=None, verbose=False, seed=None, precision='double',
+                 min_mass=None, mag_limit=None, mag_limit_filter=None):
 
         ResolvedCluster.__init__(self, iso, imf, cluster_mass, ifmr=ifmr, verbose=verbose,
-                                     seed=seed)
-
-        # Set random seed, if desired
-        if seed is not None:
-            np.random.seed(seed=seed)
+                                     seed=seed, precision=precision, min_mass=min_mass,
+                                     mag_limit=mag_limit, mag_limit_filter=mag_limit_filter)
+
+        # If the isochrone has photometry on an AKs grid, interpolate
+        # each system to its own extinction. Extinctions outside of
+        # the grid are moved to its edges.
+        if self.AKs_grid is not None:
+            rand_red = self.rng.standard_normal(len(self.star_systems))
+            final_AKs = iso.points.meta['AKS'] + deltaAKs * rand_red
+            
+            out = (final_AKs < self.AKs_grid.min()) | (final_AKs > self.AKs_grid.max())
+            if out.sum() > 0:
+                print('WARNING: {0} systems with AKs outside of the AKs grid'.format(out.sum()))
+            final_AKs = np.clip(final_AKs, self.AKs_grid.min(), self.AKs_grid.max())
+            
+            self.set_extinction(final_AKs)
+            
+            return
 
         # Extract the extinction law from the isochrone object
         redlaw_str = iso.points.meta['REDLAW']
@@ -565,18 +1088,16 @@ class ResolvedClusterDiffRedden(ResolvedCluster):
         red_vega_lo = vega * red_law.reddening(AKs).resample(vega.wave)
         red_vega_hi = vega * red_law.reddening(AKs + deltaAKs).resample(vega.wave)
 
-        for filt in self.filt_names:
-            obs_str = get_obs_str(filt)
-            filt_info = get_filter_info(obs_str)
-            
-            mag_lo = mag_in_filter(red_vega_lo, filt_info)
-            mag_hi = mag_in_filter(red_vega_hi, filt_info)
-            delta_red_filt[filt] = mag_hi - mag_lo
+        filt_info = [get_filter_info(get_obs_str(filt)) for filt in self.filt_names]
+        mag_red = mags_in_filters([red_vega_lo, red_vega_hi], filt_info)
+
+        for ff, filt in enumerate(self.filt_names):
+            delta_red_filt[filt] = mag_red[1, ff] - mag_red[0, ff]
 
         # Perturb all of star systems' photometry by a random amount corresponding to
         # differential de-reddening. The distribution is normal with a width of
         # Aks +/- deltaAKs in each filter
-        rand_red = np.random.randn(len(self.star_systems))
+        rand_red = self.rng.standard_normal(len(self.star_systems))
 
         for filt in self.filt_names:
             self.star_systems[filt] += rand_red * delta_red_filt[filt]
@@ -599,12 +1120,12 @@ class ResolvedClusterDiffRedden(ResolvedCluster):
     
 class CustomResolvedCluster(ResolvedCluster):
     def __init__(self,star_cluster_table, iso,multiplicity = 'table',
-                     ifmr=None, verbose=True, seed=None):
+                     ifmr=None, verbose=True, seed=None, precision='double'):
         self.custom_table = star_cluster_table
         dummy_imf = imf.IMF( multiplicity = multiplicity )
         ResolvedCluster.__init__(self,iso,dummy_imf,
                             cluster_mass=star_cluster_table['systemMass'].sum(),
-                            verbose=verbose)
+                            verbose=verbose, precision=precision)
 
         ##Make multiples since was skipped in ResolvedCluster.__init__ due to 
         ## imf == None
@@ -653,17 +1174,23 @@ class CustomResolvedCluster(ResolvedCluster):
         #####
         # Save our arrays to the object
         #####
-        self.star_systems = star_systems
+        self.star_systems = self._apply_precision(star_systems)
         
         if self.imf.make_multiples:
-            self.companions = companions
+            self.companions = self._apply_precision(companions)
         return
 
-class UnresolvedCluster(Cluster):
+class ClusterEnsemble(object):
     """
-    Cluster sub-class that produces an *unresolved* stellar cluster.
-    Output is a combined spectrum that is the sum of the individual 
-    spectra of the cluster stars.
+    Many realizations of a ResolvedCluster with the same isochrone,
+    IMF, IFMR and cluster mass (e.g. for Monte Carlo studies). The
+    isochrone interpolators are made once, and shared by all of
+    the realizations (see ResolvedCluster.make_realization).
+
+    Each realization has its own random number generator, spawned 
+    from the seed of the ensemble (with numpy.random.SeedSequence). So
+    the realizations are the same whether they are made one at a time
+    or in parallel processes.
 
     Parameters
     -----------
@@ -674,84 +1201,576 @@ class UnresolvedCluster(Cluster):
         SPISEA IMF object
 
     cluster_mass: float
-        Total initial mass of the cluster, in M_sun
+        Total initial mass of each cluster, in M_sun
 
-    wave_range: 2-element array
-        Define the minumum and maximum wavelengths of the final
-        output spectrum, in Angstroms. Array should be [min_wave, max_wave]
+    ifmr: ifmr object or None
+        If ifmr object is defined, will create compact remnants
+        produced by the cluster at the given isochrone age. Otherwise,
+        no compact remnants are produced.
+
+    seed: int or None
+        If set to non-None, the ensemble is identical for the same seed.
+        Default None
+
+    chunk_mass: float or None
+        Sample the IMF of each realization in chunks (see ResolvedCluster).
+        Default None
+
+    precision: 'double' or 'single'
+        Precision of the tables of each realization (see ResolvedCluster).
+        Default 'double'
 
     vebose: boolean
         True for verbose output.
     """
-    def __init__(self, iso, imf, cluster_mass,
-                 wave_range=[3000, 52000], verbose=False):
-        # Doesn't do much.
-        Cluster.__init__(self, iso, imf, cluster_mass, verbose=verbose)
-        
-        # Sample a power-law IMF randomly
-        self.mass, isMulti, compMass, sysMass = imf.generate_cluster(cluster_mass)
-        
-        temp = np.zeros(len(self.mass), dtype=float)
-        self.mass_all = np.zeros(len(self.mass), dtype=float)
-        self.spec_list = [None] * len(self.mass)
-        # placeholder array to make spectrum summing more efficient
-        spec_list_np = np.zeros(shape=(len(iso.spec_list[0].flux),len(self.mass)), dtype=float)
-        self.spec_list_trim = [None] * len(self.mass)
-        # same as spec_list_np, but for the wavelength-trimmed spectra
-        trimtmp = spectrum.trimSpectrum(iso.spec_list[0],wave_range[0],wave_range[1])
-        trimx = len(trimtmp._fluxtable)
-        spec_list_trim_np = np.zeros(shape=(trimx,len(self.mass)), dtype=float)
+    def __init__(self, iso, imf, cluster_mass, ifmr=None, seed=None,
+                 chunk_mass=None, verbose=False, precision='double'):
+        self.cluster = ResolvedCluster(iso, imf, cluster_mass, ifmr=ifmr, verbose=verbose,
+                                       chunk_mass=chunk_mass, stream=True,
+                                       precision=precision)
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.n_made = 0
 
-        t1 = time.time()
-        for ii in range(len(self.mass)):
-            # Find the closest model mass (returns None, if nothing with dm = 0.1
-            mdx = match_model_mass(iso.points['mass'], self.mass[ii])
-            if mdx == None:
-                continue
+        return
 
-            # getting the temp, mass, spectrum of the matched star
-            temp[ii] = iso.points['Teff'][mdx]
-            self.mass_all[ii] = iso.points['mass'][mdx]
-            tmpspec = iso.spec_list[mdx]
-
-            # resampling the matched spectrum to a common wavelength grid
-            tmpspec = spectrum.CompositeSourceSpectrum.tabulate(tmpspec)
-            tmpspecresamp = spectrum.TabularSourceSpectrum.resample(tmpspec,iso.spec_list[0].wave)
-            self.spec_list[ii] = tmpspecresamp
-            spec_list_np[:,ii]=np.asarray(tmpspecresamp._fluxtable)
-
-            # and trimming to the requested wavelength range
-            tmpspectrim = spectrum.trimSpectrum(tmpspecresamp,wave_range[0],wave_range[1])
-            self.spec_list_trim[ii] = tmpspectrim
-            spec_list_trim_np[:,ii] = np.asarray(tmpspectrim._fluxtable)
-            
+    def _spawn_seeds(self, n_realizations):
+        """
+        Seeds of the next n_realizations. Making more realizations
+        continues the sequence of seeds.
+        """
+        seeds = self.seed_seq.spawn(n_realizations)
+        self.n_made += n_realizations
+        
+        return seeds
 
-        t2 = time.time()
-        print( 'Mass matching took {0:f} s.'.format(t2-t1))
+    def iter_realizations(self, n_realizations, n_proc=1):
+        """
+        Make n_realizations clusters, one at a time.
 
-        # Get rid of the bad ones
-        idx = np.where(temp != 0)[0]
-        cdx = np.where(temp == 0)[0]
+        Parameters
+        ----------
+        n_realizations: int
+            Number of realizations.
+
+        n_proc: int
+            Number of processes. If larger than 1, the realizations 
+            are made in a process pool (in the same order).
+
+        Yields
+        ------
+        star_systems, companions: astropy Table
+            The tables of each realization. companions is None if the
+            IMF doesn't make multiples.
+        """
+        seeds = self._spawn_seeds(n_realizations)
 
-        self.mass_all = self.mass_all[idx]
-        self.spec_list = [self.spec_list[iidx] for iidx in idx]
-        spec_list_np = spec_list_np[:,idx]
-        self.spec_list_trim = [self.spec_list_trim[iidx] for iidx in idx]
-        spec_list_trim_np = spec_list_trim_np[:,idx]
+        if n_proc > 1:
+            pool = multiprocessing.Pool(processes=n_proc, initializer=_init_ensemble_worker,
+                                        initargs=(self.cluster,))
+            results = pool.imap(_make_ensemble_realization, seeds)
+        else:
+            pool = None
+            results = (_make_realization_tables(self.cluster, seed) for seed in seeds)
 
-        self.spec_tot_full = np.sum(spec_list_np,1)
+        try:
+            for result in results:
+                yield result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def generate(self, n_realizations, n_proc=1, concatenate=False):
+        """
+        Make n_realizations clusters.
 
-        t3 = time.time()
-        print( 'Spec summing took {0:f}s'.format(t3-t2))
+        Parameters
+        ----------
+        n_realizations: int
+            Number of realizations.
+
+        n_proc: int
+            Number of processes. If larger than 1, the realizations 
+            are made in a process pool.
+
+        concatenate: boolean
+            If True, return one star_systems and one companions table
+            with all of the realizations, with a 'realization' column
+            (the system_idx of the companions refers to the concatenated
+            star_systems). Otherwise, return a list of tables.
+
+        Returns
+        -------
+        star_systems, companions: list of astropy Tables, or astropy Tables
+            companions is None if the IMF doesn't make multiples.
+        """
+        realizations = list(self.iter_realizations(n_realizations, n_proc=n_proc))
+
+        star_systems = [real[0] for real in realizations]
+        companions = [real[1] for real in realizations]
+        if not self.cluster.imf.make_multiples:
+            companions = None
+
+        if not concatenate:
+            return star_systems, companions
+
+        first = self.n_made - n_realizations
+        N_systems = 0
+        for ii in range(n_realizations):
+            star_systems[ii]['realization'] = first + ii
+            
+            if companions is not None:
+                companions[ii]['realization'] = first + ii
+                companions[ii]['system_idx'] += N_systems
+                
+            N_systems += len(star_systems[ii])
+
+        star_systems = vstack(star_systems, metadata_conflicts='silent')
+        if companions is not None:
+            companions = vstack(companions, metadata_conflicts='silent')
+            
+        return star_systems, companions
+
+    def reduce(self, n_realizations, reducers, n_proc=1):
+        """
+        Make n_realizations clusters and update reducers (see 
+        ClusterReducer) with each one, without keeping the realizations.
+        So the memory used is that of one realization (or one chunk, 
+        with chunk_mass and n_proc = 1), for any n_realizations.
+
+        Parameters
+        ----------
+        n_realizations: int
+            Number of realizations.
+
+        reducers: list of ClusterReducer objects
+            The statistics to accumulate.
+
+        n_proc: int
+            Number of processes. If larger than 1, the realizations 
+            are made in a process pool, and reduced as they are done.
+
+        Returns
+        -------
+        reducers: list of ClusterReducer objects
+            The updated reducers.
+        """
+        if (n_proc > 1) or (self.cluster.chunk_mass is None):
+            for star_systems, companions in self.iter_realizations(n_realizations, n_proc=n_proc):
+                for reducer in reducers:
+                    reducer.update(star_systems, companions)
+        else:
+            for seed in self._spawn_seeds(n_realizations):
+                real = self.cluster.make_realization(seed, stream=True)
+                real.reduce(reducers)
+
+        return reducers
+
+class ClusterReducer(object):
+    """
+    Base class of the cluster reducers, which accumulate statistics
+    of clusters one table (or chunk) at a time, so that the tables don't
+    have to be kept in memory (see ClusterEnsemble.reduce and 
+    ResolvedCluster.reduce). 
+
+    Sub-classes define update(star_systems, companions), which adds
+    the stars in the tables to the statistics, and merge(other), which 
+    adds the statistics of another reducer of the same kind.
+    """
+    def update(self, star_systems, companions=None):
+        raise NotImplementedError()
+
+    def merge(self, other):
+        raise NotImplementedError()
+
+    def _get_tables(self, star_systems, companions):
+        """
+        Tables to use: the star systems and, if desired, the companions.
+        """
+        tables = [star_systems]
+        if self.companions and (companions is not None):
+            tables.append(companions)
+
+        return tables
+
+    def _get_weights(self, table):
+        """
+        Weight of each star (see WeightedResolvedCluster), or None
+        without a weight_column.
+        """
+        if self.weight_column is None:
+            return None
+
+        return np.array(table[self.weight_column], dtype=float)
+
+class HistogramReducer(ClusterReducer):
+    """
+    Histogram of the star systems in any number of columns, e.g. 
+    a luminosity function or a color-magnitude diagram.
+
+    Parameters
+    ----------
+    columns: list
+        Each element is the name of a column (e.g. 'm_nirc2_Kp'),
+        or a pair of column names for their difference (e.g. 
+        ('m_nirc2_J', 'm_nirc2_Kp') for the J-Kp color).
+
+    bins: list of arrays
+        The bin edges of each column.
+
+    companions: boolean
+        If True, the companions are also added to the histogram (they
+        must have the columns). Otherwise, only the star systems are used.
+        Default False
+
+    weight_column: str or None
+        If set, each star is counted with the weight in this column 
+        (e.g. 'weight' for a WeightedResolvedCluster).
+        Default None
+
+    Attributes
+    ----------
+    hist: array
+        The number of stars in each bin.
+    """
+    def __init__(self, columns, bins, companions=False, weight_column=None):
+        self.columns = columns
+        self.bins = [np.asarray(edges, dtype=float) for edges in bins]
+        self.companions = companions
+        self.weight_column = weight_column
+
+        if len(self.columns) != len(self.bins):
+            raise ValueError('HistogramReducer: need the bins of each column')
+
+        self.hist = np.zeros([len(edges) - 1 for edges in self.bins], dtype=float)
+
+        return
+
+    def _get_values(self, table, column):
+        if isinstance(column, str):
+            return np.array(table[column], dtype=float)
+        else:
+            return np.array(table[column[0]], dtype=float) - np.array(table[column[1]], dtype=float)
+
+    def update(self, star_systems, companions=None):
+        for table in self._get_tables(star_systems, companions):
+            values = np.column_stack([self._get_values(table, column) for column in self.columns])
+            hist, edges = np.histogramdd(values, bins=self.bins, weights=self._get_weights(table))
+            self.hist += hist
+
+        return
+
+    def merge(self, other):
+        self.hist += other.hist
+
+        return
+
+class PhaseReducer(ClusterReducer):
+    """
+    Number of stars and the sum of columns (e.g. the current mass)
+    for each evolutionary phase code, e.g. to count the compact
+    remnants (101 = WD, 102 = NS, 103 = BH) and their total mass.
+
+    Parameters
+    ----------
+    sum_columns: list of str
+        Columns to sum for each phase.
+        Default ['mass_current']
+
+    companions: boolean
+        If True, the companions are also counted. 
+        Default True
+
+    weight_column: str or None
+        If set, each star is counted with the weight in this column 
+        (e.g. 'weight' for a WeightedResolvedCluster), so the counts
+        and sums are weighted.
+        Default None
+
+    Attributes
+    ----------
+    counts: dict
+        Number of stars of each phase.
+
+    sums: dict
+        For each column in sum_columns, a dict with the sum of the
+        column for each phase.
+    """
+    def __init__(self, sum_columns=['mass_current'], companions=True, weight_column=None):
+        self.sum_columns = sum_columns
+        self.companions = companions
+        self.weight_column = weight_column
+        self.counts = {}
+        self.sums = {col: {} for col in sum_columns}
+
+        return
+
+    def update(self, star_systems, companions=None):
+        for table in self._get_tables(star_systems, companions):
+            # Stars without a phase are nan (or -99 with precision='single').
+            phase = np.array(table['phase'], dtype=float)
+            good = np.isfinite(phase) & (phase != -99)
+            
+            weights = self._get_weights(table)
+            if weights is None:
+                weights = np.ones(len(phase))
+            weights = weights[good]
+            
+            phases, pdx = np.unique(phase[good].astype(int), return_inverse=True)
+            counts = np.bincount(pdx, weights=weights, minlength=len(phases))
+            sums = {col: np.bincount(pdx, weights=weights * np.nan_to_num(np.array(table[col], dtype=float)[good]),
+                                     minlength=len(phases))
+                    for col in self.sum_columns}
+
+            for pp, phase_code in enumerate(phases):
+                phase_code = int(phase_code)
+                count = int(counts[pp]) if self.weight_column is None else counts[pp]
+                self.counts[phase_code] = self.counts.get(phase_code, 0) + count
+                for col in self.sum_columns:
+                    self.sums[col][phase_code] = self.sums[col].get(phase_code, 0.0) + sums[col][pp]
+
+        return
+
+    def merge(self, other):
+        for phase_code, count in other.counts.items():
+            self.counts[phase_code] = self.counts.get(phase_code, 0) + count
+        for col in self.sum_columns:
+            for phase_code, val in other.sums[col].items():
+                self.sums[col][phase_code] = self.sums[col].get(phase_code, 0.0) + val
+
+        return
+
+def _make_realization_tables(cluster, seed):
+    """
+    Make a realization of cluster (see ResolvedCluster.make_realization)
+    and return its tables.
+    """
+    real = cluster.make_realization(seed)
+    companions = real.companions if real.imf.make_multiples else None
+    
+    return real.star_systems, companions
+
+# The cluster shared by the ensemble workers (see ClusterEnsemble)
+_ensemble_cluster = None
+
+def _init_ensemble_worker(cluster):
+    """
+    Set the cluster of a ClusterEnsemble process pool worker, so it
+    is only sent to each process once.
+    """
+    global _ensemble_cluster
+    _ensemble_cluster = cluster
+
+    return
+
+def _make_ensemble_realization(seed):
+    """
+    Make a realization of the cluster of the ClusterEnsemble worker.
+    """
+    return _make_realization_tables(_ensemble_cluster, seed)
+
+class UnresolvedCluster(Cluster):
+    """
+    Cluster sub-class that produces an *unresolved* stellar cluster.
+    Output is a combined spectrum that is the sum of the individual 
+    spectra of the cluster stars.
+
+    Parameters
+    -----------
+    iso: isochrone object
+        SPISEA isochrone object
+    
+    imf: imf object
+        SPISEA IMF object
 
-        self.spec_trim = np.sum(spec_list_trim_np,1)
-        self.wave_trim = self.spec_list_trim[0].wave
+    cluster_mass: float
+        Total initial mass of the cluster, in M_sun
+
+    wave_range: 2-element array
+        Define the minumum and maximum wavelengths of the final
+        output spectrum, in Angstroms. Array should be [min_wave, max_wave]
+
+    vebose: boolean
+        True for verbose output.
+
+    integrate: boolean
+        If True, the spectrum is the expectation value of the cluster
+        spectrum rather than the spectrum of one random draw of stars:
+        the spectrum of each isochrone star is weighted by the number of 
+        stars that the IMF has in the masses matched to it (the masses 
+        closest to it, within 10%, as in match_model_mass). As in the
+        sampled cluster, the IMF is normalized so that the expected 
+        system mass (including the companions, see imf.int_system_mass)
+        is cluster_mass. The cost doesn't depend on cluster_mass. The
+        expected number of stars of each isochrone point is saved in 
+        iso_numbers. As in the sampled spectrum, the light of the 
+        companions is not included.
+        Default False
+
+    keep_spectra: boolean
+        If True (and integrate is False), keep the spectrum of each 
+        star in spec_list and spec_list_trim. The stars matched to the 
+        same isochrone star share the same spectrum object. Otherwise,
+        only the number of stars matched to each isochrone star is kept
+        (iso_numbers), and the memory used doesn't depend on the 
+        number of stars.
+        Default False
+
+    seed: int, numpy.random.SeedSequence, or numpy.random.Generator
+        Seed of the random sampling of the stars (see Cluster).
+        Default None
+    """
+    def __init__(self, iso, imf, cluster_mass,
+                 wave_range=[3000, 52000], verbose=False, integrate=False,
+                 keep_spectra=False, seed=None):
+        # Doesn't do much.
+        Cluster.__init__(self, iso, imf, cluster_mass, verbose=verbose, seed=seed)
+        self.integrate = integrate
+        self.keep_spectra = keep_spectra
+
+        if integrate:
+            self._integrate_imf(wave_range)
+        else:
+            self._sample_imf(wave_range)
+
+        if self.verbose:
+            print( 'Total cluster mass is {0:f} M_sun'.format(self.mass_tot))
+
+        return
+
+    def _iso_spectra(self, wave_range):
+        """
+        Resample the spectrum of each isochrone star to a common wavelength
+        grid (of the first one), and trim it to wave_range. Returns the
+        (N_wave x N_iso) and (N_trim x N_iso) flux arrays, the 
+        trimmed wavelengths, and the lists of the resampled and 
+        trimmed spectra.
+        """
+        wave = self.iso.spec_list[0].wave
+        N_iso = len(self.iso.points)
+        spec_np = None
+        spec_objs = [None] * N_iso
+        spec_trim_objs = [None] * N_iso
         
-        t4 = time.time()
-        print( 'Spec trimming took {0:f}s'.format(t4-t3))
+        for mdx in range(N_iso):
+            tmpspec = spectrum.CompositeSourceSpectrum.tabulate(self.iso.spec_list[mdx])
+            tmpspecresamp = spectrum.TabularSourceSpectrum.resample(tmpspec, wave)
+            tmpspectrim = spectrum.trimSpectrum(tmpspecresamp, wave_range[0], wave_range[1])
+            spec_objs[mdx] = tmpspecresamp
+            spec_trim_objs[mdx] = tmpspectrim
+
+            if spec_np is None:
+                spec_np = np.zeros((len(tmpspecresamp._fluxtable), N_iso), dtype=float)
+                spec_trim_np = np.zeros((len(tmpspectrim._fluxtable), N_iso), dtype=float)
+                wave_trim = tmpspectrim.wave
+
+            spec_np[:, mdx] = np.asarray(tmpspecresamp._fluxtable)
+            spec_trim_np[:, mdx] = np.asarray(tmpspectrim._fluxtable)
+
+        return spec_np, spec_trim_np, wave_trim, spec_objs, spec_trim_objs
+
+    def _iso_mass_bins(self):
+        """
+        Range of the stellar masses that are matched to each isochrone
+        point: the masses closest to it (between the midpoints to its 
+        neighbors), within 10% (as in match_model_mass).
+        """
+        mass = np.array(self.iso.points['mass'], dtype=float)
+        sdx = np.argsort(mass)
+        mass_s = mass[sdx]
+
+        mid = (mass_s[1:] + mass_s[:-1]) / 2.0
+        lo = np.maximum(np.concatenate([[0.0], mid]), mass_s / 1.1)
+        hi = np.minimum(np.concatenate([mid, [np.inf]]), mass_s / 0.9)
+
+        # Back to the order of the isochrone
+        bin_lo = np.empty(len(mass))
+        bin_hi = np.empty(len(mass))
+        bin_lo[sdx] = lo
+        bin_hi[sdx] = hi
+
+        return bin_lo, bin_hi
+
+    def _integrate_imf(self, wave_range):
+        """
+        Make the expectation value of the cluster spectrum by integrating
+        the IMF over the mass bin of each isochrone point 
+        (see the integrate parameter).
+        """
+        # Normalize the IMF to the cluster mass (as in imf.generate_cluster)
+        if (self.imf._mass_limits[-1] > self.cluster_mass):
+            self.imf._mass_limits[-1] = self.cluster_mass
+        self.imf.normalize(self.cluster_mass)
+        m_min = float(self.imf.norm_Mmin)
+        m_max = float(self.imf.norm_Mmax)
+
+        bin_lo, bin_hi = self._iso_mass_bins()
+        bin_lo = np.clip(bin_lo, m_min, m_max)
+        bin_hi = np.clip(bin_hi, bin_lo, m_max)
+
+        # Expected number and mass of the stars of each isochrone point.
+        # Stars without a Teff are left out, as in the sampled spectrum.
+        # The IMF is normalized to the primary mass, while generate_cluster
+        # fills cluster_mass with the system mass (including the companions).
+        good = np.array(self.iso.points['Teff']) != 0
+        scale = self.cluster_mass / self.imf.int_system_mass(m_min, m_max)
+        self.iso_numbers = np.where(good, self.imf.int_xi(bin_lo, bin_hi), 0.0) * scale
+        iso_mass = np.where(good, self.imf.int_system_mass(bin_lo, bin_hi, n_grid=20), 0.0) * scale
+
+        # The cluster spectrum is one matrix-vector product.
+        spec_np, spec_trim_np, self.wave_trim = self._iso_spectra(wave_range)[:3]
+        self.spec_tot_full = spec_np.dot(self.iso_numbers)
+        self.spec_trim = spec_trim_np.dot(self.iso_numbers)
+
+        self.mass_tot = iso_mass.sum()
+
+        return
+
+    def _sample_imf(self, wave_range):
+        """
+        Make the spectrum of one random draw of the cluster stars. Each
+        star is matched to the closest isochrone mass (within 10%), and 
+        the spectra of the isochrone stars are summed, weighted by the 
+        number of stars matched to each one. So the memory used scales 
+        with the length of the isochrone, not the number of stars.
+        """
+        # Sample a power-law IMF randomly
+        self.mass, isMulti, compMass, sysMass = self.imf.generate_cluster(self.cluster_mass, seed=self.rng)
+
+        t1 = time.time()
+        
+        # Find the closest model mass of all stars at once (-1 if nothing with dm = 0.1)
+        mdx = match_model_masses(np.array(self.iso.points['mass']), self.mass)
+        
+        # Get rid of the bad ones
+        temp = np.where(mdx >= 0, np.array(self.iso.points['Teff'])[mdx], 0)
+        idx = np.where(temp != 0)[0]
+        mdx = mdx[idx]
+        
+        self.mass_all = np.array(self.iso.points['mass'])[mdx]
+
+        # Number of stars matched to each isochrone star
+        self.iso_numbers = np.bincount(mdx, minlength=len(self.iso.points)).astype(float)
+
+        t2 = time.time()
+        if self.verbose:
+            print( 'Mass matching took {0:f} s.'.format(t2-t1))
+
+        spec_np, spec_trim_np, self.wave_trim, spec_objs, spec_trim_objs = self._iso_spectra(wave_range)
+        self.spec_tot_full = spec_np.dot(self.iso_numbers)
+        self.spec_trim = spec_trim_np.dot(self.iso_numbers)
+
+        t3 = time.time()
+        if self.verbose:
+            print( 'Spec summing took {0:f}s'.format(t3-t2))
+
+        # Spectra of the individual stars (shared by the stars 
+        # matched to the same isochrone star)
+        if self.keep_spectra:
+            self.spec_list = [spec_objs[ii] for ii in mdx]
+            self.spec_list_trim = [spec_trim_objs[ii] for ii in mdx]
 
         self.mass_tot = np.sum(sysMass[idx])
-        print( 'Total cluster mass is {0:f} M_sun'.format(self.mass_tot))
 
         return
         
@@ -807,13 +1826,18 @@ class Isochrone(object):
         If true, rebins the atmospheres so that they are the same
         resolution as the Castelli+04 atmospheres. Default is False,
         which is often sufficient synthetic photometry in most cases.
+
+    make_spectra : boolean, optional
+        If true, make the spectrum of each star (spec_list). If false,
+        only the stellar parameters are calculated, e.g. for photometry
+        from the bolometric correction tables. Default is True.
     """
     def __init__(self, logAge, AKs, distance, metallicity=0.0,
                  evo_model=default_evo_model, atm_func=default_atm_func,
                  wd_atm_func = default_wd_atm_func,
                  red_law=default_red_law, mass_sampling=1,
                  wave_range=[3000, 52000], min_mass=None, max_mass=None,
-                 rebin=True):
+                 rebin=True, make_spectra=True):
 
 
         t1 = time.time()
@@ -866,39 +1890,44 @@ class Isochrone(object):
 
         # Initialize output for stellar spectra
         self.spec_list = []
+        self.surf_spectra = None
 
         # For each temperature extract the synthetic photometry.
-        for ii in range(len(tab['Teff'])):
-            # Loop is currently taking about 0.11 s per iteration
-            gravity = float( logg_all[ii] )
-            L = float( L_all[ii].cgs / (units.erg / units.s)) # in erg/s
-            T = float( T_all[ii] / units.K)               # in Kelvin
-            R = float( R_all[ii].to('pc') / units.pc)              # in pc
-            phase = phase_all[ii]
-
-            # Get the atmosphere model now. Wavelength is in Angstroms
-            # This is the time-intensive call... everything else is negligable.
-            # If source is a star, pull from star atmospheres. If it is a WD,
-            # pull from WD atmospheres
-            if phase == 101:
-                star = wd_atm_func(temperature=T, gravity=gravity, metallicity=metallicity,
-                                       verbose=False)
-            else:
-                star = atm_func(temperature=T, gravity=gravity, metallicity=metallicity,
-                                    rebin=rebin)
-
-            # Trim wavelength range down to JHKL range (0.5 - 5.2 microns)
-            star = spectrum.trimSpectrum(star, wave_range[0], wave_range[1])
-
-            # Convert into flux observed at Earth (unreddened)
-            star *= (R / distance)**2  # in erg s^-1 cm^-2 A^-1
-
-            # Redden the spectrum. This doesn't take much time at all.
-            red = red_law.reddening(AKs).resample(star.wave) 
-            star *= red
+        # If make_spectra = False, the photometry comes from the
+        # bolometric correction tables instead (see IsochronePhot).
+        if make_spectra:
+            # Get the atmospheres of all the stars (except for WDs) in one
+            # batch, if possible. Otherwise, they are made one at a time.
+            atm_list = [None] * len(tab)
+            if atm.has_atmosphere_grid(atm_func):
+                idx = np.where(phase_all != 101)[0]
+                atm_batch = atm.get_atmosphere_batch(atm_func, metallicity=metallicity,
+                                                     temperature=np.array(T_all[idx] / units.K),
+                                                     gravity=np.array(logg_all[idx]),
+                                                     rebin=rebin)
+                for ii, star in zip(idx, atm_batch):
+                    atm_list[ii] = star
             
-            # Save the final spectrum to our spec_list for later use.            
-            self.spec_list.append(star)
+            surf_list = []
+            for ii in range(len(tab['Teff'])):
+                gravity = float( logg_all[ii] )
+                T = float( T_all[ii] / units.K)               # in Kelvin
+                phase = phase_all[ii]
+
+                # Get the atmosphere model now, trimmed. This is the
+                # time-intensive call if the atmosphere is not in atm_list.
+                star = make_surface_spectrum(T, gravity, phase, metallicity,
+                                             atm_func=atm_func, wd_atm_func=wd_atm_func,
+                                             wave_range=wave_range, rebin=rebin,
+                                             star=atm_list[ii])
+                surf_list.append(star)
+
+            # Keep the spectra at the stellar surface, so that other extinctions
+            # and distances can be applied later (see IsochronePhot).
+            # Then scale all the spectra to the distance and redden them.
+            self.surf_spectra = SurfaceSpectra.from_spectra(surf_list)
+            self.spec_list = self.surf_spectra.observe(R_all.to('pc').value, distance,
+                                                       AKs, red_law)
 
         # Append all the meta data to the summary table.
         tab.meta['REDLAW'] = red_law.name
@@ -1011,7 +2040,9 @@ class IsochronePhot(Isochrone):
          directory to see if isochrone file already exists; if it 
          does, it will just read the isochrone. If the isochrone 
          file doesn't exist, then save isochrone to the isochrone
-         directory.
+         directory. The files are keyed on all of the parameters
+         below (see IsochroneCache), so one iso_dir can hold
+         isochrones made with different models, filters, etc.
 
     mass_sampling : int, optional
         Sample the raw isochrone every `mass_sampling` steps. The default
@@ -1043,6 +2074,31 @@ class IsochronePhot(Isochrone):
         Define what filters the synthetic photometry
         will be calculated for, via the filter string 
         identifier. 
+
+    bc_dir : path or None, optional
+        If set, make the synthetic photometry from the bolometric
+        correction tables in this directory (see make_bc_tables) 
+        instead of from the spectrum of each star. This is much faster.
+        Default is None.
+
+    cache_size : float or None, optional
+        Maximum total size of the isochrone files in iso_dir, in bytes.
+        If set, the least recently used files are deleted to stay under
+        it. Default is None (no limit).
+
+    save_spectra : boolean, optional
+        If true, save the spectra of the stars at their surface in iso_dir,
+        before they are scaled to the distance and reddened. Isochrones
+        with the same age and models, but another AKs, distance, or
+        reddening law, are then made from these spectra without the
+        atmospheres (see make_from_spectra). Default is True.
+
+    AKs_grid : list or None, optional
+        If set, also save the magnitudes of each star at each of these
+        extinctions (AKs, in magnitudes), as mgrid_<filter> columns with
+        one value per AKs. ResolvedCluster interpolates them to give each star
+        its own extinction (see ResolvedCluster.set_extinction). 
+        Default is None.
     """
     def __init__(self, logAge, AKs, distance,
                  metallicity=0.0,
@@ -1052,206 +2108,837 @@ class IsochronePhot(Isochrone):
                  red_law=default_red_law, mass_sampling=1, iso_dir='./',
                  min_mass=None, max_mass=None, rebin=True, recomp=False,
                  filters=['ubv,U', 'ubv,B', 'ubv,V',
-                          'ubv,R', 'ubv,I']):
+                          'ubv,R', 'ubv,I'], bc_dir=None, cache_size=None,
+                 save_spectra=True, AKs_grid=None):
 
         self.metallicity = metallicity
+        self.red_law = red_law
+        self.AKs_grid = None
+        if AKs_grid is not None:
+            self.AKs_grid = np.sort(np.atleast_1d(AKs_grid).astype(float))
 
         # Make the iso_dir, if it doesn't already exist
         if not os.path.exists(iso_dir):
             os.mkdir(iso_dir)
 
-        # Make and input/output file name for the stored isochrone photometry.
-        # For solar metallicity case, allow for legacy isochrones (which didn't have
-        # metallicity tag since they were all solar metallicity) to be read
-        # properly
-        if metallicity == 0.0:
-            save_file_fmt = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_p00.fits'
-            self.save_file = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5))
-
-            save_file_legacy = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}.fits'
-            self.save_file_legacy = save_file_legacy.format(iso_dir, logAge, AKs, str(distance).zfill(5))
-        else:
-            # Set metallicity flag
-            if metallicity < 0:
-                metal_pre = 'm'
-            else:
-                metal_pre = 'p'
-            metal_flag = int(abs(metallicity)*10)
-            
-            save_file_fmt = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_{4}{5:2s}.fits'
-            self.save_file = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5), metal_pre, str(metal_flag).zfill(2))
-            self.save_file_legacy = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5), metal_pre, str(metal_flag).zfill(2))
+        # Make an input/output file name for the stored isochrone photometry,
+        # keyed on all the parameters that affect the isochrone (see IsochroneCache).
+        params = get_iso_params(logAge, AKs, distance, metallicity=metallicity,
+                                evo_model=evo_model, atm_func=atm_func,
+                                wd_atm_func=wd_atm_func, red_law=red_law,
+                                mass_sampling=mass_sampling, wave_range=wave_range,
+                                min_mass=min_mass, max_mass=max_mass, rebin=rebin,
+                                filters=filters, bc_dir=bc_dir, AKs_grid=self.AKs_grid)
+        
+        self.cache = IsochroneCache(iso_dir, max_size=cache_size)
+        self.cache_params = params
+        self.cache_key = self.cache.get_key(params)
+        self.save_file = self.cache.get_file(self.cache_key, params)
+
+        # The spectra at the stellar surface don't depend on the extinction
+        # or distance, so they are saved separately and shared by all of
+        # the isochrones with the same age and models.
+        self.spec_params = get_spec_params(params)
+        self.spec_key = self.cache.get_key(self.spec_params)
+        self.spec_file = os.path.join(iso_dir, 'spec_{0}.fits'.format(self.spec_key[:16]))
             
         # Expected filters
         self.filters = filters
 
         # Recalculate isochrone if save_file doesn't exist or recomp == True
-        file_exists = self.check_save_file(evo_model, atm_func, red_law)
+        if recomp == True:
+            file_exists = False
+            self.cache.count_miss()
+        else:
+            file_exists = self.check_save_file()
 
-        if (not file_exists) | (recomp==True):
+        if not file_exists:
             self.recalc = True
-            Isochrone.__init__(self, logAge, AKs, distance,
-                               metallicity=metallicity,
-                               evo_model=evo_model, atm_func=atm_func,
-                               wd_atm_func=wd_atm_func,
-                               wave_range=wave_range,
-                               red_law=red_law, mass_sampling=mass_sampling,
-                               min_mass=min_mass, max_mass=max_mass, rebin=rebin)
+
+            # An isochrone that only differs in distance just needs
+            # its magnitudes to be shifted.
+            dist_match = []
+            if recomp == False:
+                dist_match = self.cache.find(params, ignore=['distance'])
+
+            if len(dist_match) > 0:
+                self.make_from_distance(dist_match[0][1], distance)
+                return
+
+            # If an isochrone only differs in filters, only the
+            # missing filters are made.
+            filt_match = []
+            if recomp == False:
+                filt_match = self.cache.find(params, ignore=['filters'])
+
+            if len(filt_match) > 0:
+                if self.add_filters(filt_match, AKs, distance, red_law, bc_dir=bc_dir,
+                                    atm_func=atm_func, wd_atm_func=wd_atm_func,
+                                    rebin=rebin):
+                    return
+
+            # Redden the saved surface spectra, if possible. Otherwise
+            # make the isochrone from scratch (and save its spectra).
+            spec_exists = False
+            if (bc_dir is None) & save_spectra & (recomp == False):
+                spec_exists = self.cache.lookup(self.spec_key) is not None
+
+            if spec_exists:
+                self.make_from_spectra(AKs, distance, red_law)
+            else:
+                Isochrone.__init__(self, logAge, AKs, distance,
+                                   metallicity=metallicity,
+                                   evo_model=evo_model, atm_func=atm_func,
+                                   wd_atm_func=wd_atm_func,
+                                   wave_range=wave_range,
+                                   red_law=red_law, mass_sampling=mass_sampling,
+                                   min_mass=min_mass, max_mass=max_mass, rebin=rebin,
+                                   make_spectra=(bc_dir is None))
+
+                if (bc_dir is None) & save_spectra:
+                    self.surf_spectra.write(self.spec_file, self.points)
+                    self.cache.add(self.spec_key, self.spec_params, self.spec_file)
+                    
             self.verbose = True
+            self.points.meta['CACHEKEY'] = self.cache_key
             
             # Make photometry
-            self.make_photometry(rebin=rebin, vega=vega)
+            if bc_dir is None:
+                self.make_photometry(rebin=rebin, vega=vega)
+            else:
+                self.make_photometry_bc(bc_dir, atm_func=atm_func,
+                                        wd_atm_func=wd_atm_func, red_law=red_law,
+                                        rebin=rebin, vega=vega)
         else:
             self.recalc = False
-            try:
-                self.points = Table.read(self.save_file)
-            except:
-                self.points = Table.read(self.save_file_legacy)
-            # Add some error checking.
+            self.points = Table.read(self.save_file)
+
+        return
+
+    def make_from_distance(self, iso_file, distance):
+        """
+        Make the isochrone from a saved isochrone (iso_file) that 
+        only differs in distance, by adding the distance modulus
+        difference 5 log10(distance / old distance) to the magnitudes.
+        The original file and shift are kept in the meta-data 
+        (DISTSRC, DISTSHFT).
+        """
+        self.points = Table.read(iso_file)
+        self.verbose = False
+
+        dist_shift = 5 * np.log10(distance / self.points.meta['DISTANCE'])
+        for col in self.points.colnames:
+            if col.startswith('m_') | col.startswith('mgrid_'):
+                self.points[col] += dist_shift
+
+        print( 'Isochrone shifted from d = {0} pc to {1} pc'.format(self.points.meta['DISTANCE'],
+                                                                 distance))
+
+        self.points.meta['DISTANCE'] = distance
+        self.points.meta['CACHEKEY'] = self.cache_key
+        self.points.meta['DISTSRC'] = os.path.basename(iso_file)
+        self.points.meta['DISTSHFT'] = dist_shift
+
+        self._save_points()
 
         return
 
-    def make_photometry(self, rebin=True, vega=vega):
+    def add_filters(self, matches, AKs, distance, red_law, bc_dir=None,
+                    atm_func=default_atm_func, wd_atm_func=default_wd_atm_func,
+                    rebin=True):
+        """
+        Make the isochrone from a saved isochrone that only differs in 
+        filters (see IsochroneCache.find), by only making the photometry
+        of the missing filters. The photometry comes from the saved 
+        surface spectra (spec_file) or the BC tables (bc_dir), so no
+        atmospheres are made. The new filters are added after the 
+        ones from the saved isochrone. The saved isochrone file is kept
+        in the meta-data (FILTSRC).
+
+        Returns False (and does nothing) if the missing photometry can't be
+        made this way, i.e. there are no saved spectra.
+        """
+        # Use the saved isochrone with the most requested filters
+        def n_common(match):
+            return len(set(match[2]['filters']) & set(self.filters))
+        
+        key, iso_file, iso_params = max(matches, key=n_common)
+        missing = [filt for filt in self.filters if filt not in iso_params['filters']]
+        
+        if (len(missing) > 0) & (bc_dir is None):
+            if self.cache.lookup(self.spec_key) is None:
+                return False
+
+            self.surf_spectra, spec_points = SurfaceSpectra.read(self.spec_file)
+            radius = spec_points['R'].to('pc').value
+            self.spec_list = self.surf_spectra.observe(radius, distance, AKs, red_law)
+
+        self.points = Table.read(iso_file)
+        self.verbose = False
+
+        # Drop the photometry of the filters that weren't requested
+        keep = [prefix + get_filter_col_name(filt) for filt in self.filters
+                for prefix in ['m_', 'mgrid_']]
+        drop = [col for col in self.points.colnames
+                if (col.startswith('m_') | col.startswith('mgrid_')) and (col not in keep)]
+        self.points.remove_columns(drop)
+
+        print( 'Isochrone from {0}, adding filters {1}'.format(os.path.basename(iso_file),
+                                                              missing))
+        self.points.meta['CACHEKEY'] = self.cache_key
+        self.points.meta['FILTSRC'] = os.path.basename(iso_file)
+
+        if len(missing) == 0:
+            self._save_points()
+        elif bc_dir is None:
+            self.make_photometry(rebin=rebin, vega=vega, filters=missing)
+        else:
+            self.make_photometry_bc(bc_dir, atm_func=atm_func, wd_atm_func=wd_atm_func,
+                                    red_law=red_law, rebin=rebin, vega=vega,
+                                    filters=missing)
+
+        return True
+
+    def make_from_spectra(self, AKs, distance, red_law):
+        """
+        Make the isochrone from the saved spectra at the stellar surface
+        (spec_file) of an isochrone with the same age and models. The
+        spectra of all the stars are scaled to the distance and reddened
+        at once, so only the photometry remains to be done.
+        """
+        t1 = time.time()
+        
+        self.surf_spectra, self.points = SurfaceSpectra.read(self.spec_file)
+
+        radius = self.points['R'].to('pc').value
+        self.spec_list = self.surf_spectra.observe(radius, distance, AKs, red_law)
+
+        self.points.meta['REDLAW'] = red_law.name
+        self.points.meta['AKS'] = AKs
+        self.points.meta['DISTANCE'] = distance
+
+        t2 = time.time()
+        print( 'Isochrone from saved spectra took {0:f} s.'.format(t2-t1))
+        
+        return
+
+    def make_photometry(self, rebin=True, vega=vega, filters=None):
         """ 
         Make synthetic photometry for the specified filters. This function
         udpates the self.points table to include new columns with the
         photometry.
-        
+
+        All of the filters are integrated at once with mags_in_filters,
+        which reproduces mag_in_filter for every star. If filters is set, 
+        only make the photometry for these filters (default is self.filters).
         """
         startTime = time.time()
 
+        if filters is None:
+            filters = self.filters
+
         meta = self.points.meta
 
         print( 'Making photometry for isochrone: log(t) = %.2f  AKs = %.2f  dist = %d' % \
             (meta['LOGAGE'], meta['AKS'], meta['DISTANCE']))
-        print( '     Starting at: ', datetime.datetime.now(), '  Usually takes ~5 minutes')
-
-        npoints = len(self.points)
-        verbose_fmt = 'M = {0:7.3f} Msun  T = {1:5.0f} K  m_{2:s} = {3:4.2f}'
+        print( '     Starting at: ', datetime.datetime.now())
 
-        # Loop through the filters, get filter info, make photometry for
-        # all stars in this filter.
-        for ii in self.filters:
+        # Get filter info for all the filters first.
+        filt_list = []
+        for ii in filters:
             prt_fmt = 'Starting filter: {0:s}   Elapsed time: {1:.2f} seconds'
             print( prt_fmt.format(ii, time.time() - startTime))
             
-            filt = get_filter_info(ii, rebin=rebin, vega=vega)
-            filt_name = get_filter_col_name(ii)
+            filt_list.append(get_filter_info(ii, rebin=rebin, vega=vega))
 
-            # Make the column to hold magnitudes in this filter. Add to points table.
-            col_name = 'm_' + filt_name
-            mag_col = Column(np.zeros(npoints, dtype=float), name=col_name)
-            self.points.add_column(mag_col)
+        # Do the filter integration for all stars and filters together.
+        # These are already extincted, observed spectra.
+        print('Starting synthetic photometry')
+        mags = mags_in_filters(self.spec_list, filt_list)
+
+        # Photometry at each AKs_grid value, from the surface spectra
+        mags_grid = None
+        if self.AKs_grid is not None:
+            radius = self.points['R'].to('pc').value
+            mags_grid = np.stack([self.surf_spectra.get_mags(radius, meta['DISTANCE'], AKs,
+                                                             self.red_law, filt_list)
+                                  for AKs in self.AKs_grid], axis=2)
+
+        meta['PHOTMODE'] = 'SPECTRA'
+        self._add_photometry(mags, startTime, filters, mags_grid=mags_grid)
+
+        return
+
+    def make_photometry_bc(self, bc_dir, atm_func=default_atm_func,
+                           wd_atm_func=default_wd_atm_func,
+                           red_law=default_red_law, rebin=True, vega=vega,
+                           filters=None):
+        """
+        Make synthetic photometry for the specified filters from the
+        bolometric correction tables in bc_dir (see make_bc_tables),
+        instead of from the spectra. This function updates the self.points
+        table to include new columns with the photometry.
+
+        Each star is interpolated between the atmosphere models of the
+        grid used by atm_func, with the same weights as pysynphot.Icat
+        (see atmospheres.get_grid_weights_batch). Since the interpolation is
+        linear in flux, the photometry is the same as make_photometry if
+        the isochrone AKs is in the AKs grid of the tables. Otherwise, the
+        BCs are interpolated linearly in AKs. Only get_merged_atmosphere
+        and the single-grid atmosphere functions are supported. 
+        White dwarfs (phase = 101) still use their spectra.
+        If filters is set, only make the photometry for these filters
+        (default is self.filters).
+        """
+        startTime = time.time()
+
+        if filters is None:
+            filters = self.filters
+
+        meta = self.points.meta
+
+        print( 'Making BC photometry for isochrone: log(t) = %.2f  AKs = %.2f  dist = %d' % \
+            (meta['LOGAGE'], meta['AKS'], meta['DISTANCE']))
+        print( '     Starting at: ', datetime.datetime.now())
+
+        AKs = meta['AKS']
+        distance = meta['DISTANCE']
+        wave_range = [meta['WAVEMIN'], meta['WAVEMAX']]
+        col_names = ['bc_' + get_filter_col_name(filt) for filt in filters]
+
+        teff = np.array(self.points['Teff'])
+        logg = np.array(self.points['logg'])
+        radius = self.points['R'].to('pc').value
+        phase = np.array(self.points['phase'])
+
+        # Make the photometry at AKs, and at each AKs_grid value (if set)
+        AKs_all = [AKs]
+        if self.AKs_grid is not None:
+            AKs_all += list(self.AKs_grid)
+        
+        mags = np.zeros((len(self.points), len(filters), len(AKs_all)), dtype=float)
+
+        # Atmosphere grid of each (non-WD) star
+        star_grids = np.array([atm.get_atmosphere_grid(atm_func, metallicity=self.metallicity,
+                                                       temperature=teff[ii], gravity=logg[ii],
+                                                       rebin=rebin)
+                               for ii in range(len(self.points))], dtype=object)
+        star_grids[phase == 101] = None
+
+        for atm_grid in set(star_grids) - set([None]):
+            idx = np.where(star_grids == atm_grid)[0]
+            
+            bc_tab = get_bc_table(bc_dir, atm_grid, red_law)
+            AKs_grid = bc_tab.meta['AKSGRID']
+
+            # Check that the table matches this isochrone
+            missing = [col for col in col_names if col not in bc_tab.colnames]
+            if len(missing) > 0:
+                raise ValueError('BC table for {0} is missing {1}'.format(atm_grid, missing))
+            if ((bc_tab.meta['WAVEMIN'] != wave_range[0]) |
+                (bc_tab.meta['WAVEMAX'] != wave_range[1]) |
+                (bc_tab.meta['REBIN'] != rebin)):
+                raise ValueError('BC table for {0} has a different wave_range or rebin'.format(atm_grid))
+            if (min(AKs_all) < AKs_grid.min()) | (max(AKs_all) > AKs_grid.max()):
+                raise ValueError('AKs = {0} is outside of the BC table AKs grid'.format(AKs_all))
+
+            # Interpolate all the stars at once. Stars outside of the grid are
+            # moved inside it, like in the atmosphere functions.
+            valid = np.array(bc_tab['valid'])
+            rows, weights, good = atm.get_grid_weights_batch(atm_grid, metallicity=self.metallicity,
+                                                             temperature=teff[idx], gravity=logg[idx],
+                                                             valid=valid, check_bounds=True)
+
+            bc_all = np.stack([np.array(bc_tab[col]).reshape(len(bc_tab), -1) for col in col_names], axis=1)
             
-            # Loop through each star in the isochrone and do the filter integration
-            print('Starting synthetic photometry')
-            for ss in range(npoints):
-                star = self.spec_list[ss]  # These are already extincted, observed spectra.
-                star_mag = mag_in_filter(star, filt)
+            for aa_out, AKs_out in enumerate(AKs_all):
+                # Interpolate the BCs of all the models to AKs
+                if len(AKs_grid) == 1:
+                    bc = bc_all[:, :, 0]
+                else:
+                    aa = np.clip(np.searchsorted(AKs_grid, AKs_out), 1, len(AKs_grid) - 1)
+                    frac = (AKs_out - AKs_grid[aa-1]) / (AKs_grid[aa] - AKs_grid[aa-1])
+                    bc = (1 - frac) * bc_all[:, :, aa-1] + frac * bc_all[:, :, aa]
+
+                # Flux of each model at the stellar surface, relative to
+                # the filter zeropoint
+                with np.errstate(invalid='ignore'):
+                    flux_surf = 10**(-0.4 * (get_mbol_surface(bc_tab['teff'])[:, None] - bc))
+
+                star_flux = np.einsum('ij,ijk->ik', weights, flux_surf[rows])
                 
-                self.points[col_name][ss] = star_mag
-        
-                if (self.verbose and (ss % 100) == 0):
+                with np.errstate(divide='ignore'):
+                    mags[idx, :, aa_out] = -2.5 * np.log10(star_flux) - 5 * np.log10(radius[idx, None] / distance)
+
+        # White dwarfs use the spectra
+        idx = np.where(phase == 101)[0]
+        if len(idx) > 0:
+            filt_list = [get_filter_info(filt, rebin=rebin, vega=vega) for filt in filters]
+            surf_list = [make_surface_spectrum(teff[ii], logg[ii], phase[ii], self.metallicity,
+                                               atm_func=atm_func, wd_atm_func=wd_atm_func,
+                                               wave_range=wave_range, rebin=rebin)
+                         for ii in idx]
+            wd_spectra = SurfaceSpectra.from_spectra(surf_list)
+            
+            for aa_out, AKs_out in enumerate(AKs_all):
+                mags[idx, :, aa_out] = wd_spectra.get_mags(radius[idx], distance, AKs_out,
+                                                           red_law, filt_list)
+
+        meta['PHOTMODE'] = 'BC'
+        mags_grid = mags[:, :, 1:] if (self.AKs_grid is not None) else None
+        self._add_photometry(mags[:, :, 0], startTime, filters, mags_grid=mags_grid)
+
+        return
+
+    def _add_photometry(self, mags, startTime, filters, mags_grid=None):
+        """
+        Add the magnitudes (N_points x N_filters) to the points table
+        and save it. If set, the magnitudes at each AKs_grid value
+        (N_points x N_filters x N_AKs) are added as mgrid_<filter> columns.
+        """
+        npoints = len(self.points)
+        verbose_fmt = 'M = {0:7.3f} Msun  T = {1:5.0f} K  m_{2:s} = {3:4.2f}'
+
+        # Make a column to hold magnitudes in each filter. Add to points table.
+        for ff, ii in enumerate(filters):
+            filt_name = get_filter_col_name(ii)
+            col_name = 'm_' + filt_name
+            mag_col = Column(mags[:, ff], name=col_name)
+            self.points.add_column(mag_col)
+
+            if mags_grid is not None:
+                self.points.add_column(Column(mags_grid[:, ff, :], name='mgrid_' + filt_name))
+
+            if self.verbose:
+                for ss in range(0, npoints, 100):
                     print( verbose_fmt.format(self.points['mass'][ss], self.points['Teff'][ss],
-                                             filt_name, star_mag))
+                                             filt_name, mags[ss, ff]))
+
+        if mags_grid is not None:
+            self.points.meta['AKSGRID'] = ','.join(['{0}'.format(AKs) for AKs in self.AKs_grid])
 
         endTime = time.time()
         print( '      Time taken: {0:.2f} seconds'.format(endTime - startTime))
 
-        if self.save_file != None:
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                self.points.write(self.save_file, overwrite=True)
+        self._save_points()
 
         return
 
-    def check_save_file(self, evo_model, atm_func, red_law):
+    def _save_points(self):
         """
-        Check to see if save_file exists, as saved by the save_file 
-        and save_file_legacy objects. If the filename exists, check the 
-        meta-data as well.
+        Save the points table to save_file and add it to the cache. 
+        The table is written to a temporary file first, so that save_file
+        is never left half-written.
+        """
+        if self.save_file == None:
+            return
+        
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.save_file)),
+                                        suffix='.fits')
+        os.close(fd)
+        
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.points.write(tmp_file, overwrite=True)
+        os.replace(tmp_file, self.save_file)
+
+        self.cache.add(self.cache_key, self.cache_params, self.save_file)
+
+        return
+
+    def check_save_file(self):
+        """
+        Check to see if save_file exists in the isochrone cache, i.e. 
+        an isochrone was made with the same parameters (see IsochroneCache).
 
         returns a boolean: True is file exists, false otherwise
         """
-        out_bool = False
+        return self.cache.lookup(self.cache_key) is not None
+
+    def plot_CMD(self, mag1, mag2, savefile=None):
+        """
+        Make a CMD with mag1 vs mag1 - mag2
+
+        Parameters
+        ----------
+        mag1 : string
+            The name of the first magnitude column to be plotted.
+        mag2 : string
+            The name of the second magnitude column to be plotted.
+        savefile : string (default None)
+            If a savefile is specified, then the plot will be saved to that file. 
+        """
+        plt.clf()
+        plt.plot(self.points[mag1] - self.points[mag2], self.points[mag1],
+                 color='black', linestyle='solid', marker='+')
+        plt.gca().invert_yaxis()
+        plt.xlabel(mag1 + ' - ' + mag2 + ' (mag)')
+        plt.ylabel(mag1 + ' (mag)')
+        
+        fmt_title = 'logAge={0:.2f}, d={1:.2f} kpc, AKs={2:.2f}'
+        plt.title(fmt_title.format(self.points.meta['LOGAGE'],
+                                  self.points.meta['DISTANCE']/1e3,
+                                  self.points.meta['AKS']))
+
+        if savefile != None:
+            plt.savefig(savefile)
         
-        if os.path.exists(self.save_file) | os.path.exists(self.save_file_legacy):
+        return
+
+    def plot_mass_magnitude(self, mag, savefile=None):
+        """
+        Make a standard mass-luminosity relation plot for this isochrone.
+        
+        Parameters
+        ----------
+        mag : string
+            The name of the magnitude column to be plotted.
+        savefile : string (default None)
+            If a savefile is specified, then the plot will be saved to that file. 
+        """
+        plt.clf()
+        plt.semilogx(self.points['mass'], self.points[mag], 'k.')
+        plt.gca().invert_yaxis()
+        plt.xlabel(r'Mass (M$_\odot$)')
+        plt.ylabel(mag + ' (mag)')
+        
+        fmt_title = 'logAge={0:.2f}, d={1:.2f} kpc, AKs={2:.2f}'
+        plt.title(fmt_title.format(self.points.meta['LOGAGE'],
+                                  self.points.meta['DISTANCE']/1e3,
+                                  self.points.meta['AKS']))
+        
+        if savefile != None:
+            plt.savefig(savefile)
+        
+        return
+
+#===================================================#
+# Iso table: same as IsochronePhot object, but doesn't do reddening application
+# or photometry automatically. These are separate functions on the object.
+# NOTE: THIS CLASS IS DEPRECATED, DO NOT USE!
+#===================================================#
+# Version of the isochrone files. Changing it invalidates
+# all of the cached isochrones (see get_iso_params).
+iso_cache_version = 1
+
+# Cache of the model file fingerprints, keyed on path.
+_model_fingerprints = {}
+
+def get_model_fingerprint(paths):
+    """
+    Return a fingerprint (hash) of the model files under paths (files or
+    directories), made from the name, size, and modification time of
+    each file. It changes if any model file is added, removed, or
+    changed. Paths that don't exist are skipped. The fingerprint of
+    each path is only made once.
+    """
+    fingerprint = hashlib.sha1()
+    
+    for path in sorted(paths):
+        if path not in _model_fingerprints:
+            files = []
+            if os.path.isfile(path):
+                files = [path]
+            for root, dirs, names in os.walk(path):
+                files += [os.path.join(root, name) for name in names]
+
+            path_hash = hashlib.sha1()
+            for ff in sorted(files):
+                stat = os.stat(ff)
+                path_hash.update('{0} {1} {2}\n'.format(os.path.relpath(ff, path),
+                                                        stat.st_size,
+                                                        int(stat.st_mtime)).encode())
+            _model_fingerprints[path] = path_hash.hexdigest()
+
+        fingerprint.update(_model_fingerprints[path].encode())
+
+    return fingerprint.hexdigest()
+
+def get_iso_params(logAge, AKs, distance, metallicity=0.0,
+                   evo_model=default_evo_model, atm_func=default_atm_func,
+                   wd_atm_func=default_wd_atm_func, red_law=default_red_law,
+                   mass_sampling=1, wave_range=[3000, 52000], min_mass=None,
+                   max_mass=None, rebin=True, filters=[], bc_dir=None, AKs_grid=None):
+    """
+    Return a dictionary of all the parameters that affect an 
+    IsochronePhot (see IsochronePhot for their definitions), that is 
+    used as its cache key (see IsochroneCache). The models are 
+    described by their names and settings and a fingerprint of
+    their files (get_model_fingerprint).
+    """
+    # Evolution model: class, simple settings (e.g. MIST version) and files
+    evo_dir = getattr(evo_model, 'model_dir', None)
+    evo_settings = {key: val for key, val in vars(evo_model).items()
+                    if isinstance(val, (str, bool, int, float)) and (key != 'model_dir')}
+    evo_files = get_model_fingerprint([evo_dir]) if evo_dir else None
+
+    # Atmospheres: the catalogs of the grids that atm_func uses
+    atm_grids = atm.get_atmosphere_grids(atm_func, rebin=rebin)
+    atm_files = get_model_fingerprint(['{0}/grid/{1}/catalog.fits'.format(os.environ['PYSYN_CDBS'], grid)
+                                       for grid in atm_grids])
+
+    params = {'version': iso_cache_version,
+              'logAge': float(logAge), 'AKs': float(AKs), 'distance': float(distance),
+              'metallicity': float(metallicity),
+              'evo_model': [type(evo_model).__name__, evo_settings, evo_files],
+              'atm_func': [atm_func.__name__, atm_files],
+              'wd_atm_func': wd_atm_func.__name__,
+              'red_law': red_law.name,
+              'mass_sampling': int(mass_sampling),
+              'wave_range': [float(wave) for wave in wave_range],
+              'min_mass': None if min_mass is None else float(min_mass),
+              'max_mass': None if max_mass is None else float(max_mass),
+              'rebin': bool(rebin),
+              'filters': list(filters),
+              'AKs_grid': None if AKs_grid is None else [float(AKs) for AKs in AKs_grid],
+              'bc_files': None}
+
+    # The photometry from BC tables depends on the tables themselves
+    if bc_dir is not None:
+        params['bc_files'] = get_model_fingerprint([get_bc_file(bc_dir, grid, red_law)
+                                                    for grid in atm_grids])
+    
+    return params
+
+def get_spec_params(params):
+    """
+    Return the parameters (see get_iso_params) that affect the 
+    spectra of the isochrone stars at their surface, i.e. without the
+    extinction, distance, and photometry parameters.
+    """
+    spec_params = {key: val for key, val in params.items()
+                   if key not in ['AKs', 'distance', 'red_law', 'filters', 'AKs_grid', 'bc_files']}
+    spec_params['spectra'] = True
+    
+    return spec_params
+
+class IsochroneCache(object):
+    """
+    Content-addressed cache of the IsochronePhot files in iso_dir.
+
+    Each isochrone file is keyed on a hash of all the parameters that
+    affect it (get_iso_params), including fingerprints of the model 
+    files, so a file is only reused if it was made with the same
+    parameters. An index file in iso_dir (iso_cache_index.json)
+    records the parameters, size, last access time, and number of
+    hits of each file, as well as the total hits and misses of the cache.
+    The index is locked while it is updated, so several processes can
+    share the same iso_dir.
+
+    Parameters
+    ----------
+    iso_dir : path
+        Path to isochrone directory.
+
+    max_size : float or None, optional
+        Maximum total size of the isochrone files, in bytes. If set, the
+        least recently used files are deleted to stay under it.
+        Default is None (no limit).
+    """
+    index_name = 'iso_cache_index.json'
+    
+    def __init__(self, iso_dir, max_size=None):
+        self.iso_dir = iso_dir
+        self.max_size = max_size
+        self.index_file = os.path.join(iso_dir, self.index_name)
+        self.lock_file = self.index_file + '.lock'
+        
+        return
+
+    @staticmethod
+    def get_key(params):
+        """
+        Return the cache key (a hash) of the isochrone parameters.
+        """
+        params_str = json.dumps(params, sort_keys=True)
+        
+        return hashlib.sha1(params_str.encode()).hexdigest()
+
+    def get_file(self, key, params):
+        """
+        Return the name of the isochrone file for a cache key. The
+        age, extinction, distance, and metallicity are kept in the
+        name, e.g. iso_6.70_2.70_04000_p00_<key>.fits
+        """
+        metallicity = params['metallicity']
+        if metallicity < 0:
+            metal_pre = 'm'
+        else:
+            metal_pre = 'p'
+        metal_flag = int(abs(metallicity)*10)
+
+        distance = params['distance']
+        if distance == int(distance):
+            distance = int(distance)
+
+        save_file_fmt = 'iso_{0:.2f}_{1:4.2f}_{2:4s}_{3}{4:2s}_{5}.fits'
+        save_file = save_file_fmt.format(params['logAge'], params['AKs'],
+                                         str(distance).zfill(5), metal_pre,
+                                         str(metal_flag).zfill(2), key[:16])
+        
+        return os.path.join(self.iso_dir, save_file)
+
+    @contextlib.contextmanager
+    def _lock(self, timeout=60):
+        """
+        Lock the index while it is read and updated. A lock older
+        than timeout (in s) is assumed to be left over from a 
+        crashed process, and is removed.
+        """
+        while True:
             try:
-                tmp = Table.read(self.save_file)
-            except:
-                tmp = Table.read(self.save_file_legacy)
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if (time.time() - os.path.getmtime(self.lock_file)) > timeout:
+                        os.remove(self.lock_file)
+                except OSError:
+                    pass
+                time.sleep(0.05)
+
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(self.lock_file)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_file):
+            return {'hits': 0, 'misses': 0, 'files': {}}
+        
+        with open(self.index_file, 'r') as _in:
+            return json.load(_in)
+
+    def _write_index(self, index):
+        # Write to a temporary file first, so the index is never left half-written
+        fd, tmp_file = tempfile.mkstemp(dir=self.iso_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as _out:
+            json.dump(index, _out, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.index_file)
+
+        return
+
+    def lookup(self, key, record=True):
+        """
+        Return the isochrone file for a cache key, or None if it is
+        not in the cache. The hit or miss is recorded in the index,
+        unless record is False (e.g. to check for files without 
+        counting them in the stats).
+        """
+        if not record:
+            entry = self._read_index()['files'].get(key)
+            if entry is None:
+                return None
+            out_file = os.path.join(self.iso_dir, entry['file'])
             
+            return out_file if os.path.exists(out_file) else None
+        
+        with self._lock():
+            index = self._read_index()
+            entry = index['files'].get(key)
+
+            if (entry is not None) and os.path.exists(os.path.join(self.iso_dir, entry['file'])):
+                entry['hits'] += 1
+                entry['last_access'] = time.time()
+                index['hits'] += 1
+                out_file = os.path.join(self.iso_dir, entry['file'])
+            else:
+                index['files'].pop(key, None)
+                index['misses'] += 1
+                out_file = None
+
+            self._write_index(index)
+
+        return out_file
+
+    def find(self, params, ignore=[]):
+        """
+        Return the (key, file, params) of the isochrones in the cache
+        that have the same parameters, except for those in ignore
+        (e.g. ['distance']). The most recently used ones are first.
+        """
+        def strip(pars):
+            pars = {key: val for key, val in pars.items() if key not in ignore}
+            return json.dumps(pars, sort_keys=True)
+
+        params_str = strip(params)
+        files = self._read_index()['files']
         
-            # See if the meta-data matches: evo model, atm_func, redlaw
-            if ( (tmp.meta['EVOMODEL'] == type(evo_model).__name__) &
-                (tmp.meta['ATMFUNC'] == atm_func.__name__) &
-                 (tmp.meta['REDLAW'] == red_law.name) ):
-                out_bool = True
+        out = []
+        for key in sorted(files, key=lambda kk: -files[kk]['last_access']):
+            entry = files[key]
+            entry_file = os.path.join(self.iso_dir, entry['file'])
             
-        return out_bool
+            if (strip(entry['params']) == params_str) and os.path.exists(entry_file):
+                out.append((key, entry_file, entry['params']))
+
+        return out
+
+    def count_miss(self):
+        """
+        Record a miss, e.g. when the isochrone is remade with recomp=True.
+        """
+        with self._lock():
+            index = self._read_index()
+            index['misses'] += 1
+            self._write_index(index)
+
+        return
+
+    def add(self, key, params, save_file):
+        """
+        Add (or update) an isochrone file in the index, then evict the
+        least recently used files if the cache is larger than max_size.
+        """
+        with self._lock():
+            index = self._read_index()
+            index['files'][key] = {'file': os.path.basename(save_file),
+                                   'params': params,
+                                   'size': os.path.getsize(save_file),
+                                   'last_access': time.time(),
+                                   'hits': 0}
+
+            if self.max_size is not None:
+                self._evict(index, keep=key)
+
+            self._write_index(index)
+
+        return
 
-    def plot_CMD(self, mag1, mag2, savefile=None):
+    def _evict(self, index, keep=None):
         """
-        Make a CMD with mag1 vs mag1 - mag2
-
-        Parameters
-        ----------
-        mag1 : string
-            The name of the first magnitude column to be plotted.
-        mag2 : string
-            The name of the second magnitude column to be plotted.
-        savefile : string (default None)
-            If a savefile is specified, then the plot will be saved to that file. 
+        Delete the least recently used files (except keep) until the
+        total size is below max_size.
         """
-        plt.clf()
-        plt.plot(self.points[mag1] - self.points[mag2], self.points[mag1],
-                 color='black', linestyle='solid', marker='+')
-        plt.gca().invert_yaxis()
-        plt.xlabel(mag1 + ' - ' + mag2 + ' (mag)')
-        plt.ylabel(mag1 + ' (mag)')
+        files = index['files']
+        total_size = sum([entry['size'] for entry in files.values()])
         
-        fmt_title = 'logAge={0:.2f}, d={1:.2f} kpc, AKs={2:.2f}'
-        plt.title(fmt_title.format(self.points.meta['LOGAGE'],
-                                  self.points.meta['DISTANCE']/1e3,
-                                  self.points.meta['AKS']))
+        for key in sorted(files, key=lambda kk: files[kk]['last_access']):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            old_file = os.path.join(self.iso_dir, files[key]['file'])
+            if os.path.exists(old_file):
+                os.remove(old_file)
+            total_size -= files[key]['size']
+            del files[key]
 
-        if savefile != None:
-            plt.savefig(savefile)
-        
         return
 
-    def plot_mass_magnitude(self, mag, savefile=None):
+    def stats(self):
         """
-        Make a standard mass-luminosity relation plot for this isochrone.
-        
-        Parameters
-        ----------
-        mag : string
-            The name of the magnitude column to be plotted.
-        savefile : string (default None)
-            If a savefile is specified, then the plot will be saved to that file. 
+        Return a dictionary with the number of hits, misses,
+        files, and the total size (bytes) of the cache.
         """
-        plt.clf()
-        plt.semilogx(self.points['mass'], self.points[mag], 'k.')
-        plt.gca().invert_yaxis()
-        plt.xlabel(r'Mass (M$_\odot$)')
-        plt.ylabel(mag + ' (mag)')
-        
-        fmt_title = 'logAge={0:.2f}, d={1:.2f} kpc, AKs={2:.2f}'
-        plt.title(fmt_title.format(self.points.meta['LOGAGE'],
-                                  self.points.meta['DISTANCE']/1e3,
-                                  self.points.meta['AKS']))
-        
-        if savefile != None:
-            plt.savefig(savefile)
+        index = self._read_index()
+        files = index['files'].values()
         
-        return
+        return {'hits': index['hits'], 'misses': index['misses'],
+                'files': len(files), 'size': sum([entry['size'] for entry in files])}
 
-#===================================================#
-# Iso table: same as IsochronePhot object, but doesn't do reddening application
-# or photometry automatically. These are separate functions on the object.
-# NOTE: THIS CLASS IS DEPRECATED, DO NOT USE!
-#===================================================#
 class iso_table(object):
     def __init__(self, logAge, distance, evo_model=default_evo_model,
                  atm_func=default_atm_func, mass_sampling=1,
@@ -1383,7 +3070,8 @@ class iso_table(object):
         
         return
 
-    def apply_reddening(self, AKs, extinction_law, dAKs=0, dist='uniform', dAKs_max=None):
+    def apply_reddening(self, AKs, extinction_law, dAKs=0, dist='uniform', dAKs_max=None,
+                        rng=None):
         """
         Apply extinction to the spectra in iso_table, using the defined
         extinction law
@@ -1408,8 +3096,12 @@ class iso_table(object):
             Distribution to draw differential reddening from. If uniform,
             dAKs will cut off at Aks +/- dAKs. Otherwise, will draw
             from Gaussian of width AKs +/- dAks
+
+        rng: numpy.random.Generator, int, or None
+            Random number generator (or seed) for the differential extinction.
             
         """
+        rng = get_rng(rng)
         self.AKs = np.ones(len(self.spec_list))
         # Apply reddening to each object in the spec list
         for i in range(len(self.spec_list)):
@@ -1419,18 +3111,18 @@ class iso_table(object):
             # extinction law
             if dAKs != 0:
                 if dist == 'gaussian':
-                    AKs_act = np.random.normal(loc=AKs, scale=dAKs)
+                    AKs_act = rng.normal(loc=AKs, scale=dAKs)
                     # Apply dAKs_max if desired. Redo if diff > dAKs_max
                     if dAKs_max != None:
                         diff = abs(AKs_act - AKs)
                         while diff > dAKs_max:
                             print('While loop active')
-                            AKs_act = np.random.normal(loc=AKs, scale=dAKs)
+                            AKs_act = rng.normal(loc=AKs, scale=dAKs)
                             diff = abs(AKs_act - AKs)
                 elif dist == 'uniform':
                     low = AKs - dAKs
                     high = AKs + dAKs
-                    AKs_act = np.random.uniform(low=low, high=high)
+                    AKs_act = rng.uniform(low=low, high=high)
                 else:
                     print('dist {0} undefined'.format(dist))
                     return
@@ -1466,30 +3158,25 @@ class iso_table(object):
             larger than 1500 points)
  
         """
-        npoints = len(self.points)
-
-        # Loop through the filters, get filter info, make photometry for
-        # all stars in this filter.
+        # Loop through the filters, get filter info.
         ts = time.time()
+        filt_list = []
         for filt_name, filt_str in filters.items():
             # Define filter info
             prt_fmt = 'Starting filter: {0:s}   Elapsed time: {1:.2f} seconds'
             print( prt_fmt.format(filt_name, time.time() - ts))
-            filt = get_filter_info(filt_str, rebin=rebin, vega=vega)
+            filt_list.append(get_filter_info(filt_str, rebin=rebin, vega=vega))
 
-            # Make the column to hold magnitudes in this filter. Add to points table.
+        # Make photometry for all stars in all filters. These are already
+        # extincted, observed spectra.
+        mags = mags_in_filters(self.spec_list, filt_list)
+
+        # Make the columns to hold magnitudes in each filter. Add to points table.
+        for ff, filt_name in enumerate(filters.keys()):
             col_name = 'mag_' + filt_name
-            mag_col = Column(np.zeros(npoints, dtype=float), name=col_name)
+            mag_col = Column(mags[:, ff], name=col_name)
             self.points.add_column(mag_col)
             
-            # Loop through each star in the isochrone and do the filter integration
-            for ss in range(npoints):
-                star = self.spec_list[ss]  # These are already extincted, observed spectra.
-                star_mag = mag_in_filter(star, filt)
-                
-                self.points[col_name][ss] = star_mag
-        
-            
         endTime = time.time()
         print( '      Time taken: {0:.2f} seconds'.format(endTime - ts))
 
@@ -1610,6 +3297,61 @@ def get_filter_col_name(obs_str):
         
     return filt_name
 
+# Dictionary of the SPISEA obs_str for each photometry column name
+# (without the leading m_).
+filt_obs_str = {'hst_f127m': 'wfc3,ir,f127m', 'hst_f139m': 'wfc3,ir,f139m', 'hst_f153m': 'wfc3,ir,f153m',
+                'hst_f814w': 'acs,wfc1,f814w', 'hst_f125w': 'wfc3,ir,f125w', 'hst_f160w': 'wfc3,ir,f160w',
+                'decam_y': 'decam,y', 'decam_i': 'decam,i', 'decam_z': 'decam,z',
+                'decam_u':'decam,u', 'decam_g':'decam,g', 'decam_r':'decam,r',
+                'vista_Y':'vista,Y', 'vista_Z':'vista,Z', 'vista_J': 'vista,J',
+                'vista_H': 'vista,H', 'vista_Ks': 'vista,Ks',
+                'ps1_z':'ps1,z', 'ps1_g':'ps1,g', 'ps1_r': 'ps1,r',
+                'ps1_i': 'ps1,i', 'ps1_y':'ps1,y',
+                'jwst_F090W': 'jwst,F090W', 'jwst_F164N': 'jwst,F164N', 'jwst_F212N': 'jwst,F212N',
+                'jwst_F323N':'jwst,F323N', 'jwst_F466N': 'jwst,F466N',
+                'jwst_F070W': 'jwst,F070W',
+                'jwst_F115W': 'jwst,F115W',
+                'jwst_F140M': 'jwst,F140M',
+                'jwst_F150W': 'jwst,F150W',
+                'jwst_F150W2': 'jwst,F150W2',
+                'jwst_F162M': 'jwst,F162M',
+                'jwst_F182M': 'jwst,F182M',
+                'jwst_F187N': 'jwst,F187N',
+                'jwst_F200W': 'jwst,F200W',
+                'jwst_F210M': 'jwst,F210M',
+                'jwst_F250M': 'jwst,F250M', 
+                'jwst_F277W': 'jwst,F277W',
+                'jwst_F300M': 'jwst,F300M',
+                'jwst_F322W2': 'jwst,F322W2',
+                'jwst_F335M': 'jwst,F335M',
+                'jwst_F356W': 'jwst,F356W',
+                'jwst_F360M': 'jwst,F360M',
+                'jwst_F405N': 'jwst,F405N',
+                'jwst_F410M': 'jwst,F410M',
+                'jwst_F430M': 'jwst,F430M',
+                'jwst_F444W': 'jwst,F444W',
+                'jwst_F440W': 'jwst,F440W',
+                'jwst_F460M': 'jwst,F460M',
+                'jwst_F470N': 'jwst,F470N',
+                'jwst_F480M': 'jwst,F480M',
+                'nirc2_J': 'nirc2,J', 'nirc2_H': 'nirc2,H', 'nirc2_Kp': 'nirc2,Kp', 'nirc2_K': 'nirc2,K',
+                'nirc2_Lp': 'nirc2,Lp', 'nirc2_Ms': 'nirc2,Ms', 'nirc2_Hcont': 'nirc2,Hcont',
+                'nirc2_FeII': 'nirc2,FeII', 'nirc2_Brgamma': 'nirc2,Brgamma',
+                '2mass_J': '2mass,J', '2mass_H': '2mass,H', '2mass_Ks': '2mass,Ks',
+                'ubv_U':'ubv,U', 'ubv_B':'ubv,B', 'ubv_V':'ubv,V', 'ubv_R':'ubv,R',
+                'ubv_I':'ubv,I', 
+                'jg_J': 'jg,J', 'jg_H': 'jg,H', 'jg_K': 'jg,K',
+                'nirc1_K':'nirc1,K', 'nirc1_H':'nirc1,H',
+                'naco_J':'naco,J', 'naco_H':'naco,H', 'naco_Ks':'naco,Ks',
+                'ukirt_J':'ukirt,J', 'ukirt_H':'ukirt,H', 'ukirt_K':'ukirt,K',
+                'ctio_osiris_H': 'ctio_osiris,H', 'ctio_osiris_K': 'ctio_osiris,K',
+                'ztf_g':'ztf,g', 'ztf_r':'ztf,r', 'ztf_i':'ztf,i',
+                'gaiaDR2_G': 'gaia,dr2_rev,G', 'gaiaDR2_Gbp':'gaia,dr2_rev,Gbp',
+                'gaiaDR2_Grp':'gaia,dr2_rev,Grp',
+                'hawki_J': 'hawki,J',
+                'hawki_H': 'hawki,H',
+                'hawki_Ks': 'hawki,Ks'}
+
 def get_obs_str(col):
     """
     Helper function to get the associated SPISEA obs_str given
@@ -1618,61 +3360,7 @@ def get_obs_str(col):
     # Remove the trailing m_
     name = col[2:]
     
-    # Define dictionary for filters
-    filt_list = {'hst_f127m': 'wfc3,ir,f127m', 'hst_f139m': 'wfc3,ir,f139m', 'hst_f153m': 'wfc3,ir,f153m',
-                 'hst_f814w': 'acs,wfc1,f814w', 'hst_f125w': 'wfc3,ir,f125w', 'hst_f160w': 'wfc3,ir,f160w',
-                 'decam_y': 'decam,y', 'decam_i': 'decam,i', 'decam_z': 'decam,z',
-                 'decam_u':'decam,u', 'decam_g':'decam,g', 'decam_r':'decam,r',
-                 'vista_Y':'vista,Y', 'vista_Z':'vista,Z', 'vista_J': 'vista,J',
-                 'vista_H': 'vista,H', 'vista_Ks': 'vista,Ks',
-                 'ps1_z':'ps1,z', 'ps1_g':'ps1,g', 'ps1_r': 'ps1,r',
-                 'ps1_i': 'ps1,i', 'ps1_y':'ps1,y',
-                 'jwst_F090W': 'jwst,F090W', 'jwst_F164N': 'jwst,F164N', 'jwst_F212N': 'jwst,F212N',
-                 'jwst_F323N':'jwst,F323N', 'jwst_F466N': 'jwst,F466N',
-                 'jwst_F070W': 'jwst,F070W',
-                 'jwst_F115W': 'jwst,F115W',
-                 'jwst_F140M': 'jwst,F140M',
-                 'jwst_F150W': 'jwst,F150W',
-                 'jwst_F150W2': 'jwst,F150W2',
-                 'jwst_F162M': 'jwst,F162M',
-                 'jwst_F182M': 'jwst,F182M',
-                 'jwst_F187N': 'jwst,F187N',
-                 'jwst_F200W': 'jwst,F200W',
-                 'jwst_F210M': 'jwst,F210M',
-                 'jwst_F250M': 'jwst,F250M', 
-                 'jwst_F277W': 'jwst,F277W',
-                 'jwst_F300M': 'jwst,F300M',
-                 'jwst_F322W2': 'jwst,F322W2',
-                 'jwst_F335M': 'jwst,F335M',
-                 'jwst_F356W': 'jwst,F356W',
-                 'jwst_F360M': 'jwst,F360M',
-                 'jwst_F405N': 'jwst,F405N',
-                 'jwst_F410M': 'jwst,F410M',
-                 'jwst_F430M': 'jwst,F430M',
-                 'jwst_F444W': 'jwst,F444W',
-                 'jwst_F440W': 'jwst,F440W',
-                 'jwst_F460M': 'jwst,F460M',
-                 'jwst_F470N': 'jwst,F470N',
-                 'jwst_F480M': 'jwst,F480M',
-                 'nirc2_J': 'nirc2,J', 'nirc2_H': 'nirc2,H', 'nirc2_Kp': 'nirc2,Kp', 'nirc2_K': 'nirc2,K',
-                 'nirc2_Lp': 'nirc2,Lp', 'nirc2_Ms': 'nirc2,Ms', 'nirc2_Hcont': 'nirc2,Hcont',
-                 'nirc2_FeII': 'nirc2,FeII', 'nirc2_Brgamma': 'nirc2,Brgamma',
-                 '2mass_J': '2mass,J', '2mass_H': '2mass,H', '2mass_Ks': '2mass,Ks',
-                 'ubv_U':'ubv,U', 'ubv_B':'ubv,B', 'ubv_V':'ubv,V', 'ubv_R':'ubv,R',
-                 'ubv_I':'ubv,I', 
-                 'jg_J': 'jg,J', 'jg_H': 'jg,H', 'jg_K': 'jg,K',
-                 'nirc1_K':'nirc1,K', 'nirc1_H':'nirc1,H',
-                 'naco_J':'naco,J', 'naco_H':'naco,H', 'naco_Ks':'naco,Ks',
-                 'ukirt_J':'ukirt,J', 'ukirt_H':'ukirt,H', 'ukirt_K':'ukirt,K',
-                 'ctio_osiris_H': 'ctio_osiris,H', 'ctio_osiris_K': 'ctio_osiris,K',
-                 'ztf_g':'ztf,g', 'ztf_r':'ztf,r', 'ztf_i':'ztf,i',
-                 'gaiaDR2_G': 'gaia,dr2_rev,G', 'gaiaDR2_Gbp':'gaia,dr2_rev,Gbp',
-                 'gaiaDR2_Grp':'gaia,dr2_rev,Grp',
-                 'hawki_J': 'hawki,J',
-                 'hawki_H': 'hawki,H',
-                 'hawki_Ks': 'hawki,Ks'}
-
-    obs_str = filt_list[name]
+    obs_str = filt_obs_str[name]
         
     return obs_str
 
@@ -1694,11 +3382,22 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
                         iso_dir = './', mass_sampling=1,
                         filters=['wfc3,ir,f127m',
                                  'wfc3,ir,f139m',
-                                 'wfc3,ir,f153m']):
+                                 'wfc3,ir,f153m'],
+                        n_proc=1, n_retry=1):
     """
     Wrapper routine to generate a grid of isochrones of different ages,
     extinctions, and distances. 
 
+    The grid points are grouped by age, since all the points of one age
+    share the same stellar atmospheres, and each age is made by one worker
+    process. Within an age, only the first distance at each AKs is 
+    made from the spectra; the other distances are shifted from it
+    (see IsochronePhot.make_from_distance). Points that are already in iso_dir (see IsochroneCache)
+    are skipped, so a crashed run resumes where it left off. A failed point
+    is retried n_retry times, and does not stop the rest of the grid. 
+    The status of each point is written to a manifest in iso_dir
+    (iso_grid_manifest.json), which is updated as the points are done.
+
     Parameters:
     ----------
     age_arr: array
@@ -1727,6 +3426,17 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
 
     filters: dictionary
         Which filters to do the synthetic photometry on    
+
+    n_proc: int
+        Number of worker processes. Default is 1 (no extra processes).
+
+    n_retry: int
+        Number of times to retry a grid point that fails. Default is 1.
+
+    Returns
+    -------
+    manifest : dict
+        The manifest of the grid, with the status of each point.
     """
     print( '**************************************')
     print( 'Start generating isochrones')
@@ -1734,32 +3444,504 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
     print( 'Atmospheric Models adopted: {0}'.format(atm_func))
     print( 'Reddening Law adopted: {0}'.format(redlaw))
     print( 'Isochrone Mass sampling: {0}'.format(mass_sampling))
+    print( 'Worker processes: {0}'.format(n_proc))
     print( '**************************************')
 
-    num_models = len(age_arr) * len(AKs_arr) * len(dist_arr)
-    iteration = 0
-    #Loop structure: loop 1 = age, loop 2 = Aks, loop 3 = distance
-    for i in range(len(age_arr)):
-        for j in range(len(AKs_arr)):
-            for k in range(len(dist_arr)):
-                    iso = IsochronePhot(age_arr[i], AKs_arr[j], dist_arr[k],
-                                        evo_model=evo_model, atm_func=atm_func,
-                                        red_law=redlaw, iso_dir=iso_dir,
-                                        mass_sampling=mass_sampling,
-                                        filters=filters)
-                    iteration += 1
-                    print( 'Done ' + str(iteration) + ' of ' + str(num_models))
-
-    # Also, save a README file in iso directory documenting the params used
-    _out = open(iso_dir+'README.txt', 'w')
-    _out.write('SPISEA parameters used to generate isochrone grid:\n')
-    _out.write('Evolutionary Models: {0}\n'.format(evo_model))
-    _out.write('Atmospheric Models: {0}\n'.format(atm_func))
-    _out.write('Reddening Law: {0}\n'.format(redlaw))
-    _out.write('Isochrone Mass: {0}'.format(mass_sampling))
-    _out.close()
+    # Make the iso_dir, if it doesn't already exist
+    if not os.path.exists(iso_dir):
+        os.mkdir(iso_dir)
+
+    iso_kwargs = {'evo_model': evo_model, 'atm_func': atm_func, 'red_law': redlaw,
+                  'iso_dir': iso_dir, 'mass_sampling': mass_sampling,
+                  'filters': filters}
+
+    manifest_file = os.path.join(iso_dir, 'iso_grid_manifest.json')
+    manifest = {'evo_model': type(evo_model).__name__,
+                'atm_func': atm_func.__name__,
+                'red_law': redlaw.name,
+                'mass_sampling': mass_sampling,
+                'filters': list(filters),
+                'points': []}
+
+    # Skip the points that are already in iso_dir.
+    cache = IsochroneCache(iso_dir)
+    tasks = []
+    for age in age_arr:
+        age_points = []
+        
+        for AKs in AKs_arr:
+            for dist in dist_arr:
+                point = {'logAge': float(age), 'AKs': float(AKs), 'distance': float(dist),
+                         'status': 'pending', 'file': None, 'attempts': 0, 'error': None}
+                
+                params = get_iso_params(age, AKs, dist, evo_model=evo_model,
+                                        atm_func=atm_func, red_law=redlaw,
+                                        mass_sampling=mass_sampling, filters=filters)
+                save_file = cache.lookup(cache.get_key(params), record=False)
+                if save_file is not None:
+                    point['status'] = 'done'
+                    point['file'] = os.path.basename(save_file)
+                else:
+                    age_points.append(len(manifest['points']))
+                    
+                manifest['points'].append(point)
+
+        if len(age_points) > 0:
+            tasks.append((age_points, [manifest['points'][ii] for ii in age_points],
+                          iso_kwargs, n_retry))
+
+    num_models = len(manifest['points'])
+    num_done = num_models - sum([len(task[0]) for task in tasks])
+    print( 'Found {0} of {1} isochrones in {2}'.format(num_done, num_models, iso_dir))
+    write_grid_manifest(manifest, manifest_file)
+
+    # Make the isochrones, one age per task. The manifest is updated
+    # as each age is done.
+    if n_proc > 1:
+        pool = multiprocessing.Pool(processes=n_proc)
+        results = pool.imap_unordered(_make_isochrone_grid_task, tasks)
+    else:
+        pool = None
+        results = map(_make_isochrone_grid_task, tasks)
+
+    try:
+        for idx, points in results:
+            for ii, point in zip(idx, points):
+                manifest['points'][ii] = point
+                
+            num_done += len(idx)
+            write_grid_manifest(manifest, manifest_file)
+            print( 'Done ' + str(num_done) + ' of ' + str(num_models))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    failed = [point for point in manifest['points'] if point['status'] == 'failed']
+    if len(failed) > 0:
+        print( '{0} isochrones failed, see {1}'.format(len(failed), manifest_file))
+
+    return manifest
+
+def _make_isochrone_grid_task(task):
+    """
+    Make the IsochronePhot of each grid point in a task
+    (see make_isochrone_grid), catching and retrying the failures.
+    Returns the manifest indices and updated points.
+    """
+    idx, points, iso_kwargs, n_retry = task
+
+    for point in points:
+        while (point['status'] != 'done') & (point['attempts'] <= n_retry):
+            point['attempts'] += 1
+            
+            try:
+                iso = IsochronePhot(point['logAge'], point['AKs'], point['distance'],
+                                    **iso_kwargs)
+                point['status'] = 'done'
+                point['file'] = os.path.basename(iso.save_file)
+                point['error'] = None
+            except Exception as err:
+                point['status'] = 'failed'
+                point['error'] = '{0}: {1}'.format(type(err).__name__, err)
+
+    return idx, points
+
+def write_grid_manifest(manifest, manifest_file):
+    """
+    Write the isochrone grid manifest (see make_isochrone_grid) as JSON.
+    It is written to a temporary file first, so that it is never
+    left half-written.
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    fd, tmp_file = tempfile.mkstemp(dir=manifest_dir, suffix='.json')
+    with os.fdopen(fd, 'w') as _out:
+        json.dump(manifest, _out, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+    return
+
+def make_star_spectrum(temperature, gravity, radius, phase, metallicity,
+                       AKs, distance, atm_func=default_atm_func,
+                       wd_atm_func=default_wd_atm_func, red_law=default_red_law,
+                       wave_range=[3000, 52000], rebin=True, star=None):
+    """
+    Get the observed spectrum of one isochrone star: the atmosphere
+    model, trimmed to wave_range, scaled to the distance, and reddened.
+
+    Parameters
+    ----------
+    temperature : float
+        Effective temperature, in K
+
+    gravity : float
+        Surface gravity, in cgs units
+
+    radius : float
+        Stellar radius, in pc
+
+    phase : int
+        Evolutionary phase. White dwarfs (phase = 101) use wd_atm_func.
+
+    metallicity : float
+        Metallicity passed to the atmosphere function, in [M/H]
+
+    AKs : float
+        The total extinction in Ks filter, in magnitudes
+
+    distance : float
+        The distance to the star, in pc
+
+    star : pysynphot spectrum or None
+        The atmosphere model, if it has already been made
+        (e.g. with atmospheres.get_atmosphere_batch). 
+    """
+    star = make_surface_spectrum(temperature, gravity, phase, metallicity,
+                                 atm_func=atm_func, wd_atm_func=wd_atm_func,
+                                 wave_range=wave_range, rebin=rebin, star=star)
+
+    # Convert into flux observed at Earth (unreddened)
+    star *= (radius / distance)**2  # in erg s^-1 cm^-2 A^-1
+
+    # Redden the spectrum. This doesn't take much time at all.
+    red = red_law.reddening(AKs).resample(star.wave) 
+    star *= red
+
+    return star
+
+def make_surface_spectrum(temperature, gravity, phase, metallicity,
+                          atm_func=default_atm_func, wd_atm_func=default_wd_atm_func,
+                          wave_range=[3000, 52000], rebin=True, star=None):
+    """
+    Get the spectrum of one isochrone star at its surface: the atmosphere
+    model, trimmed to wave_range. make_star_spectrum then scales it to
+    the distance and reddens it. See make_star_spectrum for the parameters.
+    """
+    # Get the atmosphere model now. Wavelength is in Angstroms
+    # This is the time-intensive call... everything else is negligable.
+    # If source is a star, pull from star atmospheres. If it is a WD,
+    # pull from WD atmospheres
+    if (star is None) & (phase == 101):
+        star = wd_atm_func(temperature=temperature, gravity=gravity,
+                           metallicity=metallicity, verbose=False)
+    elif star is None:
+        star = atm_func(temperature=temperature, gravity=gravity,
+                        metallicity=metallicity, rebin=rebin)
+
+    # Trim wavelength range down to JHKL range (0.5 - 5.2 microns)
+    star = spectrum.trimSpectrum(star, wave_range[0], wave_range[1])
+
+    return star
+
+class SurfaceSpectra(object):
+    """
+    The spectra of all the stars in an isochrone at their surface (see
+    make_surface_spectrum), before they are scaled to the distance and
+    reddened. The spectra that share a wavelength grid are stacked
+    into one flux array, so the distance and extinction are applied
+    to all of them at once (see observe).
+
+    Parameters
+    ----------
+    waves : list of arrays
+        The wavelength grids (Angstroms)
+
+    fluxes : list of 2D arrays
+        The flux (photlam) of the spectra on each wavelength grid,
+        with shape (N_spec, N_wave)
+
+    group, row : int arrays
+        The wavelength grid of each star, and its row in the flux array
+    """
+    def __init__(self, waves, fluxes, group, row):
+        self.waves = waves
+        self.fluxes = fluxes
+        self.group = np.asarray(group, dtype=int)
+        self.row = np.asarray(row, dtype=int)
+
+        return
+
+    @classmethod
+    def from_spectra(cls, spec_list):
+        """
+        Stack a list of pysynphot spectra, grouped by wavelength grid.
+        """
+        groups = {}
+        group = np.zeros(len(spec_list), dtype=int)
+        row = np.zeros(len(spec_list), dtype=int)
+        
+        for ss, star in enumerate(spec_list):
+            wave = np.asarray(star.wave, dtype=float)
+            key = wave.tobytes()
+            if key not in groups:
+                groups[key] = (len(groups), wave, [])
+                
+            group[ss] = groups[key][0]
+            row[ss] = len(groups[key][2])
+            # Spectra are evaluated in photlam, the pysynphot internal units.
+            groups[key][2].append(star(wave))
+
+        groups = sorted(groups.values(), key=lambda gg: gg[0])
+        waves = [gg[1] for gg in groups]
+        fluxes = [np.array(gg[2]) for gg in groups]
+
+        return cls(waves, fluxes, group, row)
+
+    def observe(self, radius, distance, AKs, red_law):
+        """
+        Return the observed spectra of the stars, as from make_star_spectrum:
+        scaled by (radius / distance)^2 and reddened by AKs with red_law.
+        The radius (in pc) is an array with one value per star.
+        """
+        scale = (np.asarray(radius, dtype=float) / distance)**2
+        spec_list = [None] * len(self.group)
+
+        for gg in range(len(self.waves)):
+            wave = self.waves[gg]
+            idx = np.where(self.group == gg)[0]
+            
+            red = np.asarray(red_law.reddening(AKs).resample(wave).throughput)
+            flux = self.fluxes[gg][self.row[idx]] * scale[idx, None] * red[None, :]
+            
+            for ii, ss in enumerate(idx):
+                spec_list[ss] = atm.get_tabular_spectrum(wave, flux[ii])
+
+        return spec_list
+
+    def get_mags(self, radius, distance, AKs, red_law, filt_list):
+        """
+        Return the magnitudes (N_spec x N_filt) of the observed spectra
+        (see observe) through the filters, like mags_in_filters but
+        without making the pysynphot spectra.
+        """
+        scale = (np.asarray(radius, dtype=float) / distance)**2
+        mags = np.zeros((len(self.group), len(filt_list)), dtype=float)
+        flux0 = np.array([filt.flux0 for filt in filt_list])
+        mag0 = np.array([filt.mag0 for filt in filt_list])
+
+        for gg in range(len(self.waves)):
+            wave = self.waves[gg]
+            idx = np.where(self.group == gg)[0]
+            
+            red = np.asarray(red_law.reddening(AKs).resample(wave).throughput)
+            weights = np.array([get_filter_weights(wave, filt) for filt in filt_list]).T
+            
+            star_flux = np.dot(self.fluxes[gg][self.row[idx]] * red[None, :], weights)
+            star_flux *= scale[idx, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mags[idx] = -2.5 * np.log10(star_flux / flux0) + mag0
+
+        return mags
+
+    def write(self, filename, points):
+        """
+        Save the spectra and the isochrone points table to a FITS file.
+        """
+        hdus = [fits.PrimaryHDU(), fits.table_to_hdu(points)]
+        hdus[1].name = 'POINTS'
+        hdus.append(fits.ImageHDU(np.array([self.group, self.row]), name='SPECIDX'))
+        
+        for gg in range(len(self.waves)):
+            hdus.append(fits.ImageHDU(self.waves[gg], name='WAVE{0}'.format(gg)))
+            hdus.append(fits.ImageHDU(self.fluxes[gg], name='FLUX{0}'.format(gg)))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            fits.HDUList(hdus).writeto(filename, overwrite=True)
+
+        return
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read the spectra and isochrone points table saved with write.
+        Returns (spectra, points).
+        """
+        points = Table.read(filename, hdu='POINTS')
+        
+        with fits.open(filename) as hdul:
+            group, row = hdul['SPECIDX'].data
+            ngroups = int(group.max()) + 1 if len(group) > 0 else 0
+            waves = [np.array(hdul['WAVE{0}'.format(gg)].data, dtype=float)
+                     for gg in range(ngroups)]
+            fluxes = [np.array(hdul['FLUX{0}'.format(gg)].data, dtype=float)
+                      for gg in range(ngroups)]
+
+        return cls(waves, fluxes, group, row), points
+
+#===================================================#
+# Bolometric correction tables: synthetic photometry of every
+# model in an atmosphere grid, made once with make_bc_tables
+# and used by IsochronePhot (bc_dir) instead of the spectra.
+#===================================================#
+# Absolute bolometric magnitude of the Sun
+mbol_sun = 4.74
+
+# Cache of the BC tables that have been read in, keyed on file name.
+bc_tables = {}
+
+def get_mbol_surface(teff):
+    """
+    Get the bolometric magnitude of the flux at the surface of a star
+    with effective temperature teff (in K), i.e. seen with
+    (R / distance) = 1. The apparent bolometric magnitude of a star with
+    radius R at distance d is get_mbol_surface(teff) - 5 log10(R / d).
+    """
+    c = constants
+    teff = np.asarray(teff, dtype=float)
+
+    # Luminosity of a star with a radius of 10 pc
+    lum_10pc = 4.0 * math.pi * (10.0 * c.pc.value)**2 * c.sigma_sb.value * teff**4
+    
+    return mbol_sun - 2.5 * np.log10(lum_10pc / c.L_sun.value)
+
+def get_bc_file(bc_dir, atm_grid, red_law):
+    """
+    Get the name of the bolometric correction table for an
+    atmosphere grid and reddening law.
+    """
+    red_law_name = red_law.name.replace(',', '_').replace(' ', '')
+    
+    return '{0}/bc_{1}_{2}.fits'.format(bc_dir, atm_grid, red_law_name)
+
+def make_bc_tables(filters=None, atm_grids=None, bc_dir='./',
+                   red_law=default_red_law, AKs_grid=[0.0],
+                   wave_range=[3000, 52000], rebin=True, vega=vega,
+                   chunk_size=500):
+    """
+    Make the bolometric correction (BC) tables used for the fast synthetic
+    photometry of IsochronePhot (see the bc_dir parameter). Every model
+    of each atmosphere grid is integrated through each filter once,
+    at each extinction in AKs_grid. 
+
+    The bolometric correction BC = m_bol - m_filt only depends on the
+    atmosphere model (Teff, logg, [M/H]) and the extinction, and not on 
+    the stellar radius or distance. One table is saved for each
+    atmosphere grid and reddening law (see get_bc_file), with the
+    teff, metallicity, logg of each model in the grid catalog, a flag
+    for valid models, and a bc_<filter> column per filter with the BCs
+    at each AKs_grid value.
+
+    Parameters
+    ----------
+    filters : list of strings or None, optional
+        Filter obs_strs to make the BCs for. If None, all the filters 
+        in filt_obs_str are used. Default is None.
+
+    atm_grids : list of strings or None, optional
+        Names of the pysynphot atmosphere grids (in $PYSYN_CDBS/grid).
+        If None, the grids used by atmospheres.get_merged_atmosphere
+        are used. Default is None.
+
+    bc_dir : path, optional
+        Directory to save the tables in. Default is './'
+
+    red_law : reddening law object, optional
+        Define the reddening law for the synthetic photometry.
+        Default is reddening.RedLawNishiyama09().
+
+    AKs_grid : list, optional
+        Total extinctions in the Ks filter (in magnitudes) to make the BCs at.
+        IsochronePhot interpolates linearly between these, so use
+        a fine grid (e.g. steps of 0.1 mag) for optical filters at
+        high extinction. Default is [0.0].
+
+    wave_range : list, optional
+        length=2 list with the wavelength min/max of the spectra.
+        Units are Angstroms. Default is [3000, 52000].
+
+    rebin : boolean, optional
+        If true, use the rebinned atmosphere grids and rebin the
+        filters, as in IsochronePhot. Default is True.
+
+    chunk_size : int, optional
+        Number of models that are held in memory at once. Default is 500.
+    """
+    t1 = time.time()
+
+    if filters is None:
+        filters = list(filt_obs_str.values())
+
+    if atm_grids is None:
+        atm_grids = atm.get_atmosphere_grids(atm.get_merged_atmosphere, rebin=rebin)
+
+    # Make the bc_dir, if it doesn't already exist
+    if not os.path.exists(bc_dir):
+        os.mkdir(bc_dir)
+
+    filt_list = [get_filter_info(filt, rebin=rebin, vega=vega) for filt in filters]
+    AKs_grid = np.sort(np.atleast_1d(AKs_grid).astype(float))
+    reds = [red_law.reddening(AKs) for AKs in AKs_grid]
+
+    for atm_grid in atm_grids:
+        grid_cat = atm.get_grid_catalog(atm_grid)
+        nmodels = len(grid_cat)
+        print( 'Making BC table for {0}: {1} models'.format(atm_grid, nmodels))
+
+        valid = np.zeros(nmodels, dtype=bool)
+        mags = np.zeros((nmodels, len(filters), len(AKs_grid)), dtype=float)
+
+        for start in range(0, nmodels, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, nmodels))
+
+            # Like pysynphot.Icat, models without a positive total flux are invalid.
+            spec_list = []
+            for ii in rows:
+                star = atm.get_grid_spectrum(atm_grid, ii)
+                totflux = star.integrate()
+                valid[ii] = np.isfinite(totflux) & (totflux > 0)
+                
+                spec_list.append(spectrum.trimSpectrum(star, wave_range[0], wave_range[1]))
+
+            # Photometry of the flux at the stellar surface, for each extinction
+            for aa in range(len(AKs_grid)):
+                red_list = [star * reds[aa].resample(star.wave) for star in spec_list]
+                mags[rows, :, aa] = mags_in_filters(red_list, filt_list)
+
+        bc = get_mbol_surface(grid_cat['teff'])[:, None, None] - mags
+        bc[~valid] = np.nan
+
+        bc_tab = Table([grid_cat['teff'], grid_cat['metallicity'], grid_cat['logg'], valid],
+                       names=['teff', 'metallicity', 'logg', 'valid'])
+        for ff in range(len(filters)):
+            col_name = 'bc_' + get_filter_col_name(filters[ff])
+            bc_tab.add_column(Column(bc[:, ff, :], name=col_name))
+
+        bc_tab.meta['ATMGRID'] = atm_grid
+        bc_tab.meta['REDLAW'] = red_law.name
+        bc_tab.meta['AKSGRID'] = ','.join(['{0}'.format(AKs) for AKs in AKs_grid])
+        bc_tab.meta['WAVEMIN'] = wave_range[0]
+        bc_tab.meta['WAVEMAX'] = wave_range[1]
+        bc_tab.meta['REBIN'] = rebin
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            bc_tab.write(get_bc_file(bc_dir, atm_grid, red_law), overwrite=True)
+
+    t2 = time.time()
+    print( 'BC table generation took {0:f} s.'.format(t2-t1))
     return
 
+def get_bc_table(bc_dir, atm_grid, red_law):
+    """
+    Read the bolometric correction table made by make_bc_tables
+    for an atmosphere grid and reddening law. Tables are only read once.
+    The extinction grid is returned in the table meta-data as
+    an array (AKSGRID).
+    """
+    bc_file = get_bc_file(bc_dir, atm_grid, red_law)
+
+    if not os.path.exists(bc_file):
+        raise ValueError('No BC table {0}; run make_bc_tables first'.format(bc_file))
+
+    key = (os.path.abspath(bc_file), os.path.getmtime(bc_file))
+    if key not in bc_tables:
+        bc_tab = Table.read(bc_file)
+        bc_tab.meta['AKSGRID'] = np.array(bc_tab.meta['AKSGRID'].split(','), dtype=float)
+        bc_tables[key] = bc_tab
+
+    return bc_tables[key]
+
 # Little helper utility to get the magnitude of an object through a filter.
 def mag_in_filter(star, filt):
     """
@@ -1775,6 +3957,288 @@ def mag_in_filter(star, filt):
     star_mag = -2.5 * math.log10(star_flux / filt.flux0) + filt.mag0
     return star_mag
 
+def get_filter_weights(wave, filt):
+    """
+    Get the filter integration weights for spectra sampled on
+    a given wavelength grid, such that the filter-integrated flux is
+    a dot product: star_flux = np.dot(flux, weights).
+
+    The weights reproduce the tapered pysynphot Observation binned on
+    the filter wavelengths that mag_in_filter uses: the spectrum is
+    tapered and merged with the filter wavelengths and bin edges, the
+    product with the filter throughput is integrated with the trapezoid
+    rule in each bin, and the binned flux (in flam) is summed over the bins.
+
+    Parameters
+    ----------
+    wave : array
+        Wavelength grid of the spectra (Angstroms, increasing).
+
+    filt : pysynphot.spectrum.ArraySpectralElement
+        Filter object, as returned by get_filter_info.
+
+    Returns
+    -------
+    weights : array
+        Weights applied to the spectrum flux (in photlam) at each
+        point of wave.
+    """
+    wave = np.asarray(wave, dtype=float)
+    filt_wave = np.asarray(filt.wave, dtype=float)
+    filt_thru = np.asarray(filt.throughput, dtype=float)
+
+    # The tapered spectrum has an extra zero-flux point at each end.
+    wave_taper = np.concatenate(([wave[0]**2 / wave[1]], wave,
+                                 [wave[-1]**2 / wave[-2]]))
+
+    # Wavelengths where the observation is evaluated: the spectrum and filter
+    # wavelengths, plus the bin edges and bin centers (binset = filter wavelengths).
+    edges = binning.calculate_bin_edges(filt_wave)
+    sp_wave = spectrum.MergeWaveSets(wave_taper, filt_wave)
+    sp_wave = spectrum.MergeWaveSets(sp_wave, edges)
+    sp_wave = spectrum.MergeWaveSets(sp_wave, filt_wave)
+
+    # Trapezoid segments that fall within each bin.
+    indices = np.searchsorted(sp_wave, edges)
+    seg = np.arange(indices[0], indices[-1])
+    seg_bin = np.searchsorted(indices, seg, side='right') - 1
+    bin_width = sp_wave[indices[1:]] - sp_wave[indices[:-1]]
+
+    # Binned flux is converted to flam and multiplied by the bin spacing.
+    bin_diff = np.diff(filt_wave)
+    bin_diff = np.append(bin_diff, bin_diff[-1])
+    bin_scale = pysynphot.units.HC / filt_wave * bin_diff / bin_width
+
+    seg_wt = 0.5 * (sp_wave[seg+1] - sp_wave[seg]) * bin_scale[seg_bin]
+    node_wt = np.zeros(len(sp_wave), dtype=float)
+    node_wt[seg] += seg_wt
+    node_wt[seg+1] += seg_wt
+    node_wt *= np.interp(sp_wave, filt_wave, filt_thru)
+
+    # Spread the weights back onto the spectrum wavelengths, following the
+    # linear interpolation of the spectrum flux.
+    jj = np.searchsorted(wave_taper, sp_wave, side='right') - 1
+    jj = np.clip(jj, 0, len(wave_taper) - 2)
+    frac = (sp_wave - wave_taper[jj]) / (wave_taper[jj+1] - wave_taper[jj])
+    frac = np.clip(frac, 0, 1)
+
+    weights = np.bincount(jj, weights=node_wt * (1 - frac), minlength=len(wave_taper))
+    weights += np.bincount(jj + 1, weights=node_wt * frac, minlength=len(wave_taper))
+
+    # The tapered end points have zero flux.
+    return weights[1:-1]
+
+def mags_in_filters(spec_list, filt_list):
+    """
+    Get the magnitudes of many spectra through many filters at once.
+    Equivalent to calling mag_in_filter on every spectrum and filter.
+
+    Spectra that share a wavelength grid are stacked into a
+    (N_spec x N_wave) flux matrix and multiplied by the
+    (N_wave x N_filt) matrix of filter weights (see get_filter_weights).
+
+    Parameters
+    ----------
+    spec_list : list of pysynphot spectra
+        Spectra to get the magnitudes for. Assumes that extinction
+        has already been applied.
+
+    filt_list : list of pysynphot.spectrum.ArraySpectralElement
+        Filter objects, as returned by get_filter_info.
+
+    Returns
+    -------
+    mags : 2D numpy array
+        Magnitudes with shape (len(spec_list), len(filt_list)).
+    """
+    mags = np.zeros((len(spec_list), len(filt_list)), dtype=float)
+    flux0 = np.array([filt.flux0 for filt in filt_list])
+    mag0 = np.array([filt.mag0 for filt in filt_list])
+
+    # Group the spectra by wavelength grid.
+    groups = {}
+    for ss, star in enumerate(spec_list):
+        wave = np.asarray(star.wave, dtype=float)
+        key = wave.tobytes()
+        if key not in groups:
+            groups[key] = (wave, [])
+        groups[key][1].append(ss)
+
+    for wave, idx in groups.values():
+        # Spectra are evaluated in photlam, the pysynphot internal units.
+        flux = np.array([spec_list[ss](wave) for ss in idx])
+        weights = np.array([get_filter_weights(wave, filt) for filt in filt_list]).T
+
+        star_flux = np.dot(flux, weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mags[idx] = -2.5 * np.log10(star_flux / flux0) + mag0
+
+    return mags
+
+# Dtypes of the star_systems and companions columns for 
+# ResolvedCluster(precision='single'). The filter columns are float32.
+# mass_current is copied out of the interpolation buffer (as float64),
+# so that the float64 buffer can be freed.
+_single_precision_dtypes = {'Teff': np.float32,
+                            'L': np.float32,
+                            'logg': np.float32,
+                            'metallicity': np.float32,
+                            'mass_current': np.float64,
+                            'phase': np.int16,
+                            'isWR': bool,
+                            'isMultiple': bool,
+                            'N_companions': np.uint8}
+
+def columns_to_table(columns):
+    """
+    Make an astropy Table from a dict of numpy column arrays 
+    (e.g. from ResolvedCluster.iter_chunks with raw=True), without 
+    copying the columns.
+    """
+    return Table(columns, copy=False)
+
+class IsochroneInterpolator(object):
+    """
+    Linear interpolation of many isochrone columns in mass at once.
+
+    The columns are stacked into one (N_columns x N_iso) array. For each
+    call, the bracketing isochrone points and the interpolation weight of
+    each star are found with a single np.searchsorted, and all of the
+    columns are interpolated with one gather. This gives the same values as
+    one scipy.interpolate.interp1d(kind='linear', bounds_error=False,
+    fill_value=np.nan) per column, without repeating the search for
+    every column.
+
+    Parameters
+    ----------
+    mass: array
+        Mass of each isochrone point (does not need to be sorted).
+
+    columns: dict
+        Values of each column at the isochrone points, keyed on the
+        column name. A column can be 1D (N_iso) or 2D (N_iso x N),
+        e.g. magnitudes at each extinction of a grid.
+    """
+    def __init__(self, mass, columns):
+        mass = np.asarray(mass, dtype=float)
+        sdx = np.argsort(mass, kind='mergesort')
+        self.mass = mass[sdx]
+
+        # Stack all of the columns, with 2D columns flattened to
+        # several rows. Keep track of the rows of each column.
+        self.keys = list(columns.keys())
+        self._rows = {}
+        self._shapes = {}
+        values = []
+        n_rows = 0
+        for key in self.keys:
+            col = np.asarray(columns[key], dtype=float)[sdx]
+            col = col.reshape((len(mass), -1))
+            self._rows[key] = slice(n_rows, n_rows + col.shape[1])
+            self._shapes[key] = col.shape[1:] if np.ndim(columns[key]) > 1 else ()
+            values.append(col.T)
+            n_rows += col.shape[1]
+
+        self.values = np.ascontiguousarray(np.concatenate(values, axis=0))
+
+        return
+
+    def weights(self, mass):
+        """
+        Find the bracketing isochrone points (lo, lo+1) and the
+        interpolation weight of each mass. good is False for masses
+        outside of the isochrone mass range.
+        """
+        mass = np.asarray(mass, dtype=float)
+        hi = np.clip(np.searchsorted(self.mass, mass), 1, len(self.mass) - 1)
+        lo = hi - 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = (mass - self.mass[lo]) / (self.mass[hi] - self.mass[lo])
+
+        good = (mass >= self.mass[0]) & (mass <= self.mass[-1])
+
+        return lo, frac, good
+
+    def __call__(self, mass, keys=None):
+        """
+        Interpolate the columns to the masses.
+
+        Parameters
+        ----------
+        mass: array
+            Masses to interpolate to.
+
+        keys: list or None
+            Columns to interpolate. If None, all columns are interpolated.
+
+        Returns
+        -------
+        out: dict
+            Interpolated values of each column (NaN outside of the
+            isochrone mass range), keyed on the column name.
+        """
+        if keys is None:
+            keys = self.keys
+            values = self.values
+            rows = self._rows
+        else:
+            values = self.values[np.concatenate([np.arange(self._rows[key].start,
+                                                            self._rows[key].stop)
+                                                  for key in keys])]
+            rows = {}
+            n_rows = 0
+            for key in keys:
+                n = self._rows[key].stop - self._rows[key].start
+                rows[key] = slice(n_rows, n_rows + n)
+                n_rows += n
+
+        lo, frac, good = self.weights(mass)
+
+        # One gather of all columns at the two bracketing points.
+        out = values.take(lo, axis=1)
+        diff = values.take(lo + 1, axis=1)
+        diff -= out
+        diff *= frac
+        out += diff
+        out[:, ~good] = np.nan
+
+        result = {}
+        for key in keys:
+            col = out[rows[key]]
+            if self._shapes[key] == ():
+                result[key] = col[0]
+            else:
+                result[key] = col.T.reshape((-1,) + self._shapes[key])
+
+        return result
+
+    def column(self, key):
+        """
+        Return a function that interpolates one column, e.g. for code that
+        used one interp1d per column. The function can be pickled
+        (e.g. to send a cluster to other processes).
+        """
+        return functools.partial(self._interp_column, key=key)
+
+    def _interp_column(self, mass, key=None):
+        return self(np.atleast_1d(mass), keys=[key])[key]
+
+def interp_AKs_grid(mag_grid, AKs_grid, AKs):
+    """
+    Interpolate the magnitudes of each star (N_stars x N_AKs), given at
+    each extinction in AKs_grid, to the extinction AKs of each star.
+    The interpolation is linear in AKs.
+    """
+    if len(AKs_grid) == 1:
+        return mag_grid[:, 0]
+
+    aa = np.clip(np.searchsorted(AKs_grid, AKs), 1, len(AKs_grid) - 1)
+    frac = (AKs - AKs_grid[aa-1]) / (AKs_grid[aa] - AKs_grid[aa-1])
+    rows = np.arange(len(AKs))
+
+    return (1 - frac) * mag_grid[rows, aa-1] + frac * mag_grid[rows, aa]
+
 def match_model_mass(isoMasses,theMass):
     dm = np.abs(isoMasses - theMass)
     mdx = dm.argmin()
@@ -1786,9 +4250,25 @@ def match_model_mass(isoMasses,theMass):
         return mdx
 
 def match_model_masses(isoMasses, starMasses):
-    kdt = KDTree( isoMasses.reshape((len(isoMasses), 1)) )
-    q_results = kdt.query(starMasses.reshape((len(starMasses), 1)), k=1)
-    indices = q_results[1]
+    """
+    Vectorized match_model_mass: the index of the closest isochrone mass
+    of each star (with one np.searchsorted), or -1 if it is more than 10% 
+    away from the star mass.
+    """
+    isoMasses = np.asarray(isoMasses, dtype=float)
+    starMasses = np.asarray(starMasses, dtype=float)
+    
+    sdx = np.argsort(isoMasses)
+    iso_sorted = isoMasses[sdx]
+
+    hi = np.clip(np.searchsorted(iso_sorted, starMasses), 1, max(len(iso_sorted) - 1, 1))
+    lo = hi - 1
+    if len(iso_sorted) == 1:
+        hi = lo
+
+    # The closest of the two neighboring isochrone masses
+    closer_lo = (starMasses - iso_sorted[lo]) <= (iso_sorted[hi] - starMasses)
+    indices = sdx[np.where(closer_lo, lo, hi)]
 
     dm_frac = np.abs(starMasses - isoMasses[indices]) / starMasses
 
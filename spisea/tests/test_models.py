@@ -103,6 +103,31 @@ def test_atmosphere_models():
     
     return
 
+def test_atmosphere_batch():
+    """
+    Test that the batched atmospheres match get_merged_atmosphere
+    star by star, across the grid transitions.
+    """
+    from spisea import atmospheres as atm
+    import numpy as np
+
+    temp_arr = np.array([2000, 3500, 4000, 5250, 6000, 12000, 30000])
+    logg_arr = np.array([5.0, 4.5, 4.5, 4.0, 4.0, 3.5, 4.0])
+
+    t1 = time.time()
+    atm_batch = atm.get_merged_atmosphere_batch(metallicity=0, temperature=temp_arr,
+                                                gravity=logg_arr)
+    print('get_merged_atmosphere_batch: %.2f seconds' % (time.time() - t1))
+
+    assert len(atm_batch) == len(temp_arr)
+
+    for ii in range(len(temp_arr)):
+        sp = atm.get_merged_atmosphere(metallicity=0, temperature=temp_arr[ii],
+                                       gravity=logg_arr[ii])
+        np.testing.assert_allclose(atm_batch[ii](sp.wave), sp(sp.wave), rtol=1e-6)
+
+    return
+
 def test_filters():
     """
     Test to make sure all of the filters work as expected
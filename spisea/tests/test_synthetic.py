@@ -7,7 +7,8 @@ from spisea import synthetic as syn
 from spisea.imf import imf
 from spisea.imf import multiplicity
 import pysynphot
-import os
+from astropy import table
+import os, shutil
 import pdb
 from scipy.spatial import cKDTree as KDTree
 
@@ -142,8 +143,9 @@ def test_IsochronePhot(plot=False):
         iso.plot_mass_magnitude('mag160w')
 
     # Finally, let's test the isochronePhot file generation
-    assert os.path.exists('{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_p00.fits'.format(iso_dir, logAge,
-                                                                                AKs, str(distance).zfill(5)))
+    assert os.path.exists(iso.save_file)
+    assert os.path.basename(iso.save_file).startswith('iso_{0:.2f}_{1:4.2f}_{2:4s}_p00_'.format(logAge,
+                                                                                               AKs, str(distance).zfill(5)))
     
     # Check 1: If we try to remake the isochrone, does it read the file rather than
     # making a new one
@@ -182,6 +184,237 @@ def test_IsochronePhot(plot=False):
 
     assert iso_new.recalc == True
 
+    # Check 3: Changing the filters also makes a new isochrone,
+    # without overwriting the original one
+    iso_new = syn.IsochronePhot(logAge, AKs, distance, evo_model=evo_model,
+                                atm_func=atm_func, red_law=redlaw,
+                                filters=filt_list[:1],
+                                mass_sampling=1, iso_dir=iso_dir)
+
+    assert iso_new.recalc == True
+    assert iso_new.save_file != iso.save_file
+    assert os.path.exists(iso.save_file)
+
+    return
+
+def test_IsochroneCache():
+    """
+    Test the hit/miss statistics and LRU eviction of the isochrone cache.
+    """
+    iso_dir = 'iso_cache/'
+    if os.path.exists(iso_dir):
+        shutil.rmtree(iso_dir)
+    os.mkdir(iso_dir)
+
+    cache = syn.IsochroneCache(iso_dir, max_size=250)
+
+    files = []
+    for ii in range(3):
+        params = {'logAge': 6.0 + ii, 'AKs': 0.0, 'distance': 1000.0, 'metallicity': 0.0}
+        key = cache.get_key(params)
+        save_file = cache.get_file(key, params)
+        
+        assert cache.lookup(key) is None
+        
+        with open(save_file, 'w') as _out:
+            _out.write('x' * 100)
+        cache.add(key, params, save_file)
+        files.append((key, save_file))
+
+        assert cache.lookup(key) == save_file
+
+    # Only the last two files fit
+    assert not os.path.exists(files[0][1])
+    assert cache.lookup(files[0][0]) is None
+    assert cache.lookup(files[2][0]) == files[2][1]
+
+    stats = cache.stats()
+    assert stats['files'] == 2
+    assert stats['size'] == 200
+    assert stats['hits'] == 4
+    assert stats['misses'] == 4
+
+    # Checks without recording them don't change the stats
+    assert cache.lookup(files[0][0], record=False) is None
+    assert cache.lookup(files[2][0], record=False) == files[2][1]
+    stats2 = cache.stats()
+    assert stats2['hits'] == stats['hits']
+    assert stats2['misses'] == stats['misses']
+
+    return
+
+def test_make_isochrone_grid():
+    """
+    Test the parallel isochrone grid, and that a second run
+    skips the isochrones that are already made.
+    """
+    iso_dir = 'iso_grid/'
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    manifest = syn.make_isochrone_grid([6.7, 7.0], [1.0, 2.0], [4000], iso_dir=iso_dir,
+                                       mass_sampling=20, filters=filt_list, n_proc=2)
+
+    assert len(manifest['points']) == 4
+    for point in manifest['points']:
+        assert point['status'] == 'done'
+        assert os.path.exists(os.path.join(iso_dir, point['file']))
+
+    assert os.path.exists(os.path.join(iso_dir, 'iso_grid_manifest.json'))
+
+    # Nothing is remade
+    misses = syn.IsochroneCache(iso_dir).stats()['misses']
+    manifest = syn.make_isochrone_grid([6.7, 7.0], [1.0, 2.0], [4000], iso_dir=iso_dir,
+                                       mass_sampling=20, filters=filt_list, n_proc=2)
+
+    assert syn.IsochroneCache(iso_dir).stats()['misses'] == misses
+    for point in manifest['points']:
+        assert point['status'] == 'done'
+        assert point['attempts'] == 0
+
+    return
+
+def test_IsochronePhot_from_spectra():
+    """
+    Test that an isochrone made from the saved surface spectra of
+    another extinction and distance matches one made from scratch.
+    """
+    logAge = 6.7
+    filt_list = ['wfc3,ir,f127m', 'nirc2,Kp']
+    iso_dir = 'iso_spec/'
+    redlaw = reddening.RedLawHosek18b()
+
+    iso1 = syn.IsochronePhot(logAge, 1.0, 4000, mass_sampling=10, filters=filt_list,
+                             iso_dir=iso_dir, recomp=True)
+    assert os.path.exists(iso1.spec_file)
+
+    startTime = time.time()
+    iso2 = syn.IsochronePhot(logAge, 2.5, 8000, mass_sampling=10, filters=filt_list,
+                             iso_dir=iso_dir, red_law=redlaw)
+    print('IsochronePhot from spectra: %.2f seconds' % (time.time() - startTime))
+
+    assert iso2.recalc == True
+    assert iso2.spec_file == iso1.spec_file
+
+    iso3 = syn.IsochronePhot(logAge, 2.5, 8000, mass_sampling=10, filters=filt_list,
+                             iso_dir='iso_nospec/', red_law=redlaw, recomp=True,
+                             save_spectra=False)
+
+    assert iso2.points.meta['AKS'] == 2.5
+    assert iso2.points.meta['DISTANCE'] == 8000
+    for filt in filt_list:
+        col = 'm_' + syn.get_filter_col_name(filt)
+        np.testing.assert_allclose(iso2.points[col], iso3.points[col], atol=1e-6)
+
+    return
+
+def test_IsochronePhot_distance():
+    """
+    Test that an isochrone at a new distance is shifted
+    from the saved isochrone at another distance.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+    iso_dir = 'iso_dist/'
+
+    iso1 = syn.IsochronePhot(logAge, AKs, 4000, mass_sampling=10, filters=filt_list,
+                             iso_dir=iso_dir, recomp=True)
+    iso2 = syn.IsochronePhot(logAge, AKs, 8000, mass_sampling=10, filters=filt_list,
+                             iso_dir=iso_dir)
+
+    assert iso2.recalc == True
+    assert iso2.points.meta['DISTANCE'] == 8000
+    assert iso2.points.meta['DISTSRC'] == os.path.basename(iso1.save_file)
+    assert os.path.exists(iso2.save_file)
+
+    for filt in filt_list:
+        col = 'm_' + syn.get_filter_col_name(filt)
+        np.testing.assert_allclose(iso2.points[col] - iso1.points[col], 5 * np.log10(2))
+
+    return
+
+def test_IsochronePhot_add_filters():
+    """
+    Test that only the missing filters are added to a saved
+    isochrone, and that they match the photometry from scratch.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    iso_dir = 'iso_filt/'
+
+    iso1 = syn.IsochronePhot(logAge, AKs, distance, mass_sampling=10,
+                             filters=['nirc2,J'], iso_dir=iso_dir, recomp=True)
+    iso2 = syn.IsochronePhot(logAge, AKs, distance, mass_sampling=10,
+                             filters=['nirc2,J', 'nirc2,Kp'], iso_dir=iso_dir)
+
+    assert iso2.recalc == True
+    assert iso2.points.meta['FILTSRC'] == os.path.basename(iso1.save_file)
+    np.testing.assert_array_equal(iso2.points['m_nirc2_J'], iso1.points['m_nirc2_J'])
+
+    iso3 = syn.IsochronePhot(logAge, AKs, distance, mass_sampling=10,
+                             filters=['nirc2,Kp'], iso_dir='iso_filt_new/', recomp=True)
+    np.testing.assert_allclose(iso2.points['m_nirc2_Kp'], iso3.points['m_nirc2_Kp'], atol=1e-6)
+
+    return
+
+def test_mags_in_filters():
+    """
+    Test that the vectorized synthetic photometry matches
+    mag_in_filter for every star and filter.
+    """
+    logAge = 6.7
+    AKs = 2.7
+    distance = 4000
+    filt_list = ['wfc3,ir,f127m', 'nirc2,J', 'nirc2,Kp', 'ubv,V']
+
+    iso = syn.Isochrone(logAge, AKs, distance, mass_sampling=10)
+    filt_info = [syn.get_filter_info(filt) for filt in filt_list]
+
+    startTime = time.time()
+    mags = syn.mags_in_filters(iso.spec_list, filt_info)
+    print('mags_in_filters: %.2f seconds' % (time.time() - startTime))
+
+    assert mags.shape == (len(iso.spec_list), len(filt_list))
+
+    for ff in range(len(filt_list)):
+        for ss in range(len(iso.spec_list)):
+            mag = syn.mag_in_filter(iso.spec_list[ss], filt_info[ff])
+            np.testing.assert_allclose(mags[ss, ff], mag, atol=1e-4)
+
+    return
+
+def test_IsochronePhot_bc():
+    """
+    Test that the photometry from the bolometric correction
+    tables matches the photometry from the spectra.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+    atm_func = atmospheres.get_castelli_atmosphere
+    bc_dir = 'bc_tables/'
+
+    syn.make_bc_tables(filters=filt_list, atm_grids=['ck04models'], bc_dir=bc_dir,
+                       AKs_grid=[0.0, 1.0, 2.0])
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, atm_func=atm_func,
+                            mass_sampling=10, min_mass=2, filters=filt_list,
+                            iso_dir='iso/', recomp=True)
+
+    startTime = time.time()
+    iso_bc = syn.IsochronePhot(logAge, AKs, distance, atm_func=atm_func,
+                               mass_sampling=10, min_mass=2, filters=filt_list,
+                               iso_dir='iso_bc/', recomp=True, bc_dir=bc_dir)
+    print('IsochronePhot with BC tables: %.2f seconds' % (time.time() - startTime))
+
+    assert iso_bc.points.meta['PHOTMODE'] == 'BC'
+    assert len(iso_bc.spec_list) == 0
+
+    for filt in filt_list:
+        col = 'm_' + syn.get_filter_col_name(filt)
+        np.testing.assert_allclose(iso_bc.points[col], iso.points[col], atol=1e-4)
 
     return
 
@@ -381,6 +614,423 @@ def test_ResolvedClusterDiffRedden():
 
     return
     
+def test_ResolvedCluster_set_extinction():
+    """
+    Test the per-star extinction from the isochrone AKs grid.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+    AKs_grid = [0.5, 1.0, 1.5]
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5, iso_dir='iso_aks/', AKs_grid=AKs_grid)
+
+    # The grid photometry at the isochrone AKs is the isochrone photometry
+    for filt in filt_list:
+        col = syn.get_filter_col_name(filt)
+        assert iso.points['mgrid_' + col].shape == (len(iso.points), len(AKs_grid))
+        np.testing.assert_allclose(iso.points['mgrid_' + col][:, 1], iso.points['m_' + col],
+                                   atol=1e-6)
+
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.08, 0.5, 1, 120]), np.array([-1.3, -2.3, -2.3]),
+                                     multiplicity=imf_multi)
+    cluster = syn.ResolvedCluster(iso, my_imf, 10**4, seed=1)
+    mag_orig = np.array(cluster.star_systems['m_nirc2_Kp'])
+
+    # Same extinction: same photometry
+    cluster.set_extinction(AKs)
+    np.testing.assert_allclose(cluster.star_systems['m_nirc2_Kp'], mag_orig, atol=1e-6)
+
+    # Per-star extinction
+    AKs_star = np.random.uniform(0.5, 1.5, len(cluster.star_systems))
+    cluster.set_extinction(AKs_star)
+    np.testing.assert_array_equal(cluster.star_systems['AKs_f'], AKs_star)
+    
+    dmag = cluster.star_systems['m_nirc2_Kp'] - mag_orig
+    good = np.isfinite(dmag)
+    assert np.all(np.sign(dmag[good]) == np.sign(AKs_star[good] - AKs))
+
+    return
+
+def test_IsochroneInterpolator():
+    """
+    Test that the shared interpolator gives the same values as one
+    interp1d per column.
+    """
+    from scipy import interpolate
+
+    rng = np.random.default_rng(0)
+    iso_mass = rng.uniform(0.1, 10, 50)
+    columns = {'Teff': rng.uniform(3000, 30000, 50),
+               'm_J': rng.uniform(5, 20, 50),
+               'mgrid_J': rng.uniform(5, 20, (50, 3))}
+    interp = syn.IsochroneInterpolator(iso_mass, columns)
+
+    # Include masses outside of the isochrone and on the isochrone points
+    mass = np.concatenate([rng.uniform(0.05, 12, 1000), iso_mass])
+    out = interp(mass)
+
+    for key in columns:
+        f = interpolate.interp1d(iso_mass, columns[key], kind='linear',
+                                 bounds_error=False, fill_value=np.nan, axis=0)
+        np.testing.assert_allclose(out[key], f(mass), rtol=1e-12)
+        np.testing.assert_allclose(interp.column(key)(mass), f(mass), rtol=1e-12)
+
+    assert out['mgrid_J'].shape == (len(mass), 3)
+    assert np.all(np.isnan(out['Teff'][mass > iso_mass.max()]))
+
+    # A subset of the columns
+    out_j = interp(mass, keys=['m_J'])
+    assert list(out_j.keys()) == ['m_J']
+    np.testing.assert_array_equal(out_j['m_J'], out['m_J'])
+
+    return
+
+def test_ResolvedCluster_precision():
+    """
+    Test the single precision tables of ResolvedCluster.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5)
+
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cl_d = syn.ResolvedCluster(iso, my_imf, 10**4, seed=3)
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cl_s = syn.ResolvedCluster(iso, my_imf, 10**4, seed=3, precision='single')
+
+    assert cl_s.star_systems['m_nirc2_Kp'].dtype == np.float32
+    assert cl_s.star_systems['Teff'].dtype == np.float32
+    assert cl_s.star_systems['phase'].dtype == np.int16
+    assert cl_s.star_systems['isWR'].dtype == bool
+    assert cl_s.star_systems['isMultiple'].dtype == bool
+    assert cl_s.star_systems['N_companions'].dtype == np.uint8
+    assert cl_s.star_systems['mass'].dtype == np.float64
+    assert cl_s.companions['m_nirc2_Kp'].dtype == np.float32
+
+    # Same stars, with photometry that agrees to float32 precision
+    np.testing.assert_array_equal(cl_s.star_systems['mass'], cl_d.star_systems['mass'])
+    for tab_s, tab_d in [(cl_s.star_systems, cl_d.star_systems), (cl_s.companions, cl_d.companions)]:
+        for col in ['m_nirc2_J', 'm_nirc2_Kp', 'Teff', 'logg']:
+            np.testing.assert_allclose(tab_s[col], tab_d[col], rtol=1e-6)
+        
+        good = np.isfinite(tab_d['phase'])
+        np.testing.assert_array_equal(tab_s['phase'][good], tab_d['phase'][good])
+        assert np.all(tab_s['phase'][~good] == -99)
+
+    return
+
+def test_ResolvedCluster_mag_limit():
+    """
+    Test the magnitude-limited ResolvedCluster.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5)
+
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    M_cl = 10**4
+    mag_limit = 18.0
+
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+    cluster = syn.ResolvedCluster(iso, my_imf, M_cl, seed=1)
+    
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers)
+    cl_lim = syn.ResolvedCluster(iso, my_imf, M_cl, seed=1, mag_limit=mag_limit,
+                                 mag_limit_filter='nirc2,Kp')
+
+    # All the stars brighter than the limit are above the mass cut
+    assert cl_lim.min_mass is not None
+    bright = cluster.star_systems['m_nirc2_Kp'] <= mag_limit
+    assert cluster.star_systems['mass'][bright].min() >= cl_lim.min_mass
+    assert cl_lim.star_systems['mass'].min() >= cl_lim.min_mass
+    assert len(cl_lim.star_systems) < len(cluster.star_systems)
+
+    # The skipped systems are in the meta
+    assert cl_lim.star_systems.meta['N_UNRES'] == cl_lim.unresolved_number
+    assert cl_lim.unresolved_mass > 0
+    assert np.abs(M_cl - cl_lim.unresolved_mass - cl_lim.star_systems['systemMass'].sum()) < 100.0
+
+    # The number of bright stars agrees
+    n_bright = bright.sum()
+    n_bright_lim = (cl_lim.star_systems['m_nirc2_Kp'] <= mag_limit).sum()
+    assert np.abs(n_bright - n_bright_lim) < 5 * np.sqrt(n_bright)
+
+    # With multiples (at most CSF_max companions), the cut is lowered so 
+    # that the systems with bright companions are kept.
+    imf_multi = multiplicity.MultiplicityUnresolved(companion_max=True)
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cluster = syn.ResolvedCluster(iso, my_imf, M_cl, seed=1)
+    
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cl_multi = syn.ResolvedCluster(iso, my_imf, M_cl, seed=1, mag_limit=mag_limit,
+                                   mag_limit_filter='nirc2,Kp')
+
+    assert cl_multi.min_mass is not None
+    assert cl_multi.min_mass <= cl_lim.min_mass
+    bright = cluster.star_systems['m_nirc2_Kp'] <= mag_limit
+    assert cluster.star_systems['mass'][bright].min() >= cl_multi.min_mass
+    assert cl_multi.star_systems['mass'].min() >= cl_multi.min_mass
+    
+    assert cl_multi.star_systems.meta['N_UNRES'] == cl_multi.unresolved_number
+    assert np.abs(M_cl - cl_multi.unresolved_mass - cl_multi.star_systems['systemMass'].sum()) < 200.0
+
+    # The number of skipped systems and bright systems agree with the full cluster
+    below = cluster.star_systems['mass'] < cl_multi.min_mass
+    assert np.abs(below.sum() - cl_multi.unresolved_number) < 0.05 * below.sum()
+    n_bright = bright.sum()
+    n_bright_lim = (cl_multi.star_systems['m_nirc2_Kp'] <= mag_limit).sum()
+    assert np.abs(n_bright - n_bright_lim) < 5 * np.sqrt(n_bright)
+
+    return
+
+def test_WeightedResolvedCluster():
+    """
+    Test the weighted super-particle cluster against a sampled cluster.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5)
+
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    M_cl = 10**5
+    
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cluster = syn.ResolvedCluster(iso, my_imf, M_cl, seed=1)
+    
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cl_w = syn.WeightedResolvedCluster(iso, my_imf, M_cl, 2000, seed=1)
+
+    assert len(cl_w.star_systems) <= 2000
+    np.testing.assert_array_equal(cl_w.companions['weight'],
+                                  cl_w.star_systems['weight'][cl_w.companions['system_idx']])
+
+    # Weighted mass and luminosity function agree with the sampled cluster
+    w = cl_w.star_systems['weight']
+    assert np.abs((w * cl_w.star_systems['systemMass']).sum() / 
+                  cluster.star_systems['systemMass'].sum() - 1) < 0.02
+
+    bins = np.arange(8, 24, 2.0)
+    lf = syn.HistogramReducer(['m_nirc2_Kp'], [bins])
+    lf_w = syn.HistogramReducer(['m_nirc2_Kp'], [bins], weight_column='weight')
+    cluster.reduce([lf])
+    cl_w.reduce([lf_w])
+
+    good = lf.hist > 100
+    np.testing.assert_allclose(lf_w.hist[good], lf.hist[good], rtol=0.2)
+
+    # Integrated flux
+    flux = np.nansum(10**(-0.4 * cluster.star_systems['m_nirc2_Kp']))
+    flux_w = np.nansum(w * 10**(-0.4 * cl_w.star_systems['m_nirc2_Kp']))
+    assert np.abs(flux_w / flux - 1) < 0.3
+
+    return
+
+def test_ResolvedCluster_chunks():
+    """
+    Test the chunked and streamed ResolvedCluster.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5)
+
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    massLimits = np.array([0.08, 0.5, 1, 120])
+    powers = np.array([-1.3, -2.3, -2.3])
+    
+    M_cl = 10**5
+    chunk_mass = 2 * 10**4
+
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    cluster = syn.ResolvedCluster(iso, my_imf, M_cl, seed=5, chunk_mass=chunk_mass)
+
+    assert np.abs(M_cl - cluster.star_systems['systemMass'].sum()) < 200.0
+    assert len(cluster.companions) == cluster.star_systems['N_companions'].sum()
+    comp_sys = cluster.star_systems[cluster.companions['system_idx']]
+    assert np.all(comp_sys['N_companions'] > 0)
+
+    # Streaming gives the same tables, one chunk at a time
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    stream = syn.ResolvedCluster(iso, my_imf, M_cl, seed=5, chunk_mass=chunk_mass,
+                                 stream=True)
+    assert not hasattr(stream, 'star_systems')
+
+    chunks = list(stream.iter_chunks())
+    assert len(chunks) > 1
+    
+    star_systems = table.vstack([chunk[0] for chunk in chunks])
+    companions = table.vstack([chunk[1] for chunk in chunks])
+    for col in ['mass', 'systemMass', 'm_nirc2_Kp']:
+        np.testing.assert_array_equal(star_systems[col], cluster.star_systems[col])
+    for col in ['system_idx', 'mass', 'm_nirc2_Kp']:
+        np.testing.assert_array_equal(companions[col], cluster.companions[col])
+
+    # Written chunks
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    stream = syn.ResolvedCluster(iso, my_imf, M_cl, seed=5, chunk_mass=chunk_mass,
+                                 stream=True)
+    files = stream.write_chunks('cluster_chunk', overwrite=True)
+    assert len(files) == len(chunks)
+    
+    sys_read = table.vstack([table.Table.read(ff[0]) for ff in files])
+    np.testing.assert_array_equal(sys_read['mass'], cluster.star_systems['mass'])
+    
+    for ff in files:
+        os.remove(ff[0])
+        os.remove(ff[1])
+
+    # Raw columns (dicts of numpy arrays) without astropy Tables
+    my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+    stream = syn.ResolvedCluster(iso, my_imf, M_cl, seed=5, chunk_mass=chunk_mass,
+                                 stream=True)
+    raw_chunks = list(stream.iter_chunks(raw=True))
+    assert isinstance(raw_chunks[0][0], dict)
+    assert isinstance(raw_chunks[0][0]['mass'], np.ndarray)
+    
+    sys_raw = np.concatenate([chunk[0]['m_nirc2_Kp'] for chunk in raw_chunks])
+    np.testing.assert_array_equal(sys_raw, cluster.star_systems['m_nirc2_Kp'])
+    
+    comp_table = syn.columns_to_table(raw_chunks[0][1])
+    assert comp_table.colnames == chunks[0][1].colnames
+
+    return
+
+def test_ClusterEnsemble():
+    """
+    Test many realizations of a cluster sharing one isochrone.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5)
+
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.08, 0.5, 1, 120]), np.array([-1.3, -2.3, -2.3]),
+                                     multiplicity=imf_multi)
+    M_cl = 10**4
+    N_real = 4
+
+    ens = syn.ClusterEnsemble(iso, my_imf, M_cl, seed=3)
+    star_systems, companions = ens.generate(N_real)
+
+    assert len(star_systems) == N_real
+    assert len(companions) == N_real
+    for ii in range(N_real):
+        assert np.abs(M_cl - star_systems[ii]['systemMass'].sum()) < 120.0
+        assert len(companions[ii]) == star_systems[ii]['N_companions'].sum()
+
+    # Different realizations
+    assert len(star_systems[0]) != len(star_systems[1]) or \
+        np.any(star_systems[0]['mass'] != star_systems[1]['mass'])
+
+    # Same seed, same realizations, also in parallel and concatenated
+    ens = syn.ClusterEnsemble(iso, my_imf, M_cl, seed=3)
+    star_systems_all, companions_all = ens.generate(N_real, n_proc=2, concatenate=True)
+
+    np.testing.assert_array_equal(np.unique(star_systems_all['realization']), np.arange(N_real))
+    for ii in range(N_real):
+        sdx = star_systems_all['realization'] == ii
+        np.testing.assert_array_equal(star_systems_all['mass'][sdx], star_systems[ii]['mass'])
+        np.testing.assert_array_equal(star_systems_all['m_nirc2_Kp'][sdx],
+                                      star_systems[ii]['m_nirc2_Kp'])
+
+    comp_sys = star_systems_all[companions_all['system_idx']]
+    np.testing.assert_array_equal(comp_sys['realization'], companions_all['realization'])
+    assert np.all(comp_sys['N_companions'] > 0)
+
+    return
+
+def test_ClusterEnsemble_reduce():
+    """
+    Test the statistics of cluster realizations with reducers.
+    """
+    logAge = 6.7
+    AKs = 1.0
+    distance = 4000
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+
+    iso = syn.IsochronePhot(logAge, AKs, distance, filters=filt_list,
+                            mass_sampling=5)
+
+    imf_multi = multiplicity.MultiplicityUnresolved()
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.08, 0.5, 1, 120]), np.array([-1.3, -2.3, -2.3]),
+                                     multiplicity=imf_multi)
+    my_ifmr = ifmr.IFMR_Raithel18()
+    M_cl = 10**4
+    N_real = 3
+
+    kp_bins = np.arange(10, 30, 0.5)
+    col_bins = np.arange(0, 5, 0.25)
+
+    def make_reducers():
+        return [syn.HistogramReducer(['m_nirc2_Kp'], [kp_bins]),
+                syn.HistogramReducer([('m_nirc2_J', 'm_nirc2_Kp'), 'm_nirc2_Kp'], [col_bins, kp_bins]),
+                syn.PhaseReducer()]
+
+    # Reduced statistics are the same as from the tables
+    ens = syn.ClusterEnsemble(iso, my_imf, M_cl, ifmr=my_ifmr, seed=2)
+    star_systems, companions = ens.generate(N_real, concatenate=True)
+
+    ens = syn.ClusterEnsemble(iso, my_imf, M_cl, ifmr=my_ifmr, seed=2)
+    lf, cmd, phases = ens.reduce(N_real, make_reducers())
+
+    lf_good, edges = np.histogram(star_systems['m_nirc2_Kp'], bins=kp_bins)
+    np.testing.assert_array_equal(lf.hist, lf_good)
+    assert cmd.hist.shape == (len(col_bins) - 1, len(kp_bins) - 1)
+    np.testing.assert_array_equal(cmd.hist.sum(axis=0), lf_good)
+
+    for phase_code in [101, 102, 103]:
+        n_phase = (star_systems['phase'] == phase_code).sum() + (companions['phase'] == phase_code).sum()
+        assert phases.counts.get(phase_code, 0) == n_phase
+
+    n_good = np.isfinite(star_systems['phase']).sum() + np.isfinite(companions['phase']).sum()
+    assert sum(phases.counts.values()) == n_good
+    mass_tot = np.nansum(star_systems['mass_current']) + np.nansum(companions['mass_current'])
+    np.testing.assert_allclose(sum(phases.sums['mass_current'].values()), mass_tot)
+    
+    # Reducing chunks of each realization
+    ens = syn.ClusterEnsemble(iso, my_imf, M_cl, ifmr=my_ifmr, seed=2, chunk_mass=2000)
+    lf, cmd, phases_chunk = ens.reduce(N_real, make_reducers())
+    mass_tot_chunk = sum(phases_chunk.sums['mass_current'].values())
+    assert np.abs(mass_tot_chunk / mass_tot - 1) < 0.2
+
+    # Merging reducers
+    lf2 = syn.HistogramReducer(['m_nirc2_Kp'], [kp_bins])
+    lf2.merge(lf)
+    lf2.merge(lf)
+    np.testing.assert_array_equal(lf2.hist, 2 * lf.hist)
+
+    return
+
 def test_UnresolvedCluster():
     log_age = 6.7
     AKs = 0.0
@@ -408,6 +1058,154 @@ def test_UnresolvedCluster():
 
     return
 
+def test_UnresolvedCluster_integrate():
+    """
+    Test the integrated-light spectrum from the IMF integration.
+    """
+    log_age = 6.7
+    AKs = 0.0
+    distance = 4000
+    metallicity=0
+    cluster_mass = 10**4.
+
+    imf_in = imf.Kroupa_2001()
+    evo = evolution.MergedBaraffePisaEkstromParsec()
+    atm_func = atmospheres.get_merged_atmosphere
+    iso = syn.Isochrone(log_age, AKs, distance, metallicity=metallicity,
+                            evo_model=evo, atm_func=atm_func, mass_sampling=10)
+
+    cluster = syn.UnresolvedCluster(iso, imf_in, cluster_mass, integrate=True)
+    assert len(cluster.iso_numbers) == len(iso.points)
+    assert np.all(cluster.iso_numbers >= 0)
+    assert cluster.mass_tot <= cluster_mass
+    assert cluster.mass_tot > 0.5 * cluster_mass
+
+    # The same spectrum for any cluster mass (scaled)
+    imf_in = imf.Kroupa_2001()
+    cluster2 = syn.UnresolvedCluster(iso, imf_in, 2 * cluster_mass, integrate=True)
+    np.testing.assert_allclose(cluster2.spec_trim, 2 * cluster.spec_trim, rtol=1e-6)
+
+    # It agrees with the mean of random draws of the cluster, in the
+    # well-populated (low-mass) isochrone points, with and without multiples.
+    n_draws = 5
+    for imf_multi in [None, multiplicity.MultiplicityUnresolved()]:
+        imf_in = imf.Kroupa_2001(multiplicity=imf_multi)
+        cluster = syn.UnresolvedCluster(iso, imf_in, cluster_mass, integrate=True)
+        
+        numbers = np.zeros(len(iso.points))
+        for seed in range(n_draws):
+            imf_in = imf.Kroupa_2001(multiplicity=imf_multi)
+            cluster_s = syn.UnresolvedCluster(iso, imf_in, cluster_mass, seed=seed)
+            assert len(cluster.wave_trim) == len(cluster_s.wave_trim)
+            numbers += cluster_s.iso_numbers
+        numbers /= n_draws
+
+        full = cluster.iso_numbers > 500
+        assert full.sum() > 3
+        np.testing.assert_allclose(numbers[full], cluster.iso_numbers[full], rtol=0.1)
+        assert np.abs(numbers[full].sum() - cluster.iso_numbers[full].sum()) < 0.03 * cluster.iso_numbers[full].sum()
+
+    # Multiples take up some of the cluster mass, so there are fewer stars
+    imf_in = imf.Kroupa_2001(multiplicity=multiplicity.MultiplicityUnresolved())
+    cluster_m = syn.UnresolvedCluster(iso, imf_in, cluster_mass, integrate=True)
+    imf_in = imf.Kroupa_2001()
+    cluster_1 = syn.UnresolvedCluster(iso, imf_in, cluster_mass, integrate=True)
+    assert cluster_m.iso_numbers.sum() < 0.95 * cluster_1.iso_numbers.sum()
+    assert cluster_m.mass_tot <= cluster_mass
+
+    return
+
+def test_UnresolvedCluster_integrate_mean():
+    """
+    Test that the integrated-light spectrum and mass are the mean of 
+    the sampled clusters, with and without multiples.
+    """
+    log_age = 6.7
+    AKs = 0.0
+    distance = 4000
+    cluster_mass = 10**4.
+
+    evo = evolution.MergedBaraffePisaEkstromParsec()
+    atm_func = atmospheres.get_merged_atmosphere
+    iso = syn.Isochrone(log_age, AKs, distance, evo_model=evo, 
+                        atm_func=atm_func, mass_sampling=10)
+
+    # Without the most massive stars, that make single clusters scatter a lot
+    massLimits = np.array([0.08, 0.5, 1, 5])
+    powers = np.array([-1.3, -2.3, -2.3])
+    n_draws = 10
+    
+    for imf_multi in [None, multiplicity.MultiplicityUnresolved()]:
+        my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+        cluster = syn.UnresolvedCluster(iso, my_imf, cluster_mass, integrate=True)
+
+        mass_tot = np.zeros(n_draws)
+        spec_tot = np.zeros((n_draws, len(cluster.spec_tot_full)))
+        for seed in range(n_draws):
+            my_imf = imf.IMF_broken_powerlaw(massLimits, powers, multiplicity=imf_multi)
+            cluster_s = syn.UnresolvedCluster(iso, my_imf, cluster_mass, seed=seed)
+            mass_tot[seed] = cluster_s.mass_tot
+            spec_tot[seed] = cluster_s.spec_tot_full
+
+        np.testing.assert_allclose(mass_tot.mean(), cluster.mass_tot, rtol=0.02)
+        np.testing.assert_allclose(spec_tot.mean(axis=0).sum(), cluster.spec_tot_full.sum(), rtol=0.05)
+
+        # The spectral shape too, where there is flux
+        bright = cluster.spec_tot_full > 0.1 * cluster.spec_tot_full.max()
+        np.testing.assert_allclose(spec_tot.mean(axis=0)[bright], cluster.spec_tot_full[bright], rtol=0.1)
+
+    return
+
+def test_UnresolvedCluster_sampled():
+    """
+    Test the binned spectrum sum of the sampled UnresolvedCluster.
+    """
+    log_age = 6.7
+    AKs = 0.0
+    distance = 4000
+    cluster_mass = 10**4.
+
+    evo = evolution.MergedBaraffePisaEkstromParsec()
+    atm_func = atmospheres.get_merged_atmosphere
+    iso = syn.Isochrone(log_age, AKs, distance, evo_model=evo, 
+                        atm_func=atm_func, mass_sampling=10)
+
+    cluster = syn.UnresolvedCluster(iso, imf.Kroupa_2001(), cluster_mass, seed=4,
+                                    keep_spectra=True)
+    assert cluster.iso_numbers.sum() == len(cluster.mass_all)
+    assert len(cluster.spec_list_trim) == len(cluster.mass_all)
+
+    # The binned sum is the sum of the spectra of the stars
+    spec_sum = np.sum([np.asarray(spec._fluxtable) for spec in cluster.spec_list_trim], axis=0)
+    np.testing.assert_allclose(cluster.spec_trim, spec_sum, rtol=1e-8)
+
+    # Same seed, same spectrum, without keeping the spectra of the stars
+    cluster2 = syn.UnresolvedCluster(iso, imf.Kroupa_2001(), cluster_mass, seed=4)
+    assert not hasattr(cluster2, 'spec_list')
+    np.testing.assert_array_equal(cluster2.spec_trim, cluster.spec_trim)
+
+    return
+
+def test_match_model_masses():
+    """
+    Test the vectorized mass matching against match_model_mass.
+    """
+    rng = np.random.default_rng(1)
+    iso_masses = np.sort(rng.uniform(0.1, 50, 200))
+    iso_masses = np.concatenate([iso_masses[100:], iso_masses[:100]])
+    star_masses = rng.uniform(0.05, 80, 2000)
+
+    indices = syn.match_model_masses(iso_masses, star_masses)
+
+    for ii in range(len(star_masses)):
+        mdx = syn.match_model_mass(iso_masses, star_masses[ii])
+        if mdx is None:
+            assert indices[ii] == -1
+        else:
+            assert indices[ii] == mdx
+
+    return
+
 def test_ifmr_multiplicity():
     # Define cluster parameters
     logAge = 9.7
@@ -688,7 +1486,8 @@ def model_young_cluster_object(resolved=False):
     if resolved:
         cluster = syn.ResolvedCluster(iso, imf_in, cluster_mass)
     else:
-        cluster = syn.UnresolvedCluster(iso, imf_in, cluster_mass, wave_range=[19000,24000])
+        cluster = syn.UnresolvedCluster(iso, imf_in, cluster_mass, wave_range=[19000,24000],
+                                        keep_spectra=True)
 
     # Plot the spectrum of the most massive star
     idx = cluster.mass_all.argmax()
@@ -0,0 +1,50 @@
+import numpy as np
+
+def get_rng(seed=None):
+    """
+    Return a numpy random Generator for the random sampling in SPISEA.
+
+    Every object that draws random numbers has its own Generator (rather than
+    the global np.random state), so that objects made at the same time
+    (e.g. clusters made in parallel threads) don't change each other's
+    random numbers.
+
+    Parameters
+    ----------
+    seed: None, int, numpy.random.SeedSequence, or numpy.random.Generator
+        If None, a new Generator is made with a random seed. If an int or
+        SeedSequence, a new Generator is made from it (the output is
+        identical for the same seed). A Generator is returned as is.
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+
+    return np.random.default_rng(seed)
+
+def spawn_rngs(seed, n):
+    """
+    Make n independent random Generators from one seed (with
+    numpy.random.SeedSequence.spawn), e.g. for n clusters made
+    in parallel. The output is identical for the same seed, regardless
+    of the order in which the Generators are used.
+
+    Parameters
+    ----------
+    seed: None, int, or numpy.random.SeedSequence
+        Seed of all of the Generators. If None, a random seed is used.
+
+    n: int
+        Number of Generators.
+
+    Returns
+    -------
+    rngs: list of numpy.random.Generator
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    return [np.random.default_rng(ss) for ss in seed.spawn(n)]